@@ -1,17 +1,66 @@
+import io
+import os
+import re
+import sys
+import math
+import array
 import logging
 import httpx
+import numpy as np
 import pydantic
 import xmltodict
 import stamina
 
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+from xml.etree import ElementTree
 from xml.parsers.expat import ExpatError
 from typing import List, Optional
+from app import settings
 
 
 logger = logging.getLogger(__name__)
 
 
+XML_READ_CHUNK_SIZE = 64 * 1024  # Bytes read from the source on each step of the streaming parser
+
+
+# Long-lived clients per ATS host (scheme://host:port), so connections are reused across pulls and retries
+_sessions = {}
+
+
+def get_session(endpoint) -> httpx.AsyncClient:
+    url = urlsplit(endpoint)
+    host = f"{url.scheme}://{url.netloc}"
+    session = _sessions.get(host)
+    if session is None or session.is_closed:
+        http2 = settings.ATS_HTTP2
+        if http2:
+            try:
+                import h2  # noqa: F401  HTTP/2 support in httpx is optional
+            except ImportError:
+                logger.warning("ATS_HTTP2 is enabled but the 'h2' package is not installed. Using HTTP/1.1.")
+                http2 = False
+        session = httpx.AsyncClient(
+            timeout=120,
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=settings.ATS_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.ATS_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.ATS_KEEPALIVE_EXPIRY
+            )
+        )
+        _sessions[host] = session
+    return session
+
+
+async def close_sessions():
+    sessions = list(_sessions.values())
+    _sessions.clear()
+    for session in sessions:
+        await session.aclose()
+
+
 # Pydantic models
 class DataResponse(pydantic.BaseModel):
     ats_serial_num: str = pydantic.Field(..., alias="AtsSerialNum")
@@ -48,6 +97,12 @@ class TransmissionsResponse(pydantic.BaseModel):
         allow_population_by_field_name = True
 
 
+class DeviceDataPointsSummary(pydantic.BaseModel):
+    count: int
+    first_fix: datetime
+    last_fix: datetime
+
+
 class PullObservationsDataResponse(pydantic.BaseModel):
     vehicles: List[DataResponse]
 
@@ -74,6 +129,108 @@ def normalize_xml_string(xml_str):
     return xml_str
 
 
+class DataPointsStreamParser:
+    """
+    Incremental parser for the ATS data points XML.
+    Bytes are fed as they arrive and validated DataResponse rows are returned one <Table> element at a time,
+    releasing each element once parsed so the full document is never held in memory.
+    """
+    _ESCAPED_CHARS = re.compile(rb'\\(["/])|"')
+
+    def __init__(self):
+        self._parser = ElementTree.XMLPullParser(events=("start", "end"))
+        self._open_elements = []
+        self._root_found = False
+        self._quoted = None  # Some responses come wrapped in quotes and with escaped characters
+        self._pending = b""
+
+    def feed(self, chunk: bytes) -> List[DataResponse]:
+        if self._quoted is None:
+            chunk = chunk.lstrip()
+            if not chunk:
+                return []
+            self._quoted = chunk.startswith(b'"')
+        if self._quoted:
+            chunk = self._unescape(self._pending + chunk)
+        return self._parse(chunk)
+
+    def close(self) -> List[DataResponse]:
+        data_points = self._parse(self._unescape(self._pending, final=True)) if self._pending else []
+        try:
+            self._parser.close()
+        except ElementTree.ParseError as e:
+            msg = f"Invalid XML."
+            logger.exception(msg)
+            raise ATSBadXMLException(message=msg, error=e)
+        return data_points
+
+    def _unescape(self, data: bytes, final=False) -> bytes:
+        # Hold back a trailing backslash until we know which character it escapes
+        if not final and data.endswith(b"\\"):
+            data, self._pending = data[:-1], data[-1:]
+        else:
+            self._pending = b""
+        return self._ESCAPED_CHARS.sub(lambda match: match.group(1) or b"", data)
+
+    def _parse(self, data: bytes) -> List[DataResponse]:
+        data_points = []
+        try:
+            self._parser.feed(data)
+            for event, element in self._parser.read_events():
+                if event == "start":
+                    self._check_root(element)
+                    self._open_elements.append(element)
+                    continue
+                self._open_elements.pop()
+                parent = self._open_elements[-1] if self._open_elements else None
+                if element.tag == "Table" and parent is not None and parent.tag == "NewDataSet":
+                    data_points.append(self._build_data_point(element))
+                    parent.remove(element)  # Release the parsed row
+        except ElementTree.ParseError as e:
+            msg = f"Invalid XML."
+            logger.exception(msg)
+            raise ATSBadXMLException(message=msg, error=e)
+        return data_points
+
+    def _check_root(self, element):
+        if self._root_found:
+            return
+        if element.tag != "DataSet":
+            msg = f"Dataset or NewDataSet tag not found in XML."
+            logger.error(msg)
+            raise ATSBadXMLException(message=msg, error=KeyError("DataSet"))
+        self._root_found = True
+
+    @staticmethod
+    def _build_data_point(element) -> DataResponse:
+        # Empty tags are read as None, same as xmltodict does
+        row = {child.tag: (child.text or "").strip() or None for child in element}
+        try:
+            return DataResponse.parse_obj(row)
+        except pydantic.ValidationError as e:
+            msg = f"Error building 'DataResponse'."
+            logger.exception(msg)
+            raise ATSBadXMLException(message=msg, error=e)
+
+
+def iter_data_points(source, chunk_size=XML_READ_CHUNK_SIZE):
+    """
+    Stream the data points from an ATS data points XML.
+    :param source: A path to the XML file, or a binary file-like object
+    :param chunk_size: Bytes read from the source on each step
+    :return: A generator yielding validated DataResponse rows, one <Table> element at a time
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            yield from iter_data_points(f, chunk_size=chunk_size)
+        return
+
+    parser = DataPointsStreamParser()
+    while chunk := source.read(chunk_size):
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
+
 def closest_transmission(transmissions, test_date):
     sorted_list = sorted([t.DateSent for t in transmissions])
     previous_date = sorted_list[-1]
@@ -87,65 +244,252 @@ def closest_transmission(transmissions, test_date):
     return [t for t in transmissions if t.DateSent == sorted_list[-1]][0]
 
 
-def parse_data_points_from_xml(xml):
-    result = {}
-    try:
-        logger.info(f"-- Parsing response (xmltodict) --")
-        parsed_xml = xmltodict.parse(normalize_xml_string(xml))
-    except (xmltodict.ParsingInterrupted, ExpatError) as e:
-        msg = f"Invalid XML."
-        logger.exception(msg)
-        raise ATSBadXMLException(message=msg, error=e)
+def group_data_points_by_device(data_points):
+    """
+    Bucket data points per device (ats_serial_num) in a single pass, keeping their input order.
+    :param data_points: An iterable of DataResponse, e.g. the generator returned by iter_data_points()
+    :return: A tuple with a dict of data points per serial num, and a dict of DeviceDataPointsSummary per serial num
+    """
+    points_per_device = {}
+    for point in data_points:
+        points_per_device.setdefault(point.ats_serial_num, []).append(point)
+
+    summaries = {
+        serial_num: DeviceDataPointsSummary(
+            count=len(points),
+            first_fix=min(point.date_year_and_julian for point in points),
+            last_fix=max(point.date_year_and_julian for point in points),
+        )
+        for serial_num, points in points_per_device.items()
+    }
+    return points_per_device, summaries
+
+
+class DataPointBatch:
+    """
+    Columnar (array-backed) representation of a set of ATS data points.
+    Coordinates, timestamps and flags are kept in NumPy arrays. Serial numbers are stored once and referenced by
+    index, and the remaining text fields are kept as interned strings, so no per-fix objects are kept alive.
+    """
+    TEXT_FIELDS = ("num_sats", "hdop", "fix_time", "dimension", "activity", "temperature")
+    FLAG_FIELDS = ("mortality", "low_batt_voltage")
+    FLAG_MISSING = -1
+    _EPOCH = datetime(1970, 1, 1)
+
+    def __init__(self, serial_nums, serial_index, longitude, latitude, timestamps, text_columns, flag_columns):
+        self.serial_nums = serial_nums  # Unique serial numbers, in order of appearance
+        self.serial_index = serial_index  # uint32: Position of the serial number of each fix in serial_nums
+        self.longitude = longitude  # float64: NaN when missing
+        self.latitude = latitude  # float64: NaN when missing
+        self.timestamps = timestamps  # datetime64[us]: Local time of the device, without timezone
+        self.text_columns = text_columns  # Dict of lists of strings (or None), by field name
+        self.flag_columns = flag_columns  # Dict of int8 arrays by field name: 1 = True, 0 = False, -1 = missing
+
+    @classmethod
+    def from_data_points(cls, data_points):
+        """
+        Build a batch from an iterable of DataResponse, e.g. the generator returned by iter_data_points().
+        Each row is copied into the columns as it arrives so the DataResponse objects can be released right away.
+        """
+        builder = DataPointBatchBuilder()
+        builder.extend(data_points)
+        return builder.build()
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def take(self, indices):
+        """
+        Build a new batch with the fixes at the given positions (a NumPy array of indices).
+        """
+        index_list = indices.tolist()
+        return DataPointBatch(
+            serial_nums=self.serial_nums,
+            serial_index=self.serial_index[indices],
+            longitude=self.longitude[indices],
+            latitude=self.latitude[indices],
+            timestamps=self.timestamps[indices],
+            text_columns={field: [column[i] for i in index_list] for field, column in self.text_columns.items()},
+            flag_columns={field: column[indices] for field, column in self.flag_columns.items()},
+        )
+
+    def group_by_device(self):
+        """
+        Split the batch per device (ats_serial_num), keeping the input order within each device.
+        :return: A tuple with a dict of DataPointBatch per serial num, and a dict of DeviceDataPointsSummary per serial num
+        """
+        batches_per_device = {}
+        summaries = {}
+        order = np.argsort(self.serial_index, kind="stable")
+        positions = np.flatnonzero(np.diff(self.serial_index[order])) + 1
+        for indices in np.split(order, positions) if len(order) else []:
+            device_batch = self.take(indices)
+            serial_num = self.serial_nums[int(device_batch.serial_index[0])]
+            batches_per_device[serial_num] = device_batch
+            summaries[serial_num] = DeviceDataPointsSummary(
+                count=len(device_batch),
+                first_fix=device_batch.timestamps.min().item(),
+                last_fix=device_batch.timestamps.max().item(),
+            )
+        return batches_per_device, summaries
+
+    def columns(self):
+        """
+        Convert the columns to lists of python values, with the same fields and values as DataResponse.dict()
+        :return: A dict of lists by field name, in the same order as the DataResponse fields
+        """
+        columns = {
+            "ats_serial_num": [self.serial_nums[i] for i in self.serial_index.tolist()],
+            "longitude": [None if math.isnan(v) else v for v in self.longitude.tolist()],
+            "latitude": [None if math.isnan(v) else v for v in self.latitude.tolist()],
+            "date_year_and_julian": self.timestamps.tolist(),
+            **self.text_columns,
+            **{
+                field: [None if v == self.FLAG_MISSING else bool(v) for v in column.tolist()]
+                for field, column in self.flag_columns.items()
+            },
+        }
+        return {field: columns[field] for field in DataResponse.__fields__}
+
+    def records(self):
+        """
+        Iterate the fixes as dicts, with the same fields and values as DataResponse.dict()
+        """
+        columns = self.columns()
+        for values in zip(*columns.values()):
+            yield dict(zip(columns, values))
+
+
+class DataPointBatchBuilder:
+    """
+    Accumulates DataResponse rows into growable arrays, to build a DataPointBatch incrementally
+    (e.g. while the XML is still being received).
+    """
+
+    def __init__(self):
+        self._serial_positions = {}
+        self._serial_index = array.array("I")
+        self._longitude = array.array("d")
+        self._latitude = array.array("d")
+        self._timestamps = array.array("q")
+        self._text_columns = {field: [] for field in DataPointBatch.TEXT_FIELDS}
+        self._flag_columns = {field: array.array("b") for field in DataPointBatch.FLAG_FIELDS}
+
+    def extend(self, data_points):
+        for point in data_points:
+            self._serial_index.append(
+                self._serial_positions.setdefault(sys.intern(point.ats_serial_num), len(self._serial_positions))
+            )
+            self._longitude.append(math.nan if point.longitude is None else point.longitude)
+            self._latitude.append(math.nan if point.latitude is None else point.latitude)
+            self._timestamps.append(
+                (point.date_year_and_julian.replace(tzinfo=None) - DataPointBatch._EPOCH) // timedelta(microseconds=1)
+            )
+            for field, column in self._text_columns.items():
+                value = getattr(point, field)
+                column.append(None if value is None else sys.intern(value))
+            for field, column in self._flag_columns.items():
+                value = getattr(point, field)
+                column.append(DataPointBatch.FLAG_MISSING if value is None else int(value))
+
+    def build(self) -> DataPointBatch:
+        return DataPointBatch(
+            serial_nums=list(self._serial_positions),
+            serial_index=np.frombuffer(self._serial_index, dtype=np.uint32),
+            longitude=np.frombuffer(self._longitude, dtype=np.float64),
+            latitude=np.frombuffer(self._latitude, dtype=np.float64),
+            timestamps=np.frombuffer(self._timestamps, dtype=np.int64).view("datetime64[us]"),
+            text_columns=self._text_columns,
+            flag_columns={
+                field: np.frombuffer(column, dtype=np.int8) for field, column in self._flag_columns.items()
+            },
+        )
+
+
+def read_data_point_batch(source, chunk_size=XML_READ_CHUNK_SIZE) -> DataPointBatch:
+    """
+    Stream an ATS data points XML straight into a columnar DataPointBatch.
+    :param source: A path to the XML file, or a binary file-like object
+    :param chunk_size: Bytes read from the source on each step
+    """
+    return DataPointBatch.from_data_points(iter_data_points(source, chunk_size=chunk_size))
+
+
+async def read_data_point_batch_from_chunks(chunks) -> DataPointBatch:
+    """
+    Parse an ATS data points XML into a DataPointBatch as it's received.
+    :param chunks: An async iterable of bytes, e.g. a file being downloaded from cloud storage
+    """
+    parser = DataPointsStreamParser()
+    builder = DataPointBatchBuilder()
+    async for chunk in chunks:
+        builder.extend(parser.feed(chunk))
+    builder.extend(parser.close())
+    return builder.build()
 
+
+def parse_data_points_from_xml(xml):
+    logger.info(f"-- Parsing response (streaming) --")
+    response_per_device, summaries = group_data_points_by_device(
+        iter_data_points(io.BytesIO(xml.encode("utf-8")))
+    )
+    for serial_num, summary in summaries.items():
+        logger.info(
+            f"-- Extracted {summary.count} data points for device {serial_num} "
+            f"({summary.first_fix} - {summary.last_fix}) --"
+        )
+    return response_per_device
+
+
+async def _iter_endpoint_response(endpoint, auth, chunk_size=XML_READ_CHUNK_SIZE):
+    session = get_session(endpoint)
+    # Retry until the response headers are received, the body can't be read again once consumed
+    for attempt in stamina.retry_context(on=httpx.HTTPError, wait_initial=4.0, wait_jitter=5.0, wait_max=32.0):
+        with attempt:
+            response = await session.send(
+                session.build_request("GET", endpoint),
+                auth=(auth.username, auth.password.get_secret_value()),
+                stream=True
+            )
+            if response.is_error:  # Log response body on 4xx or 5xx
+                await response.aread()
+                await response.aclose()
+                logger.error(f"Error Response body: {response.text}")
+            response.raise_for_status()
     try:
-        data_xml_tag = parsed_xml["DataSet"].get("diffgr:diffgram", {})
-        data = data_xml_tag.get("NewDataSet", {})
-    except KeyError as e:
-        msg = f"Dataset or NewDataSet tag not found in XML."
-        logger.exception(msg)
-        raise ATSBadXMLException(message=msg, error=e)
+        async for chunk in response.aiter_bytes(chunk_size):
+            yield chunk
+    finally:
+        await response.aclose()
 
-    if data:
-        # Add a validator for checking if "Table" variable within data is a list, if not, convert it to a list
-        if not isinstance(data.get("Table"), list):
-            data["Table"] = [data.get("Table", {})]
 
-        try:
-            parsed_response = PullObservationsDataResponse.parse_obj(
-                {"vehicles": data.get("Table", [])}
-            )
-        except pydantic.ValidationError as e:
-            msg = f"Error building 'PullObservationsTransmissionsResponse'."
-            logger.exception(msg)
-            raise ATSBadXMLException(message=msg, error=e)
+async def iter_data_endpoint_response(integration_id, config, auth, chunk_size=XML_READ_CHUNK_SIZE):
+    endpoint = config.data_endpoint
+    logger.info(f"-- Streaming data points for integration ID: {integration_id} Endpoint: {endpoint} --")
+    async for chunk in _iter_endpoint_response(endpoint, auth, chunk_size):
+        yield chunk
 
-        response_per_device = {}
-        # save data points per serial num
-        serial_nums = set([v.ats_serial_num for v in parsed_response.vehicles])
-        for serial_num in serial_nums:
-            response_per_device[serial_num] = [
-                point for point in parsed_response.vehicles if serial_num == point.ats_serial_num
-            ]
-            logger.info(
-                f"-- Extracted {len(response_per_device[serial_num])} data points for device {serial_num} --")
-        result = response_per_device
 
-    return result
+async def iter_transmissions_endpoint_response(integration_id, config, auth, chunk_size=XML_READ_CHUNK_SIZE):
+    endpoint = config.transmissions_endpoint
+    logger.info(f"-- Streaming transmissions for integration ID: {integration_id} Endpoint: {endpoint} --")
+    async for chunk in _iter_endpoint_response(endpoint, auth, chunk_size):
+        yield chunk
 
 
 @stamina.retry(on=httpx.HTTPError, wait_initial=4.0, wait_jitter=5.0, wait_max=32.0)
 async def get_data_endpoint_response(integration_id, config, auth, parse_response=False):
     endpoint = config.data_endpoint
-    async with httpx.AsyncClient(timeout=120) as session:
-        logger.info(f"-- Getting data points for integration ID: {integration_id} Endpoint: {endpoint} --")
-        response = await session.get(endpoint, auth=(auth.username, auth.password.get_secret_value()))
-        if response.is_error:  # Log response body on 4xx or 5xx
-            logger.error(f"Error Response body: {response.text}")
-        response.raise_for_status()
-        if parse_response:
-            return parse_data_points_from_xml(xml=response.text)
-        else:
-            return response.text
+    session = get_session(endpoint)
+    logger.info(f"-- Getting data points for integration ID: {integration_id} Endpoint: {endpoint} --")
+    response = await session.get(endpoint, auth=(auth.username, auth.password.get_secret_value()))
+    if response.is_error:  # Log response body on 4xx or 5xx
+        logger.error(f"Error Response body: {response.text}")
+    response.raise_for_status()
+    if parse_response:
+        return parse_data_points_from_xml(xml=response.text)
+    else:
+        return response.text
 
 
 def parse_transmissions_from_xml(xml):
@@ -187,13 +531,13 @@ def parse_transmissions_from_xml(xml):
 @stamina.retry(on=httpx.HTTPError, wait_initial=4.0, wait_jitter=5.0, wait_max=32.0)
 async def get_transmissions_endpoint_response(integration_id, config, auth, parse_response=False):
     endpoint = config.transmissions_endpoint
-    async with httpx.AsyncClient(timeout=120) as session:
-        logger.info(f"-- Getting transmissions for integration ID: {integration_id} Endpoint: {endpoint} --")
-        response = await session.get(endpoint, auth=(auth.username, auth.password.get_secret_value()))
-        if response.is_error:  # Log response body on 4xx or 5xx
-            logger.error(f"Error Response body: {response.text}")
-        response.raise_for_status()
-        if parse_response:
-            return parse_transmissions_from_xml(xml=response.text)
-        else:
-            return response.text
+    session = get_session(endpoint)
+    logger.info(f"-- Getting transmissions for integration ID: {integration_id} Endpoint: {endpoint} --")
+    response = await session.get(endpoint, auth=(auth.username, auth.password.get_secret_value()))
+    if response.is_error:  # Log response body on 4xx or 5xx
+        logger.error(f"Error Response body: {response.text}")
+    response.raise_for_status()
+    if parse_response:
+        return parse_transmissions_from_xml(xml=response.text)
+    else:
+        return response.text
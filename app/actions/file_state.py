@@ -0,0 +1,358 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+import time
+import stamina
+import redis.asyncio as redis
+from app import settings
+from app.actions.configurations import FileStatus
+
+
+logger = logging.getLogger(__name__)
+
+
+# Files are tracked per integration, in sorted sets named "<group>.<integration_id>" and scored by file timestamp,
+# except in-progress files that are scored by the expiry of their lease.
+# The group names alone were global sets shared by all the integrations, kept until they're migrated.
+PENDING_FILES = "ats_pending_files"
+IN_PROGRESS_FILES = "ats_in_progress_files"
+PROCESSED_FILES = "ats_processed_files"
+# Hashes named "<FILE_LEASES>.<integration_id>", with the lease of each in-progress file:
+# {"owner": ..., "score": ..., "attempts": ...}. Reclaimed files keep their entry, to count the processing attempts.
+FILE_LEASES = "ats_file_leases"
+# Bloom filters named "<PROCESSED_FILES_SEEN>.<integration_id>.<generation>", remembering processed files after
+# they're trimmed. A new generation starts every retention period, and the previous one is still checked.
+PROCESSED_FILES_SEEN = "ats_processed_files_seen"
+
+# A file is in at most one group. The scripts receive the groups in this order, and refer to them by position.
+FILE_STATUS_GROUPS = {
+    FileStatus.PENDING: PENDING_FILES,
+    FileStatus.IN_PROGRESS: IN_PROGRESS_FILES,
+    FileStatus.PROCESSED: PROCESSED_FILES,
+}
+FILE_STATUSES = list(FILE_STATUS_GROUPS)
+
+ANY_STATUS = object()  # Use it as expected_status to set the status of a file regardless of the current one
+
+# Held while the global groups are migrated, so only one migration runs at a time in the process
+_migration_lock = asyncio.Lock()
+# Set once the global groups are found empty, so the process stops checking them
+_global_groups_migrated = False
+
+# KEYS: the status groups. ARGV[1]: the file name.
+# Returns the position of the group holding the file, or 0 if the file isn't in any group.
+GET_STATUS_SCRIPT = """
+for i, key in ipairs(KEYS) do
+    if redis.call("ZSCORE", key, ARGV[1]) then
+        return i
+    end
+end
+return 0
+"""
+
+# KEYS[1..3]: the status groups, KEYS[4]: the leases, KEYS[5]: the current generation of the processed files filter.
+# ARGV[1]: the file name, ARGV[2]: the position of the target group,
+# ARGV[3]: the position of the expected group (0 for untracked files), or "" to skip the check, ARGV[4]: the score,
+# ARGV[5]: the lease owner, or "" to skip the check of in-progress files, ARGV[6]: the lease expiry,
+# ARGV[7]: the expiry of the filter in seconds,
+# ARGV[8...]: the bits of the file in the processed files filter, set when the file is processed.
+# Returns {1 if the file was moved else 0, the position of the group holding the file before}.
+SET_STATUS_SCRIPT = """
+local current = 0
+for i = 1, 3 do
+    if redis.call("ZSCORE", KEYS[i], ARGV[1]) then
+        current = i
+        break
+    end
+end
+if ARGV[3] ~= "" and tonumber(ARGV[3]) ~= current then
+    return {0, current}
+end
+if current == 2 and ARGV[5] ~= "" then
+    local lease = redis.call("HGET", KEYS[4], ARGV[1])
+    if lease and cjson.decode(lease)["owner"] ~= ARGV[5] then
+        return {0, current}
+    end
+end
+if current ~= 0 then
+    redis.call("ZREM", KEYS[current], ARGV[1])
+end
+local attempts = 0
+if tonumber(ARGV[2]) == 2 then
+    local lease = redis.call("HGET", KEYS[4], ARGV[1])
+    if lease then
+        attempts = tonumber(cjson.decode(lease)["attempts"] or 0)
+    end
+end
+redis.call("HDEL", KEYS[4], ARGV[1])
+if tonumber(ARGV[2]) == 2 then
+    redis.call("ZADD", KEYS[2], ARGV[6], ARGV[1])
+    redis.call("HSET", KEYS[4], ARGV[1], cjson.encode({owner = ARGV[5], score = ARGV[4], attempts = attempts + 1}))
+else
+    redis.call("ZADD", KEYS[tonumber(ARGV[2])], ARGV[4], ARGV[1])
+end
+if tonumber(ARGV[2]) == 3 then
+    for i = 8, #ARGV do
+        redis.call("SETBIT", KEYS[5], ARGV[i], 1)
+    end
+    redis.call("EXPIRE", KEYS[5], ARGV[7])
+end
+return {1, current}
+"""
+
+# KEYS[1]: the pending group, KEYS[2]: the in-progress group, KEYS[3]: the leases.
+# ARGV[1]: the current time, ARGV[2]: the maximum number of processing attempts.
+# Moves the in-progress files with an expired lease back to pending, keeping their count of attempts.
+# Files that used all their attempts are left in progress without expiry instead.
+# Returns {names of the files set back to pending, names of the files left in progress}.
+RECLAIM_EXPIRED_LEASES_SCRIPT = """
+local expired = redis.call("ZRANGEBYSCORE", KEYS[2], "-inf", ARGV[1])
+local reclaimed = {}
+local abandoned = {}
+for _, file_name in ipairs(expired) do
+    local lease = redis.call("HGET", KEYS[3], file_name)
+    local score = ARGV[1]
+    local attempts = 0
+    if lease then
+        lease = cjson.decode(lease)
+        score = lease["score"]
+        attempts = tonumber(lease["attempts"] or 0)
+    end
+    if attempts >= tonumber(ARGV[2]) then
+        redis.call("ZADD", KEYS[2], "+inf", file_name)
+        table.insert(abandoned, file_name)
+    else
+        redis.call("ZREM", KEYS[2], file_name)
+        redis.call("HSET", KEYS[3], file_name, cjson.encode({score = score, attempts = attempts}))
+        redis.call("ZADD", KEYS[1], score, file_name)
+        table.insert(reclaimed, file_name)
+    end
+end
+return {reclaimed, abandoned}
+"""
+
+
+def _status_position(status):
+    return FILE_STATUSES.index(status) + 1 if status else 0
+
+
+def _status_at(position):
+    return FILE_STATUSES[int(position) - 1] if position else None
+
+
+def _group_keys(integration_id):
+    return [f"{group}.{integration_id}" for group in FILE_STATUS_GROUPS.values()]
+
+
+def _processed_filter_key(integration_id, generation):
+    return f"{PROCESSED_FILES_SEEN}.{integration_id}.{generation}"
+
+
+def processed_filter_bits(file_name, size_bits, hashes):
+    # Positions of a file in a Bloom filter, by double hashing
+    digest = hashlib.sha256(file_name.encode("utf-8")).digest()
+    h1, h2 = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:16], "big") | 1
+    return [(h1 + i * h2) % size_bits for i in range(hashes)]
+
+
+def file_timestamp(file_name):
+    # Files are named "<timestamp>_<integration_id>_<type>.xml", with UTC timestamps like 20241206121217722379
+    try:
+        timestamp = datetime.datetime.strptime(file_name.split("_")[0], "%Y%m%d%H%M%S%f")
+    except ValueError:
+        return time.time()
+    return timestamp.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+class FileStateStore:
+    """
+    Tracks the processing status of the data files pulled from ATS.
+    Lookups and compare-and-set transitions run as Lua scripts, so each one is atomic and takes a single round trip.
+    """
+
+    def __init__(self, **kwargs):
+        host = kwargs.get("host", settings.REDIS_HOST)
+        port = kwargs.get("port", settings.REDIS_PORT)
+        db = kwargs.get("db", settings.REDIS_STATE_DB)
+        self.lease_seconds = kwargs.get("lease_seconds", settings.FILE_PROCESSING_LEASE_SECONDS)
+        self.max_attempts = kwargs.get("max_attempts", settings.FILE_PROCESSING_MAX_ATTEMPTS)
+        self.processed_retention_seconds = kwargs.get(
+            "processed_retention_seconds", settings.PROCESSED_FILES_RETENTION_DAYS * 24 * 3600
+        )
+        self.processed_max_count = kwargs.get("processed_max_count", settings.PROCESSED_FILES_MAX_COUNT)
+        self.processed_filter_size_bits = kwargs.get("processed_filter_size_bits", settings.PROCESSED_FILES_FILTER_SIZE_BITS)
+        self.processed_filter_hashes = kwargs.get("processed_filter_hashes", settings.PROCESSED_FILES_FILTER_HASHES)
+        self.db_client = redis.StrictRedis(host=host, port=port, db=db, encoding="utf-8", decode_responses=True)
+        self._get_status_script = self.db_client.register_script(GET_STATUS_SCRIPT)
+        self._set_status_script = self.db_client.register_script(SET_STATUS_SCRIPT)
+        self._reclaim_expired_leases_script = self.db_client.register_script(RECLAIM_EXPIRED_LEASES_SCRIPT)
+
+    async def get_status(self, integration_id: str, file_name: str):
+        # Returns the FileStatus of the file, or None if it isn't tracked.
+        for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30,
+                                             wait_jitter=3.0):
+            with attempt:
+                position = await self._get_status_script(keys=_group_keys(integration_id), args=[file_name])
+        return _status_at(position)
+
+    async def set_status(self, integration_id: str, file_name: str, status: FileStatus, expected_status=ANY_STATUS,
+                         lease_owner: str = None):
+        """
+        Set the status of a file. If expected_status is given (None meaning the file isn't tracked),
+        the status is only set when it matches the current status of the file.
+        Files set in progress get a lease for lease_owner, and once it expires they can be reclaimed back to pending.
+        If the file is in progress and lease_owner is given, the status is only set when lease_owner holds the lease.
+        Returns whether the status was set, and the status of the file before the call.
+        """
+        keys, args = self._set_status_keys_and_args(integration_id, file_name, status, expected_status, lease_owner)
+        for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30,
+                                             wait_jitter=3.0):
+            with attempt:
+                moved, previous = await self._set_status_script(keys=keys, args=args)
+        return bool(moved), _status_at(previous)
+
+    def _set_status_keys_and_args(self, integration_id, file_name, status, expected_status, lease_owner):
+        expected = "" if expected_status is ANY_STATUS else _status_position(expected_status)
+        lease_expiry = time.time() + self.lease_seconds if status == FileStatus.IN_PROGRESS else 0
+        filter_bits = self._processed_filter_bits(file_name) if status == FileStatus.PROCESSED else []
+        filter_key = _processed_filter_key(integration_id, self._processed_filter_generation())
+        keys = [*_group_keys(integration_id), f"{FILE_LEASES}.{integration_id}", filter_key]
+        args = [
+            file_name, _status_position(status), expected, file_timestamp(file_name),
+            lease_owner or "", lease_expiry, 2 * self.processed_retention_seconds, *filter_bits
+        ]
+        return keys, args
+
+    async def reclaim_expired_leases(self, integration_id: str):
+        """
+        Set the in-progress files of an integration back to pending once their lease expired,
+        e.g. when the processing crashed, failed or timed out. Files processed max_attempts times already are left
+        in progress without expiry instead, until their status is set manually.
+        Returns the names of the files set back to pending, and the names of the files left in progress.
+        """
+        pending_group, in_progress_group, _ = _group_keys(integration_id)
+        for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30,
+                                             wait_jitter=3.0):
+            with attempt:
+                reclaimed_files, abandoned_files = await self._reclaim_expired_leases_script(
+                    keys=[pending_group, in_progress_group, f"{FILE_LEASES}.{integration_id}"],
+                    args=[time.time(), self.max_attempts]
+                )
+        return reclaimed_files, abandoned_files
+
+    async def trim_processed_files(self, integration_id: str):
+        """
+        Remove the processed files older than the retention period, and then the oldest ones above the maximum count.
+        They're still in the filters used by was_processed(). Returns the number of files removed.
+        """
+        processed_group = f"{PROCESSED_FILES}.{integration_id}"
+        for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30,
+                                             wait_jitter=3.0):
+            with attempt:
+                async with self.db_client.pipeline(transaction=False) as pipeline:
+                    pipeline.zremrangebyscore(processed_group, "-inf", time.time() - self.processed_retention_seconds)
+                    pipeline.zremrangebyrank(processed_group, 0, -(self.processed_max_count + 1))
+                    removed_by_age, removed_by_count = await pipeline.execute()
+        return removed_by_age + removed_by_count
+
+    async def was_processed(self, integration_id: str, file_name: str):
+        # Whether the file was processed in the current or the previous retention period, even if it was trimmed since.
+        # It may be wrong (rarely) for files never processed.
+        generation = self._processed_filter_generation()
+        filter_keys = [_processed_filter_key(integration_id, g) for g in (generation, generation - 1)]
+        filter_bits = self._processed_filter_bits(file_name)
+        for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30,
+                                             wait_jitter=3.0):
+            with attempt:
+                async with self.db_client.pipeline(transaction=False) as pipeline:
+                    for filter_key in filter_keys:
+                        for bit in filter_bits:
+                            pipeline.getbit(filter_key, bit)
+                    bits_set = await pipeline.execute()
+        return any(
+            all(bits_set[i:i + len(filter_bits)]) for i in range(0, len(bits_set), len(filter_bits))
+        )
+
+    def _processed_filter_generation(self):
+        return int(time.time() // self.processed_retention_seconds)
+
+    def _processed_filter_bits(self, file_name):
+        return processed_filter_bits(file_name, self.processed_filter_size_bits, self.processed_filter_hashes)
+
+    async def get_files(self, integration_id: str, status: FileStatus, limit: int = None):
+        # Returns the names of the files of an integration with the given status, oldest first.
+        for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30,
+                                             wait_jitter=3.0):
+            with attempt:
+                return await self.db_client.zrange(
+                    f"{FILE_STATUS_GROUPS[status]}.{integration_id}", 0, limit - 1 if limit else -1
+                )
+
+    async def migrate_global_groups(self, batch_size: int = 500):
+        """
+        Move the files from the global groups shared by all the integrations to the groups of their integration,
+        in batches of batch_size files taking one round trip each. Files already tracked per integration keep
+        their status. If a migration is already running in the process, it returns right away.
+        It can run regularly to pick up files added by replicas still on the previous version, until it finds
+        the global groups empty. From then on it returns right away too. Returns the number of files migrated.
+        """
+        global _global_groups_migrated
+        if _global_groups_migrated or _migration_lock.locked():
+            return 0
+        async with _migration_lock:
+            for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30,
+                                                 wait_jitter=3.0):
+                with attempt:
+                    async with self.db_client.pipeline(transaction=False) as pipeline:
+                        for group in FILE_STATUS_GROUPS.values():
+                            pipeline.scard(group)
+                        group_sizes = await pipeline.execute()
+            if not any(group_sizes):
+                _global_groups_migrated = True
+                return 0
+            migrated = 0
+            for (status, group), group_size in zip(FILE_STATUS_GROUPS.items(), group_sizes):
+                if not group_size:
+                    continue
+                file_names = []
+                async for file_name in self.db_client.sscan_iter(group, count=batch_size):
+                    file_names.append(file_name)
+                    if len(file_names) >= batch_size:
+                        migrated += await self._migrate_files(group, status, file_names)
+                        file_names = []
+                if file_names:
+                    migrated += await self._migrate_files(group, status, file_names)
+        if migrated:
+            logger.info(f"{migrated} files migrated from the global file groups.")
+        return migrated
+
+    async def _migrate_files(self, group: str, status: FileStatus, file_names: list):
+        # Moves the files from a global group to the groups of their integration, in one round trip
+        files_by_integration = []
+        for file_name in file_names:
+            try:
+                _, integration_id, _ = file_name.split("_", 2)
+            except ValueError:
+                logger.warning(f"Can't find the integration of file '{file_name}' in '{group}'. Discarded.")
+            else:
+                files_by_integration.append((integration_id, file_name))
+        for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30,
+                                             wait_jitter=3.0):
+            with attempt:
+                async with self.db_client.pipeline(transaction=False) as pipeline:
+                    for integration_id, file_name in files_by_integration:
+                        keys, args = self._set_status_keys_and_args(
+                            integration_id, file_name, status, expected_status=None, lease_owner=None
+                        )
+                        await self._set_status_script(keys=keys, args=args, client=pipeline)
+                    pipeline.srem(group, *file_names)
+                    await pipeline.execute()
+        return len(files_by_integration)
+
+    def __str__(self):
+        connection_kwargs = self.db_client.connection_pool.connection_kwargs
+        return f"FileStateStore(host={connection_kwargs.get('host')}, port={connection_kwargs.get('port')}, db={connection_kwargs.get('db')})"
+
+    def __repr__(self):
+        return self.__str__()
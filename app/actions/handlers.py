@@ -1,16 +1,19 @@
 import asyncio
 import datetime
+import socket
+import uuid
+import time
 import aiohttp
 import logging
-import aiofiles
 import httpx
+import numpy as np
 from gundi_core.schemas.v2.gundi import LogLevel
 from app import settings
 from app.actions import ats_client
-import app.services.gundi as gundi_tools
+from app.actions.sender import ObservationsSender
 from app.services.activity_logger import activity_logger, log_action_activity
-from app.services.state import IntegrationStateManager
 from app.services.file_storage import CloudFileStorage
+from app.actions.file_state import FileStateStore
 from app.actions.configurations import (
     FileStatus,
     AuthenticateConfig,
@@ -27,13 +30,8 @@ from app.services.action_scheduler import crontab_schedule
 logger = logging.getLogger(__name__)
 
 
-state_manager = IntegrationStateManager()
 file_storage = CloudFileStorage()
-
-
-PENDING_FILES = "ats_pending_files"
-IN_PROGRESS_FILES = "ats_in_progress_files"
-PROCESSED_FILES = "ats_processed_files"
+file_state = FileStateStore()
 
 
 def extract_gmt_offsets(transmissions, integration_id):
@@ -50,27 +48,6 @@ def extract_gmt_offsets(transmissions, integration_id):
     return offsets_by_device
 
 
-def get_file_group_by_status(status):
-    if status == FileStatus.PENDING:
-        return PENDING_FILES
-    elif status == FileStatus.IN_PROGRESS:
-        return IN_PROGRESS_FILES
-    elif status == FileStatus.PROCESSED:
-        return PROCESSED_FILES
-    else:
-        return None
-
-
-async def get_file_status(file_name):
-    if await state_manager.group_ismember(PENDING_FILES, file_name):
-        return {"status": FileStatus.PENDING.value, "group": PENDING_FILES}
-    elif await state_manager.group_ismember(IN_PROGRESS_FILES, file_name):
-        return {"status": FileStatus.IN_PROGRESS.value, "group": IN_PROGRESS_FILES}
-    elif await state_manager.group_ismember(PROCESSED_FILES, file_name):
-        return {"status": FileStatus.PROCESSED.value, "group": PROCESSED_FILES}
-    return {}
-
-
 async def filter_and_transform(serial_num, vehicles, gmt_offset, integration_id, action_id):
     transformed_data = []
     main_data = ["ats_serial_num", "date_year_and_julian", "latitude", "longitude"]
@@ -87,27 +64,35 @@ async def filter_and_transform(serial_num, vehicles, gmt_offset, integration_id,
         )
         gmt_offset = 0
 
-    for vehicle in vehicles:
-        # Get GmtOffset for this device
-        time_delta = datetime.timedelta(hours=gmt_offset)
-        timezone_object = datetime.timezone(time_delta)
-
-        date_year_and_julian_with_tz = vehicle.date_year_and_julian.replace(tzinfo=timezone_object)
-
-        vehicle.date_year_and_julian = date_year_and_julian_with_tz
-
+    # vehicles is a DataPointBatch with the fixes of this device, so the observations are built column-wise.
+    # recorded_at is formatted from the datetime64 column in one step, with the device's UTC offset appended
+    # to the whole column, as it's serialized anyway when the observations are sent.
+    timezone_object = datetime.timezone(datetime.timedelta(hours=gmt_offset))
+    utc_offset = datetime.datetime(2000, 1, 1, tzinfo=timezone_object).isoformat()[19:]  # e.g. "-03:00"
+    timestamps = vehicles.timestamps
+    unit = "s" if (timestamps.astype("datetime64[s]") == timestamps).all() else "us"
+    recorded_at = np.char.add(np.datetime_as_string(timestamps, unit=unit), utc_offset).tolist()
+    columns = vehicles.columns()
+    additional_fields = [field for field in columns if field not in main_data]
+    for source, date_year_and_julian_with_tz, latitude, longitude, *additional_values in zip(
+            columns["ats_serial_num"],
+            recorded_at,
+            columns["latitude"],
+            columns["longitude"],
+            *(columns[field] for field in additional_fields)
+    ):
         data = {
-            "source": vehicle.ats_serial_num,
-            "source_name": vehicle.ats_serial_num,
+            "source": source,
+            "source_name": source,
             'type': 'tracking-device',
-            "recorded_at": vehicle.date_year_and_julian,
+            "recorded_at": date_year_and_julian_with_tz,
             "location": {
-                "lat": vehicle.latitude,
-                "lon": vehicle.longitude
+                "lat": latitude,
+                "lon": longitude
             },
             "additional": {
-                key: value for key, value in vehicle.dict().items()
-                if key not in main_data and value is not None
+                key: value for key, value in zip(additional_fields, additional_values)
+                if value is not None
             }
         }
         transformed_data.append(data)
@@ -115,69 +100,69 @@ async def filter_and_transform(serial_num, vehicles, gmt_offset, integration_id,
     return transformed_data
 
 
-async def retrieve_transmissions(integration_id, auth_config, pull_config, file_prefix):
-    logger.info(f"Retrieving transmissions for integration '{integration_id}'...")
-    transmissions_raw_xml = await ats_client.get_transmissions_endpoint_response(
-        integration_id=integration_id,
-        config=pull_config,
-        auth=auth_config
-    )
-
+async def retrieve_transmissions(integration_id, auth_config, pull_config, file_prefix, timings=None):
+    timings = timings if timings is not None else {}
     transmissions_file_name = f"{file_prefix}_transmissions.xml"
-    logger.info(f"Saving transmissions for integration '{integration_id}' to file '{transmissions_file_name}'...")
-    async with aiofiles.open(f"/tmp/{transmissions_file_name}", "w") as f:
-        await f.write(transmissions_raw_xml)
-
-    logger.info(f"Uploading transmissions file {transmissions_file_name} to cloud storage...")
-    await file_storage.upload_file(
+    logger.info(
+        f"Retrieving transmissions for integration '{integration_id}' into file '{transmissions_file_name}'..."
+    )
+    start_time = time.monotonic()
+    # The response is uploaded to cloud storage as it's received, without buffering it in memory or disk
+    await file_storage.upload_stream(
         integration_id=integration_id,
-        local_file_path=f"/tmp/{transmissions_file_name}",
+        chunks=ats_client.iter_transmissions_endpoint_response(
+            integration_id=integration_id,
+            config=pull_config,
+            auth=auth_config
+        ),
         destination_blob_name=transmissions_file_name,
+        zipped=settings.ATS_STORE_FILES_GZIPPED,
         metadata={
             "integration_id": integration_id,
             "ats_username": auth_config.username,
             "status": FileStatus.PENDING.value
         }
     )
-
+    timings["transmissions"] = round(time.monotonic() - start_time, 3)
     logger.info(f"Transmissions file {transmissions_file_name} saved.")
     return transmissions_file_name
 
 
-async def retrieve_data_points(integration_id, auth_config, pull_config, file_prefix):
-    logger.info(f"Retrieving data points for integration '{integration_id}'...")
-    data_points_raw_xml = await ats_client.get_data_endpoint_response(
-        integration_id=integration_id,
-        config=pull_config,
-        auth=auth_config
-    )
-
+async def retrieve_data_points(integration_id, auth_config, pull_config, file_prefix, timings=None):
+    timings = timings if timings is not None else {}
     data_points_file_name = f"{file_prefix}_data_points.xml"
-    logger.info(f"Saving data points for integration '{integration_id}' to file '{data_points_file_name}'...")
-    async with aiofiles.open(f"/tmp/{data_points_file_name}", "w") as f:
-        await f.write(data_points_raw_xml)
-
-    logger.info(f"Uploading data points file {data_points_file_name} to cloud storage...")
-    await file_storage.upload_file(
+    logger.info(f"Retrieving data points for integration '{integration_id}' into file '{data_points_file_name}'...")
+    start_time = time.monotonic()
+    # The response is uploaded to cloud storage as it's received, without buffering it in memory or disk
+    await file_storage.upload_stream(
         integration_id=integration_id,
-        local_file_path=f"/tmp/{data_points_file_name}",
+        chunks=ats_client.iter_data_endpoint_response(
+            integration_id=integration_id,
+            config=pull_config,
+            auth=auth_config
+        ),
         destination_blob_name=data_points_file_name,
+        zipped=settings.ATS_STORE_FILES_GZIPPED,
         metadata={
             "integration_id": integration_id,
             "ats_username": auth_config.username,
             "status": FileStatus.PENDING.value
         }
     )
-
-    # Add it to the list of pending files to be processed
-    await state_manager.group_add(
-        group_name=PENDING_FILES,
-        values=[data_points_file_name]
-    )
+    timings["data_points"] = round(time.monotonic() - start_time, 3)
     logger.info(f"Data points file {data_points_file_name} saved.")
     return data_points_file_name
 
 
+async def delete_file_quietly(integration_id, file_name):
+    try:
+        await file_storage.delete_file(integration_id=integration_id, blob_name=file_name)
+    except Exception as e:
+        logger.warning(f"Error deleting file {file_name} for integration {integration_id}: {type(e).__name__}: {e}")
+    else:
+        logger.info(f"File {file_name} deleted.")
+
+
 async def action_auth(integration, action_config: AuthenticateConfig):
     logger.info(f"Executing 'auth' action with integration ID {integration.id} and action_config {action_config}...")
     pull_config = get_pull_config(integration)
@@ -210,30 +195,58 @@ async def action_pull_observations(integration, action_config: PullObservationsC
     pull_config = action_config
     timestamp = datetime.datetime.now(tz=datetime.timezone.utc).strftime("%Y%m%d%H%M%S%f")
     file_prefix = f"{timestamp}_{integration_id}"
-    transmissions_file = await retrieve_transmissions(
-        integration_id=integration_id,
-        auth_config=auth_config,
-        pull_config=pull_config,
-        file_prefix=file_prefix
+    timings = {}
+    start_time = time.monotonic()
+    # Both endpoints are independent, so they are streamed to cloud storage concurrently
+    transmissions_result, data_points_result = await asyncio.gather(
+        retrieve_transmissions(
+            integration_id=integration_id,
+            auth_config=auth_config,
+            pull_config=pull_config,
+            file_prefix=file_prefix,
+            timings=timings
+        ),
+        retrieve_data_points(
+            integration_id=integration_id,
+            auth_config=auth_config,
+            pull_config=pull_config,
+            file_prefix=file_prefix,
+            timings=timings
+        ),
+        return_exceptions=True
     )
-    data_points_file = await retrieve_data_points(
+    errors = [result for result in (transmissions_result, data_points_result) if isinstance(result, BaseException)]
+    if errors:
+        # Don't leave a file without its pair in the bucket
+        for file_name in (transmissions_result, data_points_result):
+            if isinstance(file_name, str):
+                await delete_file_quietly(integration_id, file_name)
+        raise errors[0]
+    transmissions_file, data_points_file = transmissions_result, data_points_result
+
+    # Add the data file to the list of pending files only when both files are saved
+    await file_state.set_status(
         integration_id=integration_id,
-        auth_config=auth_config,
-        pull_config=pull_config,
-        file_prefix=file_prefix
+        file_name=data_points_file,
+        status=FileStatus.PENDING
     )
-    logger.info(f"-- Observations pulled with success for integration ID: {str(integration.id)}.")
+    timings["total"] = round(time.monotonic() - start_time, 3)
+    logger.info(f"-- Observations pulled with success for integration ID: {str(integration.id)}. Timings: {timings}")
 
-    return {"transmissions_file": transmissions_file, "data_points_file": data_points_file}
+    return {"transmissions_file": transmissions_file, "data_points_file": data_points_file, "timings": timings}
 
 
 async def process_data_file(file_name, integration, process_config):
     logger.info(f"Processing data file {file_name} for integration {integration}...")
-    # Set the file in progress for thread-safety
-    moved = await state_manager.group_move(
-        from_group=PENDING_FILES,
-        to_group=IN_PROGRESS_FILES,
-        values=[file_name]
+    integration_id = str(integration.id)
+    # Set the file in progress for thread-safety. If this run dies, the file is set back to pending once the lease expires
+    lease_owner = f"{socket.gethostname()}-{uuid.uuid4().hex[:12]}"
+    moved, _ = await file_state.set_status(
+        integration_id=integration_id,
+        file_name=file_name,
+        status=FileStatus.IN_PROGRESS,
+        expected_status=FileStatus.PENDING,
+        lease_owner=lease_owner
     )
     if not moved:
         logger.warning(f"File {file_name} was already in progress.")
@@ -242,27 +255,16 @@ async def process_data_file(file_name, integration, process_config):
     transmissions = {}
     data_points_per_device = {}
     observations_processed = 0
-    integration_id = str(integration.id)
-
-    logger.info(f"Downloading data file {file_name} from cloud storage...")
-    local_data_file_path = f"/tmp/{file_name}"
-    await file_storage.download_file(
-        integration_id=integration_id,
-        source_blob_name=file_name,
-        destination_file_path=local_data_file_path
-    )
-    logger.info(f"Data file {file_name} downloaded.")
 
     # Try to get the related transmissions file
     timestamp, integration_id, *_ = file_name.split("_")
     transmissions_file_name = f"{timestamp}_{integration_id}_transmissions.xml"
-    local_transmissions_file_path = f"/tmp/{transmissions_file_name}"
+    transmissions_xml_content = None
     try:
-        await file_storage.download_file(
+        transmissions_xml_content = (await file_storage.download_bytes(
             integration_id=integration_id,
-            source_blob_name=transmissions_file_name,
-            destination_file_path=local_transmissions_file_path
-        )
+            source_blob_name=transmissions_file_name
+        )).decode("utf-8")
     except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         msg = f"Error downloading transmissions file {transmissions_file_name}: {type(e)}: {e}."
         logger.warning(msg)
@@ -272,11 +274,11 @@ async def process_data_file(file_name, integration, process_config):
             title=msg,
             level=LogLevel.WARNING
         )
-    logger.info(f"Transmissions file {transmissions_file_name} downloaded.")
+    else:
+        logger.info(f"Transmissions file {transmissions_file_name} downloaded.")
 
     # Try to parse the transmissions file to get tz offsets
-    async with aiofiles.open(local_transmissions_file_path, "r") as f:
-        transmissions_xml_content = await f.read()
+    if transmissions_xml_content is not None:
         try:
             transmissions = ats_client.parse_transmissions_from_xml(xml=transmissions_xml_content)
         except Exception as e:
@@ -293,91 +295,126 @@ async def process_data_file(file_name, integration, process_config):
     gmt_offsets = extract_gmt_offsets(transmissions, integration.id)
     logger.info(f"-- Integration ID: {str(integration.id)}, GMT offsets: {gmt_offsets} --")
 
-    logger.info(f"Processing data points from file {file_name}...")
-    async with aiofiles.open(local_data_file_path, "r") as f:
-        data_points_xml_content = await f.read()
-        try:
-            data_points_per_device = ats_client.parse_data_points_from_xml(xml=data_points_xml_content)
-        except Exception as e:
-            msg = f"Error parsing '{file_name}': {e}. Integration ID: {integration_id}."
-            logger.exception(msg)
-            await log_action_activity(
-                integration_id=integration_id,
-                action_id="process_observations",
-                title=msg,
-                level=LogLevel.ERROR
-            )
-            raise e
+    logger.info(f"Downloading and processing data points from file {file_name}...")
+    try:  # Parse the data points into a columnar batch as the file is downloaded (and decompressed, if gzipped)
+        data_points = await ats_client.read_data_point_batch_from_chunks(
+            file_storage.iter_download(integration_id=integration_id, source_blob_name=file_name)
+        )
+        data_points_per_device, device_summaries = data_points.group_by_device()
+    except Exception as e:
+        msg = f"Error parsing '{file_name}': {e}. Integration ID: {integration_id}."
+        logger.exception(msg)
+        await log_action_activity(
+            integration_id=integration_id,
+            action_id="process_observations",
+            title=msg,
+            level=LogLevel.ERROR
+        )
+        raise e
 
     if not data_points_per_device:
         msg = f"No data points were extracted from '{file_name}'. Integration ID: {integration_id}."
         logger.warning(msg)
 
-    for serial_num, data_points in data_points_per_device.items():
-        logger.info(f"Processing data points for device {serial_num}, integration {integration_id}...")
-        transformed_data = await filter_and_transform(
-            serial_num,
-            data_points,
-            gmt_offsets.get(serial_num, 0),
-            str(integration.id),
-            "pull_observations"
-        )
+    # Batches of up to OBSERVATIONS_BATCH_SIZE are sent concurrently, up to OBSERVATIONS_MAX_CONCURRENT_BATCHES at a time
+    async with ObservationsSender(integration_id=integration.id) as sender:
+        for serial_num, data_points in data_points_per_device.items():
+            summary = device_summaries[serial_num]
+            logger.info(
+                f"Processing {summary.count} data points ({summary.first_fix} - {summary.last_fix}) "
+                f"for device {serial_num}, integration {integration_id}..."
+            )
+            transformed_data = await filter_and_transform(
+                serial_num,
+                data_points,
+                gmt_offsets.get(serial_num, 0),
+                str(integration.id),
+                "pull_observations"
+            )
 
-        if transformed_data:
-            # Send transformed data to Sensors API V2
-            def generate_batches(iterable, n=settings.OBSERVATIONS_BATCH_SIZE):
-                for i in range(0, len(iterable), n):
-                    yield iterable[i: i + n]
-
-            for i, batch in enumerate(generate_batches(transformed_data)):
-                logger.info(
-                    f'Sending observations batch #{i}: {len(batch)} observations. Device: {serial_num}'
-                )
-                await gundi_tools.send_observations_to_gundi(
-                    observations=batch,
-                    integration_id=integration.id
-                )
-                observations_processed += len(batch)
-        else:
-            message = f"No observations after transformation for device {serial_num}, integration {integration_id}."
-            logger.warning(message)
+            if transformed_data:
+                # Send transformed data to Sensors API V2, packed with other devices in full batches
+                await sender.add(transformed_data, device=serial_num)  # Waits while too many batches are in flight
+            else:
+                message = f"No observations after transformation for device {serial_num}, integration {integration_id}."
+                logger.warning(message)
+    observations_processed += sender.observations_sent
 
     # Set the file status as processed
-    await state_manager.group_move(
-        from_group=IN_PROGRESS_FILES,
-        to_group=PROCESSED_FILES,
-        values=[file_name]
-    )
-    # Update metadata to see it in the gcp console
-    await file_storage.update_file_metadata(
-        integration_id=integration_id,
-        blob_name=file_name,
-        metadata={"status": FileStatus.PROCESSED.value}
-    )
-    await file_storage.update_file_metadata(
+    moved, current_status = await file_state.set_status(
         integration_id=integration_id,
-        blob_name=transmissions_file_name,
-        metadata={"status": FileStatus.PROCESSED.value}
+        file_name=file_name,
+        status=FileStatus.PROCESSED,
+        expected_status=FileStatus.IN_PROGRESS,
+        lease_owner=lease_owner
     )
-    logger.info(f"Data file {file_name} processed.")
-    await file_storage.delete_file(integration_id=integration_id, blob_name=file_name)
-    logger.info(f"Data file {file_name} deleted.")
-    await file_storage.delete_file(integration_id=integration_id, blob_name=transmissions_file_name)
-    logger.info(f"Transmissions file {file_name} deleted.")
+    if not moved:
+        current_status = current_status.value if current_status else "Not found"
+        logger.warning(
+            f"File {file_name} status was changed to '{current_status}' while it was being processed. "
+            f"Data file and transmissions file {transmissions_file_name} kept."
+        )
+        return observations_processed
+    # Update metadata to see it in the gcp console, then remove both files. Done concurrently, per file in order.
+    cleanup_operations = [
+        {"action": "update_metadata", "blob_name": file_name, "metadata": {"status": FileStatus.PROCESSED.value}},
+        {"action": "update_metadata", "blob_name": transmissions_file_name, "metadata": {"status": FileStatus.PROCESSED.value}},
+        {"action": "delete", "blob_name": file_name},
+        {"action": "delete", "blob_name": transmissions_file_name},
+    ]
+    cleanup_results = await file_storage.batch(integration_id=integration_id, operations=cleanup_operations)
+    cleanup_errors = [error for error in cleanup_results if error is not None]
+    for operation, error in zip(cleanup_operations, cleanup_results):
+        if error is not None:
+            logger.error(f"Error in '{operation['action']}' for file {operation['blob_name']}: {type(error).__name__}: {error}")
+    if cleanup_errors:
+        raise cleanup_errors[0]
+    logger.info(f"Data file {file_name} processed. Data file and transmissions file {transmissions_file_name} deleted.")
+    logger.debug(f"Storage connection pool stats: {file_storage.pool_stats()}")
     return observations_processed
 
 
+async def migrate_global_file_groups():
+    # Runs in the background on startup, and before processing files until the global groups are found empty.
+    # ToDo: Remove once every environment is migrated
+    try:
+        await file_state.migrate_global_groups()
+    except Exception as e:
+        logger.exception(f"Error migrating the global file groups: {type(e).__name__}: {e}")
+
+
 @crontab_schedule("5-55/10 * * * *")  # Run every 10 minutes, but 5 minutes after action_pull_observations
 @activity_logger()
 async def action_process_observations(integration, action_config: ProcessObservationsConfig):
     logger.info(f"Executing process_observations action with integration {integration} and action_config {action_config}...")
     observations_processed = 0
     integration_id = str(integration.id)
-    pending_files = await state_manager.group_get(PENDING_FILES)
-    pending_files_for_integration = [
-        file_name for file_name in pending_files if file_name.endswith(f"{integration_id}_data_points.xml")
-    ]
-    for file_name in pending_files_for_integration:
+    await migrate_global_file_groups()  # Picks up files added by replicas still on the previous version
+    # Recover files left in progress by runs that crashed or timed out
+    reclaimed_files, abandoned_files = await file_state.reclaim_expired_leases(integration_id=integration_id)
+    if reclaimed_files:
+        msg = f"{len(reclaimed_files)} files with an expired lease set back to pending for integration {integration_id}: {reclaimed_files}."
+        logger.warning(msg)
+        await log_action_activity(
+            integration_id=integration_id,
+            action_id="process_observations",
+            title=msg,
+            level=LogLevel.WARNING
+        )
+    if abandoned_files:  # Logged once, these files are no longer retried
+        msg = (
+            f"{len(abandoned_files)} files failed {file_state.max_attempts} times and are left in progress for integration "
+            f"{integration_id}: {abandoned_files}. Use set_file_status to set them back to pending once fixed."
+        )
+        logger.error(msg)
+        await log_action_activity(
+            integration_id=integration_id,
+            action_id="process_observations",
+            title=msg,
+            level=LogLevel.ERROR
+        )
+    pending_files = await file_state.get_files(integration_id=integration_id, status=FileStatus.PENDING)
+    for file_name in pending_files:  # Oldest first
         try:
             observations_processed += await process_data_file(
                 file_name=file_name,
@@ -394,17 +431,25 @@ async def action_process_observations(integration, action_config: ProcessObserva
                 level=LogLevel.ERROR
             )
             continue  # Keep processing as many files as possible
+    # Keep the processed files group bounded
+    files_trimmed = await file_state.trim_processed_files(integration_id=integration_id)
+    if files_trimmed:
+        logger.info(f"{files_trimmed} files trimmed from the processed files of integration '{integration_id}'.")
     logger.info(f"-- Observations processed with success for integration '{integration_id}'.")
-    return {'observations_processed': observations_processed}
+    return {'observations_processed': observations_processed, 'leases_reclaimed': len(reclaimed_files),
+            'files_abandoned': len(abandoned_files)}
 
 
 async def action_get_file_status(integration, action_config: GetFileStatusConfig):
     logger.info(f"Executing get_file_status action with integration {integration} and action_config {action_config}...")
 
+    integration_id = str(integration.id)
     file_name = action_config.filename
-    file_status = await get_file_status(file_name)
+    file_status = await file_state.get_status(integration_id=integration_id, file_name=file_name)
+    if not file_status and await file_state.was_processed(integration_id=integration_id, file_name=file_name):
+        file_status = FileStatus.PROCESSED  # Processed a while ago, and trimmed since
 
-    return {"file_status": file_status.get("status", "Not found")}
+    return {"file_status": file_status.value if file_status else "Not found"}
 
 
 async def action_set_file_status(integration, action_config: SetFileStatusConfig):
@@ -412,15 +457,16 @@ async def action_set_file_status(integration, action_config: SetFileStatusConfig
     integration_id = str(integration.id)
     file_name = action_config.filename
     file_status_to_move = action_config.status
-    group_to_move = get_file_group_by_status(file_status_to_move)
 
-    current_file_status = await get_file_status(file_name)
+    current_file_status = await file_state.get_status(integration_id=integration_id, file_name=file_name)
 
     if not current_file_status:
         # Add it to the list of pending files to be processed
-        await state_manager.group_add(
-            group_name=PENDING_FILES,
-            values=[file_name]
+        await file_state.set_status(
+            integration_id=integration_id,
+            file_name=file_name,
+            status=FileStatus.PENDING,
+            expected_status=None
         )
         await file_storage.update_file_metadata(
             integration_id=integration_id,
@@ -432,15 +478,22 @@ async def action_set_file_status(integration, action_config: SetFileStatusConfig
         return {"file_status": "Not found", "message": msg}
 
     try:
-        await state_manager.group_move(
-            from_group=current_file_status.get("group", None),
-            to_group=group_to_move,
-            values=[file_name]
+        # Only move it if the status wasn't changed meanwhile, e.g. by the file being processed
+        moved, current_file_status = await file_state.set_status(
+            integration_id=integration_id,
+            file_name=file_name,
+            status=file_status_to_move,
+            expected_status=current_file_status
         )
     except Exception as e:
-        msg = f"state_manager.group_move for file '{file_name}' failed. Error: {e}."
+        msg = f"file_state.set_status for file '{file_name}' failed. Error: {e}."
+        logger.warning(msg)
+        return {"file_status": current_file_status.value, "message": "Error setting file status"}
+    if not moved:
+        current_file_status = current_file_status.value if current_file_status else "Not found"
+        msg = f"File '{file_name}' status changed to '{current_file_status}' while setting it. Try again."
         logger.warning(msg)
-        return {"file_status": current_file_status.get("status"), "message": "Error setting file status"}
+        return {"file_status": current_file_status, "message": msg}
 
     try:
         await file_storage.update_file_metadata(
@@ -451,7 +504,7 @@ async def action_set_file_status(integration, action_config: SetFileStatusConfig
     except Exception as e:
         msg = f"file_storage.update_file_metadata for file '{file_name}' status failed. Error: {e}."
         logger.warning(msg)
-        return {"file_status": current_file_status.get("status"), "message": "Error setting file status"}
+        return {"file_status": current_file_status.value, "message": "Error setting file status"}
 
     msg = f"File status for '{file_name}' in integration '{integration_id}' set to '{file_status_to_move.value}'."
     logger.info(msg)
@@ -464,17 +517,19 @@ async def action_reprocess_file(integration, action_config: ReprocessFileConfig)
     file_name = action_config.filename
 
     # check current file status
-    file_status = await get_file_status(file_name)
+    file_status = await file_state.get_status(integration_id=integration_id, file_name=file_name)
+    if not file_status and await file_state.was_processed(integration_id=integration_id, file_name=file_name):
+        file_status = FileStatus.PROCESSED
 
     if not file_status:
         msg = f"File '{file_name}' not found. Skipping reprocessing."
         logger.warning(msg)
         return {"observations_processed": 0, "message": msg}
-    if file_status.get("status") == FileStatus.IN_PROGRESS.value:
+    if file_status == FileStatus.IN_PROGRESS:
         msg = f"File '{file_name}' processing is already in progress. Skipping reprocessing."
         logger.warning(msg)
         return {"observations_processed": 0, "message": msg}
-    if file_status.get("status") == FileStatus.PROCESSED.value:
+    if file_status == FileStatus.PROCESSED:
         msg = f"File '{file_name}' was already processed and deleted. Please contact Gundi team to restore it."
         logger.warning(msg)
         return {"observations_processed": 0, "message": msg}
@@ -0,0 +1,141 @@
+import asyncio
+import json
+import logging
+import time
+from collections import Counter
+import app.services.gundi as gundi_tools
+from app import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class ObservationsSender:
+    """
+    Sends observation batches to Gundi keeping up to `max_concurrent_batches` requests in flight.
+    add() packs observations from many devices into batches of up to `batch_size` observations
+    (and `max_batch_bytes` serialized bytes, if set). It waits while the window is full,
+    which applies backpressure to the code producing the observations.
+    Use it as an async context manager: on exit it sends the pending observations,
+    waits for the batches in flight and raises the first error, if any.
+    After a batch fails (once retries are exhausted) no more batches are sent.
+    """
+
+    def __init__(self, integration_id, max_concurrent_batches=None, batch_size=None, max_batch_bytes=None):
+        self.integration_id = integration_id
+        self.max_concurrent_batches = max_concurrent_batches or settings.OBSERVATIONS_MAX_CONCURRENT_BATCHES
+        self.batch_size = batch_size or settings.OBSERVATIONS_BATCH_SIZE
+        self.max_batch_bytes = max_batch_bytes if max_batch_bytes is not None else settings.OBSERVATIONS_BATCH_MAX_BYTES
+        self.observations_sent = 0
+        self.observations_sent_per_device = Counter()
+        self.batches_sent = 0
+        self.latencies = []
+        self._pending = []
+        self._pending_devices = Counter()
+        self._pending_bytes = 0
+        self._window = asyncio.Semaphore(self.max_concurrent_batches)
+        self._tasks = set()
+        self._batches_count = 0
+        self._error = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is not None and exc_value is not self._error:  # Don't leave requests running in the background
+                for task in self._tasks:
+                    task.cancel()
+            elif exc_type is None and self._error is None:
+                await self.flush()  # Raises if a batch fails while waiting for the window
+        finally:
+            await self.wait()
+        if exc_type is None:
+            self._log_stats()
+            self._raise_if_failed()
+
+    async def add(self, observations, device=None):
+        for observation in observations:
+            # Approximate size in the request body, including the separator
+            size = len(json.dumps(observation, default=str)) + 2 if self.max_batch_bytes else 0
+            if self._pending and (
+                len(self._pending) >= self.batch_size
+                or (self.max_batch_bytes and self._pending_bytes + size > self.max_batch_bytes)
+            ):
+                await self.flush()
+            self._pending.append(observation)
+            self._pending_devices[device] += 1
+            self._pending_bytes += size
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, devices = self._pending, self._pending_devices
+        self._pending, self._pending_devices, self._pending_bytes = [], Counter(), 0
+        await self._submit(batch, devices)
+
+    async def _submit(self, observations, devices):
+        self._raise_if_failed()
+        await self._window.acquire()
+        try:
+            self._raise_if_failed()  # A batch may have failed while waiting
+        except Exception:
+            self._window.release()
+            raise
+        batch_number = self._batches_count
+        self._batches_count += 1
+        task = asyncio.create_task(self._send_batch(batch_number, observations, devices))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def wait(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _send_batch(self, batch_number, observations, devices):
+        start_time = time.monotonic()
+        try:
+            await gundi_tools.send_observations_to_gundi(
+                observations=observations,
+                integration_id=self.integration_id
+            )
+        except Exception as e:
+            if self._error is None:
+                self._error = e
+            logger.error(
+                f"Error sending observations batch #{batch_number} ({len(observations)} observations) "
+                f"for integration {self.integration_id}. {self._describe_devices(devices)}. {type(e).__name__}: {e}"
+            )
+        else:
+            latency = time.monotonic() - start_time
+            self.latencies.append(latency)
+            self.batches_sent += 1
+            self.observations_sent += len(observations)
+            self.observations_sent_per_device.update(devices)
+            logger.info(
+                f"Observations batch #{batch_number} sent: {len(observations)} observations in {latency:.2f}s. "
+                f"{self._describe_devices(devices)}"
+            )
+        finally:
+            self._window.release()
+
+    @staticmethod
+    def _describe_devices(devices):
+        if len(devices) == 1:
+            return f"Device: {next(iter(devices))}"
+        return f"Devices: {len(devices)}"
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise self._error
+
+    def _log_stats(self):
+        if not self.latencies:
+            return
+        logger.info(
+            f"Sent {self.observations_sent} observations in {self.batches_sent} batches for integration "
+            f"{self.integration_id}. Batch latency avg: {sum(self.latencies) / len(self.latencies):.2f}s, "
+            f"max: {max(self.latencies):.2f}s (up to {self.max_concurrent_batches} batches in flight)."
+        )
+        for device, count in self.observations_sent_per_device.items():
+            logger.info(f"Sent {count} observations for device {device}, integration {self.integration_id}.")
@@ -5,7 +5,16 @@ import datetime
 import xmltodict
 from gundi_core.schemas.v2 import Integration, IntegrationSummary
 
-from app.actions.ats_client import TransmissionsResponse, DataResponse, ATSBadXMLException
+from app.actions import ats_client
+from app.services.file_storage import CloudFileStorage
+from app.actions.ats_client import (
+    TransmissionsResponse,
+    DataResponse,
+    ATSBadXMLException,
+    DataPointBatch,
+)
+from app.actions.configurations import FileStatus
+from .utils import InMemoryFileStateStore
 
 
 def async_return(result):
@@ -14,6 +23,26 @@ def async_return(result):
     return f
 
 
+async def async_iter_chunks(text, chunk_size=1024):
+    data = text.encode("utf-8")
+    for i in range(0, len(data), chunk_size):
+        yield data[i: i + chunk_size]
+
+
+async def consume_upload_stream(chunks, **kwargs):
+    async for _ in chunks:
+        pass
+    return {}
+
+
+@pytest.fixture(autouse=True)
+def clear_ats_sessions():
+    # Clients are bound to the event loop of the test that created them
+    ats_client._sessions.clear()
+    yield
+    ats_client._sessions.clear()
+
+
 @pytest.fixture
 def ats_integration_v2():
     return Integration.parse_obj(
@@ -85,28 +114,26 @@ def mock_data_file_name(mocker):
 
 
 @pytest.fixture
-def mock_state_manager(mocker, mock_transmissions_file_name, mock_data_file_name):
-    mock_state_manager = mocker.MagicMock()
-    mock_state_manager.get_state.return_value = async_return({})
-    mock_state_manager.set_state.return_value = async_return(None)
-    mock_state_manager.group_add.return_value = async_return(2)
-    mock_state_manager.group_get.return_value = async_return([
-        mock_transmissions_file_name,
-        mock_data_file_name,
-    ])
-    mock_state_manager.group_ismember.return_value = async_return(True)
-    mock_state_manager.group_move.return_value = async_return(1)
-    mock_state_manager.group_remove.return_value = async_return(1)
-    return mock_state_manager
+def mock_file_state(mock_data_file_name):
+    file_state = InMemoryFileStateStore()
+    file_state.statuses[mock_data_file_name] = FileStatus.PENDING
+    return file_state
 
 
 @pytest.fixture
-def mock_file_storage(mocker):
+def mock_file_storage(mocker, mock_ats_data_response_xml, mock_ats_transmissions_response_xml):
     mock_file_storage = mocker.MagicMock()
     mock_file_storage.upload_file.return_value = async_return(None)
+    mock_file_storage.upload_stream.side_effect = consume_upload_stream
+    mock_file_storage.iter_download.side_effect = lambda **kwargs: async_iter_chunks(mock_ats_data_response_xml)
+    mock_file_storage.download_bytes.side_effect = lambda **kwargs: async_return(
+        mock_ats_transmissions_response_xml.encode("utf-8")
+    )
     mock_file_storage.download_file.return_value = async_return(None)
     mock_file_storage.delete_file.return_value = async_return(None)
     mock_file_storage.update_file_metadata.return_value = async_return(None)
+    # Run the real batch logic on top of the mocked single-blob methods
+    mock_file_storage.batch.side_effect = lambda **kwargs: CloudFileStorage.batch(mock_file_storage, **kwargs)
     mock_file_storage.get_file_metadata.return_value = async_return({"status": "pending"})
     mock_file_storage.list_files.return_value = async_return([
         "20241206121217722379_1eb8ba40-6312-4093-9b47-7786320b11fb_transmissions.xml",
@@ -310,6 +337,13 @@ def mock_ats_data_parsed(mock_ats_data_response_xml):
     }
 
 
+@pytest.fixture
+def mock_ats_data_response_quoted_xml(mock_ats_data_response_xml):
+    # Same data points, but wrapped in quotes and with escaped characters
+    escaped_xml = mock_ats_data_response_xml.replace('"', '\\"').replace('/', '\\/')
+    return f'"{escaped_xml}"'
+
+
 @pytest.fixture
 def mock_ats_data_single_point_parsed(mock_ats_data_response_xml):
     return {
@@ -332,19 +366,6 @@ def mock_ats_data_single_point_parsed(mock_ats_data_response_xml):
     }
 
 
-@pytest.fixture
-def mock_aiofiles(
-        mocker,
-        mock_ats_transmissions_response_xml
-):
-    mock_client = mocker.MagicMock()
-    mock_fd = mocker.MagicMock()
-    mock_fd.__aenter__.return_value = mock_fd
-    mock_fd.read.return_value = async_return(mock_ats_transmissions_response_xml)
-    mock_client.open.return_value = mock_fd
-    return mock_client
-
-
 @pytest.fixture
 def mock_ats_client(
         mocker,
@@ -357,7 +378,14 @@ def mock_ats_client(
     ats_client_mock = mocker.MagicMock()
     ats_client_mock.get_data_endpoint_response.return_value = async_return(mock_ats_data_response_xml)
     ats_client_mock.get_transmissions_endpoint_response.return_value = async_return(mock_ats_transmissions_response_xml)
+    ats_client_mock.iter_data_endpoint_response.side_effect = lambda **kwargs: async_iter_chunks(mock_ats_data_response_xml)
+    ats_client_mock.iter_transmissions_endpoint_response.side_effect = lambda **kwargs: async_iter_chunks(
+        mock_ats_transmissions_response_xml
+    )
     ats_client_mock.parse_data_points_from_xml.return_value = mock_ats_data_parsed
+    ats_client_mock.read_data_point_batch_from_chunks.side_effect = lambda chunks: async_return(
+        DataPointBatch.from_data_points([point for points in mock_ats_data_parsed.values() for point in points])
+    )
     ats_client_mock.parse_transmissions_from_xml.return_value = mock_ats_transmissions_parsed
     return ats_client_mock
 
@@ -374,7 +402,14 @@ def mock_ats_client_with_invalid_tz_offsets(
     ats_client_mock = mocker.MagicMock()
     ats_client_mock.get_data_endpoint_response.return_value = async_return(mock_ats_data_response_xml)
     ats_client_mock.get_transmissions_endpoint_response.return_value = async_return(mock_ats_transmissions_response_with_invalid_offsets)
+    ats_client_mock.iter_data_endpoint_response.side_effect = lambda **kwargs: async_iter_chunks(mock_ats_data_response_xml)
+    ats_client_mock.iter_transmissions_endpoint_response.side_effect = lambda **kwargs: async_iter_chunks(
+        mock_ats_transmissions_response_with_invalid_offsets
+    )
     ats_client_mock.parse_data_points_from_xml.return_value = mock_ats_data_parsed
+    ats_client_mock.read_data_point_batch_from_chunks.side_effect = lambda chunks: async_return(
+        DataPointBatch.from_data_points([point for points in mock_ats_data_parsed.values() for point in points])
+    )
     ats_client_mock.parse_transmissions_from_xml.return_value = mock_ats_transmissions_with_invalid_offsets_parsed
     return ats_client_mock
 
@@ -391,9 +426,16 @@ def mock_ats_client_with_parse_error(
     ats_client_mock = mocker.MagicMock()
     ats_client_mock.get_data_endpoint_response.return_value = async_return(mock_ats_data_response_xml)
     ats_client_mock.get_transmissions_endpoint_response.return_value = async_return(mock_ats_transmissions_response_xml)
+    ats_client_mock.iter_data_endpoint_response.side_effect = lambda **kwargs: async_iter_chunks(mock_ats_data_response_xml)
+    ats_client_mock.iter_transmissions_endpoint_response.side_effect = lambda **kwargs: async_iter_chunks(
+        mock_ats_transmissions_response_xml
+    )
     ats_client_mock.parse_data_points_from_xml.side_effect = (
         ATSBadXMLException(message="Invalid XML.",  error=xmltodict.ParsingInterrupted()),
     )
+    ats_client_mock.read_data_point_batch_from_chunks.side_effect = ATSBadXMLException(
+        message="Invalid XML.", error=xmltodict.ParsingInterrupted()
+    )
     ats_client_mock.parse_transmissions_from_xml.return_value = mock_ats_transmissions_parsed
     return ats_client_mock
 
@@ -1,14 +1,27 @@
+import io
+import datetime
+
 import httpx
 import pytest
 import respx
 import xmltodict
 
+from app.actions import ats_client
 from app.actions.ats_client import (
+    close_sessions,
+    get_session,
     get_transmissions_endpoint_response,
     get_data_endpoint_response,
+    iter_data_endpoint_response,
+    group_data_points_by_device,
+    iter_data_points,
     parse_data_points_from_xml,
     parse_transmissions_from_xml,
     ATSBadXMLException,
+    DataPointBatch,
+    DataResponse,
+    read_data_point_batch,
+    read_data_point_batch_from_chunks,
 )
 from app.actions.configurations import PullObservationsConfig, AuthenticateConfig
 
@@ -38,6 +51,72 @@ async def test_get_transmissions_endpoint_response(ats_integration_v2, mock_ats_
         assert response == mock_ats_transmissions_response_xml
 
 
+
+@pytest.mark.asyncio
+async def test_ats_endpoints_reuse_one_client_per_host(
+        ats_integration_v2, mock_ats_transmissions_response_xml, mock_ats_data_response_xml
+):
+    async with respx.mock(assert_all_called=True) as ats_api_mock:
+        pull_config = PullObservationsConfig(
+            data_endpoint='http://test.ats.org/Service1.svc/GetPointsAtsIri/1',
+            transmissions_endpoint='http://test.ats.org/Service1.svc/GetAllTransmission/1'
+        )
+        auth_config = AuthenticateConfig(username='test', password='test')
+        ats_api_mock.get(pull_config.transmissions_endpoint).respond(
+            status_code=httpx.codes.OK, text=mock_ats_transmissions_response_xml
+        )
+        ats_api_mock.get(pull_config.data_endpoint).respond(
+            status_code=httpx.codes.OK, text=mock_ats_data_response_xml
+        )
+        for _ in range(2):
+            await get_transmissions_endpoint_response(
+                integration_id=str(ats_integration_v2.id), config=pull_config, auth=auth_config
+            )
+            await get_data_endpoint_response(
+                integration_id=str(ats_integration_v2.id), config=pull_config, auth=auth_config
+            )
+        assert list(ats_client._sessions) == ["http://test.ats.org"]
+        session = ats_client._sessions["http://test.ats.org"]
+        assert get_session("http://test.ats.org/other/path") is session
+        assert get_session("https://other.ats.org/path") is not session
+
+    await close_sessions()
+    assert session.is_closed
+    assert ats_client._sessions == {}
+
+
+
+@pytest.mark.asyncio
+async def test_iter_data_endpoint_response(ats_integration_v2, mock_ats_data_response_xml):
+    async with respx.mock(assert_all_called=True) as ats_api_mock:
+        pull_config = PullObservationsConfig(
+            data_endpoint='http://test.ats.org/Service1.svc/GetPointsAtsIri/1',
+            transmissions_endpoint='http://test.ats.org/Service1.svc/GetAllTransmission/1'
+        )
+        auth_config = AuthenticateConfig(username='test', password='test')
+        ats_api_mock.get(pull_config.data_endpoint).respond(
+            status_code=httpx.codes.OK, text=mock_ats_data_response_xml
+        )
+
+        chunks = [
+            chunk async for chunk in iter_data_endpoint_response(
+                integration_id=str(ats_integration_v2.id), config=pull_config, auth=auth_config, chunk_size=1024
+            )
+        ]
+
+    assert len(chunks) > 1
+    assert b"".join(chunks).decode("utf-8") == mock_ats_data_response_xml
+
+
+def test_session_falls_back_to_http1_without_h2(mocker):
+    mocker.patch("app.actions.ats_client.settings.ATS_HTTP2", True)
+    mocker.patch.dict("sys.modules", {"h2": None})  # Not installed
+
+    session = get_session("https://test.ats.org/Service1.svc/GetPointsAtsIri/1")
+
+    assert isinstance(session, httpx.AsyncClient)
+
+
 def test_parse_transmissions_from_xml(mock_ats_transmissions_response_xml, mock_ats_transmissions_parsed):
     result = parse_transmissions_from_xml(mock_ats_transmissions_response_xml)
     assert result == mock_ats_transmissions_parsed
@@ -139,3 +218,114 @@ def test_parse_data_points_from_xml_with_single_point(
 def test_parse_data_points_from_escaped_xml(mock_ats_data_response_escaped_xml):
     result = parse_data_points_from_xml(mock_ats_data_response_escaped_xml)
     assert result == {}
+
+
+def test_iter_data_points_from_file_path(mock_ats_data_parsed):
+    result = list(iter_data_points("app/actions/tests/files/ats_data_points.xml"))
+    assert result == [point for points in mock_ats_data_parsed.values() for point in points]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64 * 1024])
+def test_iter_data_points_from_byte_stream(mock_ats_data_response_xml, mock_ats_data_parsed, chunk_size):
+    source = io.BytesIO(mock_ats_data_response_xml.encode("utf-8"))
+    result = list(iter_data_points(source, chunk_size=chunk_size))
+    assert result == [point for points in mock_ats_data_parsed.values() for point in points]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64 * 1024])
+def test_iter_data_points_from_quoted_xml(mock_ats_data_response_quoted_xml, mock_ats_data_parsed, chunk_size):
+    source = io.BytesIO(mock_ats_data_response_quoted_xml.encode("utf-8"))
+    result = list(iter_data_points(source, chunk_size=chunk_size))
+    assert result == [point for points in mock_ats_data_parsed.values() for point in points]
+
+
+def test_iter_data_points_from_empty_xml():
+    assert list(iter_data_points("app/actions/tests/files/ats_no_data_points.xml")) == []
+
+
+def test_iter_data_points_raises_on_invalid_xml():
+    with pytest.raises(ATSBadXMLException):
+        list(iter_data_points("app/actions/tests/files/ats_data_points_invalid_xml.xml"))
+
+
+def test_iter_data_points_raises_on_missing_dataset_tag():
+    with pytest.raises(ATSBadXMLException):
+        list(iter_data_points(io.BytesIO(b"<NewDataSet><Table></Table></NewDataSet>")))
+
+
+def test_group_data_points_by_device_keeps_input_order(mock_ats_data_parsed):
+    data_points = [point for points in mock_ats_data_parsed.values() for point in points]
+    # Interleave devices to check the order within each device is kept
+    data_points = [data_points[1], data_points[2], data_points[0]]
+
+    points_per_device, summaries = group_data_points_by_device(iter(data_points))
+
+    assert list(points_per_device) == ["052194", "052191"]
+    assert points_per_device["052194"] == [data_points[0], data_points[2]]
+    assert points_per_device["052191"] == [data_points[1]]
+    assert summaries["052194"].count == 2
+    assert summaries["052194"].first_fix == datetime.datetime(2024, 5, 31, 0, 0)
+    assert summaries["052194"].last_fix == datetime.datetime(2024, 5, 31, 8, 0)
+    assert summaries["052191"].count == 1
+    assert summaries["052191"].first_fix == summaries["052191"].last_fix == datetime.datetime(2024, 10, 26, 16, 0)
+
+
+def test_group_data_points_by_device_with_no_data_points():
+    assert group_data_points_by_device([]) == ({}, {})
+
+
+def test_read_data_point_batch(mock_ats_data_parsed):
+    batch = read_data_point_batch("app/actions/tests/files/ats_data_points.xml")
+
+    data_points = [point for points in mock_ats_data_parsed.values() for point in points]
+    assert len(batch) == 3
+    assert batch.serial_nums == ["052194", "052191"]
+    assert list(batch.records()) == [point.dict() for point in data_points]
+
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("chunk_size", [1, 7, 64 * 1024])
+async def test_read_data_point_batch_from_chunks(mock_ats_data_parsed, chunk_size):
+    with open("app/actions/tests/files/ats_data_points.xml", "rb") as f:
+        data = f.read()
+
+    async def chunks():
+        for i in range(0, len(data), chunk_size):
+            yield data[i: i + chunk_size]
+
+    batch = await read_data_point_batch_from_chunks(chunks())
+
+    data_points = [point for points in mock_ats_data_parsed.values() for point in points]
+    assert list(batch.records()) == [point.dict() for point in data_points]
+
+
+def test_data_point_batch_keeps_missing_values():
+    data_point = DataResponse(
+        ats_serial_num="052194",
+        date_year_and_julian=datetime.datetime(2024, 5, 31, 0, 0),
+        mortality=True,
+    )
+
+    batch = DataPointBatch.from_data_points([data_point])
+
+    assert list(batch.records()) == [data_point.dict()]
+
+
+def test_data_point_batch_group_by_device(mock_ats_data_parsed):
+    data_points = [point for points in mock_ats_data_parsed.values() for point in points]
+    batch = DataPointBatch.from_data_points([data_points[1], data_points[2], data_points[0]])
+
+    batches_per_device, summaries = batch.group_by_device()
+
+    assert list(batches_per_device) == ["052194", "052191"]
+    assert list(batches_per_device["052194"].records()) == [data_points[1].dict(), data_points[0].dict()]
+    assert list(batches_per_device["052191"].records()) == [data_points[2].dict()]
+    assert summaries["052194"].count == 2
+    assert summaries["052194"].first_fix == datetime.datetime(2024, 5, 31, 0, 0)
+    assert summaries["052194"].last_fix == datetime.datetime(2024, 5, 31, 8, 0)
+    assert summaries["052191"].count == 1
+
+
+def test_data_point_batch_group_by_device_with_no_data_points():
+    assert DataPointBatch.from_data_points([]).group_by_device() == ({}, {})
@@ -0,0 +1,286 @@
+import asyncio
+
+import pytest
+from unittest import mock
+from unittest.mock import AsyncMock, MagicMock
+
+from app.actions.configurations import FileStatus
+from app.actions.file_state import (
+    FileStateStore,
+    file_timestamp,
+    PENDING_FILES,
+    IN_PROGRESS_FILES,
+    PROCESSED_FILES,
+    FILE_LEASES,
+    PROCESSED_FILES_SEEN,
+    processed_filter_bits,
+)
+
+
+@pytest.fixture
+def mock_redis_with_scripts(mocker, mock_redis):
+    scripts = {}
+
+    def register_script(script):
+        scripts[script] = AsyncMock()
+        return scripts[script]
+
+    mock_redis.StrictRedis.return_value.register_script.side_effect = register_script
+    mocker.patch("app.actions.file_state.redis", mock_redis)
+    mocker.patch("app.actions.file_state._global_groups_migrated", False)
+    return scripts
+
+
+def group_keys(integration_id):
+    return [f"{PENDING_FILES}.{integration_id}", f"{IN_PROGRESS_FILES}.{integration_id}", f"{PROCESSED_FILES}.{integration_id}"]
+
+
+NOW = 1733490000.0
+RETENTION_SECONDS = 30 * 24 * 3600
+
+
+def filter_key(integration_id, generations_ago=0):
+    return f"{PROCESSED_FILES_SEEN}.{integration_id}.{int(NOW // RETENTION_SECONDS) - generations_ago}"
+
+
+def set_status_keys(integration_id):
+    return [*group_keys(integration_id), f"{FILE_LEASES}.{integration_id}", filter_key(integration_id)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("position,expected_status", [
+    (1, FileStatus.PENDING),
+    (2, FileStatus.IN_PROGRESS),
+    (3, FileStatus.PROCESSED),
+    (0, None),
+])
+async def test_get_file_status(mock_redis_with_scripts, integration_v2, mock_data_file_name, position, expected_status):
+    file_state = FileStateStore()
+    file_state._get_status_script.return_value = position
+    integration_id = str(integration_v2.id)
+
+    status = await file_state.get_status(integration_id=integration_id, file_name=mock_data_file_name)
+
+    assert status == expected_status
+    # A single script call checks all the groups of the integration
+    file_state._get_status_script.assert_awaited_once_with(
+        keys=group_keys(integration_id), args=[mock_data_file_name]
+    )
+
+
+@pytest.fixture
+def now(mocker):
+    return mocker.patch("app.actions.file_state.time.time", return_value=NOW).return_value
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("expected_status,expected_arg", [
+    (FileStatus.PENDING, 1),
+    (None, 0),  # Not tracked
+])
+async def test_set_file_status_with_expected_status(
+        mock_redis_with_scripts, integration_v2, mock_data_file_name, now, expected_status, expected_arg
+):
+    file_state = FileStateStore()
+    file_state._set_status_script.return_value = [0, 2]
+    integration_id = str(integration_v2.id)
+
+    moved, previous_status = await file_state.set_status(
+        integration_id=integration_id,
+        file_name=mock_data_file_name,
+        status=FileStatus.IN_PROGRESS,
+        expected_status=expected_status
+    )
+
+    assert not moved
+    assert previous_status == FileStatus.IN_PROGRESS
+    file_state._set_status_script.assert_awaited_once_with(
+        keys=set_status_keys(integration_id),
+        args=[mock_data_file_name, 2, expected_arg, file_timestamp(mock_data_file_name), "", now + 600, 2 * RETENTION_SECONDS]
+    )
+
+
+@pytest.mark.asyncio
+async def test_set_file_status_regardless_of_current_status(
+        mock_redis_with_scripts, integration_v2, mock_data_file_name, now
+):
+    file_state = FileStateStore()
+    file_state._set_status_script.return_value = [1, 0]
+    integration_id = str(integration_v2.id)
+
+    moved, previous_status = await file_state.set_status(
+        integration_id=integration_id, file_name=mock_data_file_name, status=FileStatus.PENDING
+    )
+
+    assert moved
+    assert previous_status is None
+    file_state._set_status_script.assert_awaited_once_with(
+        keys=set_status_keys(integration_id),
+        args=[mock_data_file_name, 1, "", file_timestamp(mock_data_file_name), "", 0, 2 * RETENTION_SECONDS]
+    )
+
+
+@pytest.mark.asyncio
+async def test_set_file_in_progress_with_lease(mock_redis_with_scripts, integration_v2, mock_data_file_name, now):
+    file_state = FileStateStore(lease_seconds=60)
+    file_state._set_status_script.return_value = [1, 1]
+    integration_id = str(integration_v2.id)
+
+    moved, previous_status = await file_state.set_status(
+        integration_id=integration_id,
+        file_name=mock_data_file_name,
+        status=FileStatus.IN_PROGRESS,
+        expected_status=FileStatus.PENDING,
+        lease_owner="worker-1"
+    )
+
+    assert moved
+    assert previous_status == FileStatus.PENDING
+    file_state._set_status_script.assert_awaited_once_with(
+        keys=set_status_keys(integration_id),
+        args=[mock_data_file_name, 2, 1, file_timestamp(mock_data_file_name), "worker-1", now + 60, 2 * RETENTION_SECONDS]
+    )
+
+
+@pytest.mark.asyncio
+async def test_reclaim_expired_leases(mock_redis_with_scripts, integration_v2, mock_data_file_name, now):
+    file_state = FileStateStore(max_attempts=3)
+    abandoned_file_name = "20241206121217722379_a_data_points.xml"
+    file_state._reclaim_expired_leases_script.return_value = [[mock_data_file_name], [abandoned_file_name]]
+    integration_id = str(integration_v2.id)
+
+    reclaimed_files, abandoned_files = await file_state.reclaim_expired_leases(integration_id=integration_id)
+
+    assert reclaimed_files == [mock_data_file_name]
+    assert abandoned_files == [abandoned_file_name]
+    file_state._reclaim_expired_leases_script.assert_awaited_once_with(
+        keys=[f"{PENDING_FILES}.{integration_id}", f"{IN_PROGRESS_FILES}.{integration_id}", f"{FILE_LEASES}.{integration_id}"],
+        args=[now, 3]
+    )
+
+
+def test_file_timestamp(mock_data_file_name):
+    assert file_timestamp(mock_data_file_name) == 1733487137.722379  # 2024-12-06 12:12:17.722379 UTC
+    assert file_timestamp("20241206121217722379_a_data_points.xml") < file_timestamp("20241206121218000000_a_data_points.xml")
+
+
+@pytest.mark.asyncio
+async def test_get_files_reads_only_the_integration_group(mock_redis_with_scripts, mock_redis, integration_v2):
+    redis_client = mock_redis.StrictRedis.return_value
+    redis_client.zrange = AsyncMock(return_value=["file_1.xml", "file_2.xml"])
+    file_state = FileStateStore()
+    integration_id = str(integration_v2.id)
+
+    files = await file_state.get_files(integration_id=integration_id, status=FileStatus.PENDING, limit=10)
+
+    assert files == ["file_1.xml", "file_2.xml"]
+    redis_client.zrange.assert_awaited_once_with(f"{PENDING_FILES}.{integration_id}", 0, 9)
+
+
+@pytest.mark.asyncio
+async def test_migrate_global_groups(mock_redis_with_scripts, mock_redis, integration_v2, mock_data_file_name, now):
+    global_groups = {PENDING_FILES: [mock_data_file_name, "invalid.xml"], IN_PROGRESS_FILES: [], PROCESSED_FILES: []}
+
+    async def sscan_iter(group, count):
+        for file_name in global_groups[group]:
+            yield file_name
+
+    redis_client = mock_redis.StrictRedis.return_value
+    redis_client.sscan_iter = sscan_iter
+    redis_client.srem = MagicMock()
+    redis_client.execute = AsyncMock(side_effect=[[2, 0, 0], [[1, 0], 2], [0, 0, 0]])
+    file_state = FileStateStore()
+    integration_id = mock_data_file_name.split("_")[1]
+
+    assert await file_state.migrate_global_groups() == 1
+    assert await file_state.migrate_global_groups() == 0  # The global groups are empty now
+    assert await file_state.migrate_global_groups() == 0  # And they aren't checked anymore
+
+    # Files already tracked in the integration groups aren't overwritten
+    file_state._set_status_script.assert_awaited_once_with(
+        keys=set_status_keys(integration_id),
+        args=[mock_data_file_name, 1, 0, file_timestamp(mock_data_file_name), "", 0, 2 * RETENTION_SECONDS],
+        client=redis_client
+    )
+    # Moved in one round trip, along with the discarded files
+    redis_client.srem.assert_called_once_with(PENDING_FILES, mock_data_file_name, "invalid.xml")
+    assert redis_client.execute.await_count == 3
+
+
+@pytest.mark.asyncio
+async def test_migrate_global_groups_runs_once_at_a_time(mock_redis_with_scripts, mock_redis):
+    redis_client = mock_redis.StrictRedis.return_value
+    sizes_requested = asyncio.Event()
+    release = asyncio.Event()
+
+    async def execute():
+        sizes_requested.set()
+        await release.wait()
+        return [0, 0, 0]
+
+    redis_client.execute = AsyncMock(side_effect=execute)
+    file_state = FileStateStore()
+    migration = asyncio.create_task(file_state.migrate_global_groups())
+    await sizes_requested.wait()
+
+    # Other integrations don't wait for the migration in progress, nor repeat it
+    assert await file_state.migrate_global_groups() == 0
+    release.set()
+    assert await migration == 0
+    assert redis_client.execute.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_set_file_processed_adds_it_to_the_filter(
+        mock_redis_with_scripts, integration_v2, mock_data_file_name, now
+):
+    file_state = FileStateStore(processed_filter_size_bits=1024, processed_filter_hashes=3)
+    file_state._set_status_script.return_value = [1, 2]
+    integration_id = str(integration_v2.id)
+
+    await file_state.set_status(integration_id=integration_id, file_name=mock_data_file_name, status=FileStatus.PROCESSED)
+
+    bits = processed_filter_bits(mock_data_file_name, 1024, 3)
+    assert len(bits) == 3
+    assert all(0 <= bit < 1024 for bit in bits)
+    file_state._set_status_script.assert_awaited_once_with(
+        keys=set_status_keys(integration_id),
+        args=[mock_data_file_name, 3, "", file_timestamp(mock_data_file_name), "", 0, 2 * RETENTION_SECONDS, *bits]
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("bits_set,expected_result", [
+    ([1, 1, 1, 0, 0, 0], True),  # In the current generation
+    ([0, 0, 0, 1, 1, 1], True),  # In the previous generation
+    ([1, 0, 1, 0, 1, 1], False),
+    ([0, 0, 0, 0, 0, 0], False),
+])
+async def test_was_processed(
+        mock_redis_with_scripts, mock_redis, integration_v2, mock_data_file_name, now, bits_set, expected_result
+):
+    redis_client = mock_redis.StrictRedis.return_value
+    redis_client.execute = AsyncMock(return_value=bits_set)
+    file_state = FileStateStore(processed_filter_size_bits=1024, processed_filter_hashes=3)
+    integration_id = str(integration_v2.id)
+
+    assert await file_state.was_processed(integration_id=integration_id, file_name=mock_data_file_name) == expected_result
+    # The bits are read from the current and the previous generations of the filter in one round trip
+    assert redis_client.getbit.call_args_list == [
+        mock.call(filter_key(integration_id, generations_ago), bit)
+        for generations_ago in (0, 1)
+        for bit in processed_filter_bits(mock_data_file_name, 1024, 3)
+    ]
+    redis_client.execute.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_trim_processed_files(mock_redis_with_scripts, mock_redis, integration_v2, now):
+    redis_client = mock_redis.StrictRedis.return_value
+    redis_client.execute = AsyncMock(return_value=[3, 2])
+    file_state = FileStateStore(processed_retention_seconds=3600, processed_max_count=100)
+    integration_id = str(integration_v2.id)
+
+    assert await file_state.trim_processed_files(integration_id=integration_id) == 5
+    redis_client.zremrangebyscore.assert_called_once_with(f"{PROCESSED_FILES}.{integration_id}", "-inf", now - 3600)
+    redis_client.zremrangebyrank.assert_called_once_with(f"{PROCESSED_FILES}.{integration_id}", 0, -101)
@@ -1,81 +1,84 @@
-import asyncio
 import pytest
 from unittest.mock import AsyncMock
 from app.actions.handlers import (
     action_get_file_status,
     action_set_file_status,
     action_reprocess_file,
-    PENDING_FILES,
-    IN_PROGRESS_FILES,
-    PROCESSED_FILES
 )
 from app.actions.configurations import FileStatus, GetFileStatusConfig, SetFileStatusConfig, ReprocessFileConfig
+from .utils import InMemoryFileStateStore
+
+
+@pytest.fixture
+def file_state():
+    file_state = InMemoryFileStateStore()
+    file_state.statuses["test_file.xml"] = FileStatus.PENDING
+    return file_state
+
 
 @pytest.mark.asyncio
-async def test_action_get_file_status(mocker, integration_v2, mock_state_manager):
-    mocker.patch("app.actions.handlers.state_manager", mock_state_manager)
+async def test_action_get_file_status(mocker, integration_v2, file_state):
+    mocker.patch("app.actions.handlers.file_state", file_state)
     action_config = GetFileStatusConfig(filename="test_file.xml")
 
     result = await action_get_file_status(integration_v2, action_config)
 
-    mock_state_manager.group_ismember.assert_any_call(PENDING_FILES, "test_file.xml")
     assert result == {"file_status": FileStatus.PENDING.value}
 
 
 @pytest.mark.asyncio
-async def test_action_get_file_status_not_found(mocker, integration_v2, mock_state_manager):
-    mocker.patch("app.actions.handlers.state_manager", mock_state_manager)
-
-    future = asyncio.Future()
-    future.set_result(False)
-    mock_state_manager.group_ismember.return_value = future
+async def test_action_get_file_status_not_found(mocker, integration_v2, file_state):
+    mocker.patch("app.actions.handlers.file_state", file_state)
 
     action_config = GetFileStatusConfig(filename="non_existent_file.xml")
 
     result = await action_get_file_status(integration_v2, action_config)
 
-    mock_state_manager.group_ismember.assert_any_call(PENDING_FILES, "non_existent_file.xml")
-    mock_state_manager.group_ismember.assert_any_call(IN_PROGRESS_FILES, "non_existent_file.xml")
-    mock_state_manager.group_ismember.assert_any_call(PROCESSED_FILES, "non_existent_file.xml")
     assert result == {"file_status": "Not found"}
 
 
 @pytest.mark.asyncio
-async def test_action_set_file_status(mocker, integration_v2, mock_state_manager, mock_file_storage):
-    mocker.patch("app.actions.handlers.state_manager", mock_state_manager)
+async def test_action_get_file_status_trimmed_after_processing(mocker, integration_v2, file_state):
+    mocker.patch("app.actions.handlers.file_state", file_state)
+    integration_id = str(integration_v2.id)
+    file_name = f"20241206121217722379_{integration_id}_data_points.xml"
+    file_state.processed_max_count = 0
+    await file_state.set_status(integration_id, file_name, FileStatus.PROCESSED)
+    assert await file_state.trim_processed_files(integration_id) == 1
+    action_config = GetFileStatusConfig(filename=file_name)
+
+    result = await action_get_file_status(integration_v2, action_config)
+
+    assert file_name not in file_state.statuses
+    assert result == {"file_status": FileStatus.PROCESSED.value}
+
+
+@pytest.mark.asyncio
+async def test_action_set_file_status(mocker, integration_v2, file_state, mock_file_storage):
+    mocker.patch("app.actions.handlers.file_state", file_state)
     mocker.patch("app.actions.handlers.file_storage", mock_file_storage)
     action_config = SetFileStatusConfig(filename="test_file.xml", status=FileStatus.IN_PROGRESS)
 
     result = await action_set_file_status(integration_v2, action_config)
 
-    mock_state_manager.group_move.assert_any_call(
-        from_group="ats_pending_files",
-        to_group="ats_in_progress_files",
-        values=[action_config.filename]
+    assert file_state.statuses["test_file.xml"] == FileStatus.IN_PROGRESS
+    mock_file_storage.update_file_metadata.assert_called_once_with(
+        integration_id=str(integration_v2.id),
+        blob_name=action_config.filename,
+        metadata={"status": FileStatus.IN_PROGRESS.value}
     )
     assert result == {"file_status": action_config.status.value, 'message': f"File status for '{action_config.filename}' in integration '{str(integration_v2.id)}' set to '{action_config.status.value}'."}
 
 
 @pytest.mark.asyncio
-async def test_action_set_file_status_not_found_set_file_to_pending(mocker, integration_v2, mock_state_manager, mock_file_storage):
-    mocker.patch("app.actions.handlers.state_manager", mock_state_manager)
-
-    future = asyncio.Future()
-    future.set_result(False)
-    mock_state_manager.group_ismember.return_value = future
-
+async def test_action_set_file_status_not_found_set_file_to_pending(mocker, integration_v2, file_state, mock_file_storage):
+    mocker.patch("app.actions.handlers.file_state", file_state)
     mocker.patch("app.actions.handlers.file_storage", mock_file_storage)
     action_config = SetFileStatusConfig(filename="non_existent_file.xml", status=FileStatus.IN_PROGRESS)
 
     result = await action_set_file_status(integration_v2, action_config)
 
-    mock_state_manager.group_ismember.assert_any_call(PENDING_FILES, "non_existent_file.xml")
-    mock_state_manager.group_ismember.assert_any_call(IN_PROGRESS_FILES, "non_existent_file.xml")
-    mock_state_manager.group_ismember.assert_any_call(PROCESSED_FILES, "non_existent_file.xml")
-    mock_state_manager.group_add.assert_called_once_with(
-        group_name=PENDING_FILES,
-        values=[action_config.filename]
-    )
+    assert file_state.statuses["non_existent_file.xml"] == FileStatus.PENDING
     mock_file_storage.update_file_metadata.assert_called_once_with(
         integration_id=str(integration_v2.id),
         blob_name=action_config.filename,
@@ -85,10 +88,10 @@ async def test_action_set_file_status_not_found_set_file_to_pending(mocker, inte
 
 
 @pytest.mark.asyncio
-async def test_action_set_file_status_exception(mocker, integration_v2, mock_state_manager, mock_file_storage):
-    mocker.patch("app.actions.handlers.state_manager", mock_state_manager)
+async def test_action_set_file_status_exception(mocker, integration_v2, file_state, mock_file_storage):
+    mocker.patch("app.actions.handlers.file_state", file_state)
     mocker.patch("app.actions.handlers.file_storage", mock_file_storage)
-    mock_state_manager.group_move.side_effect = Exception("Test exception")
+    mocker.patch.object(file_state, "set_status", AsyncMock(side_effect=Exception("Test exception")))
 
     action_config = SetFileStatusConfig(filename="test_file.xml", status=FileStatus.IN_PROGRESS)
 
@@ -98,9 +101,31 @@ async def test_action_set_file_status_exception(mocker, integration_v2, mock_sta
 
 
 @pytest.mark.asyncio
-async def test_action_reprocess_file(mocker, integration_v2, mock_file_storage, mock_state_manager):
+async def test_action_set_file_status_changed_concurrently(mocker, integration_v2, file_state, mock_file_storage):
+    mocker.patch("app.actions.handlers.file_state", file_state)
+    mocker.patch("app.actions.handlers.file_storage", mock_file_storage)
+    get_status = file_state.get_status
+
+    async def get_status_and_start_processing(integration_id, file_name):
+        status = await get_status(integration_id, file_name)
+        file_state.statuses[file_name] = FileStatus.IN_PROGRESS  # Picked by process_observations meanwhile
+        return status
+
+    mocker.patch.object(file_state, "get_status", get_status_and_start_processing)
+    action_config = SetFileStatusConfig(filename="test_file.xml", status=FileStatus.PROCESSED)
+
+    result = await action_set_file_status(integration_v2, action_config)
+
+    # The status set by the processing isn't overwritten
+    assert file_state.statuses["test_file.xml"] == FileStatus.IN_PROGRESS
+    assert not mock_file_storage.update_file_metadata.called
+    assert result["file_status"] == FileStatus.IN_PROGRESS.value
+
+
+@pytest.mark.asyncio
+async def test_action_reprocess_file(mocker, integration_v2, mock_file_storage, file_state):
     mocker.patch("app.actions.handlers.file_storage", mock_file_storage)
-    mocker.patch("app.actions.handlers.state_manager", mock_state_manager)
+    mocker.patch("app.actions.handlers.file_state", file_state)
     mock_process_data_file = mocker.patch("app.actions.handlers.process_data_file", new_callable=AsyncMock, return_value=10)
     action_config = ReprocessFileConfig(filename="test_file.xml")
 
@@ -115,12 +140,10 @@ async def test_action_reprocess_file(mocker, integration_v2, mock_file_storage,
 
 
 @pytest.mark.asyncio
-async def test_action_reprocess_file_exception(mocker, integration_v2, mock_state_manager, mock_file_storage):
-    mocker.patch("app.actions.handlers.state_manager", mock_state_manager)
+async def test_action_reprocess_file_exception(mocker, integration_v2, file_state, mock_file_storage):
+    mocker.patch("app.actions.handlers.file_state", file_state)
     mocker.patch("app.actions.handlers.file_storage", mock_file_storage)
-    mock_state_manager.group_ismember.return_value = asyncio.Future()
-    mock_state_manager.group_ismember.return_value.set_result(True)
-    mock_state_manager.group_move.side_effect = Exception("Test exception")
+    mocker.patch.object(file_state, "set_status", AsyncMock(side_effect=Exception("Test exception")))
 
     action_config = ReprocessFileConfig(filename="test_file.xml")
 
@@ -0,0 +1,113 @@
+import datetime
+import json
+import random
+
+import pytest
+
+from app.actions.ats_client import DataPointBatch, DataResponse
+from app.actions.handlers import filter_and_transform
+from ...conftest import AsyncMock
+
+
+def legacy_filter_and_transform(vehicles, gmt_offset):
+    # Per-row transformation used before the columnar path, kept as reference for regression tests
+    transformed_data = []
+    main_data = ["ats_serial_num", "date_year_and_julian", "latitude", "longitude"]
+    if abs(gmt_offset) > 24:
+        gmt_offset = 0
+    for vehicle in vehicles:
+        time_delta = datetime.timedelta(hours=gmt_offset)
+        timezone_object = datetime.timezone(time_delta)
+        vehicle = vehicle.copy(update={
+            "date_year_and_julian": vehicle.date_year_and_julian.replace(tzinfo=timezone_object)
+        })
+        transformed_data.append({
+            "source": vehicle.ats_serial_num,
+            "source_name": vehicle.ats_serial_num,
+            'type': 'tracking-device',
+            "recorded_at": vehicle.date_year_and_julian,
+            "location": {
+                "lat": vehicle.latitude,
+                "lon": vehicle.longitude
+            },
+            "additional": {
+                key: value for key, value in vehicle.dict().items()
+                if key not in main_data and value is not None
+            }
+        })
+    return transformed_data
+
+
+def parse_recorded_at(observations):
+    return [{**o, "recorded_at": datetime.datetime.fromisoformat(o["recorded_at"])} for o in observations]
+
+
+def random_data_points(serial_num, count, seed=7):
+    rnd = random.Random(seed)
+    start = datetime.datetime(2024, 1, 1)
+    return [
+        DataResponse(
+            ats_serial_num=serial_num,
+            longitude=rnd.choice([None, round(rnd.uniform(-180, 180), 5)]),
+            latitude=rnd.choice([None, round(rnd.uniform(-90, 90), 5)]),
+            date_year_and_julian=start + datetime.timedelta(minutes=rnd.randint(0, 500000)),
+            num_sats=rnd.choice([None, f"{rnd.randint(0, 12):02d}"]),
+            hdop=rnd.choice([None, str(round(rnd.uniform(0.5, 5), 1))]),
+            fix_time=rnd.choice([None, "039"]),
+            dimension=rnd.choice([None, "2", "3"]),
+            activity=rnd.choice([None, "00", "02"]),
+            temperature=rnd.choice([None, "+24", "-03"]),
+            mortality=rnd.choice([None, True, False]),
+            low_batt_voltage=rnd.choice([None, True, False]),
+        )
+        for _ in range(count)
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("gmt_offset", [-12, -3, 0, 3, 14, 25])
+async def test_filter_and_transform_matches_per_row_transformation(mocker, gmt_offset):
+    mocker.patch("app.actions.handlers.log_action_activity", AsyncMock())
+    data_points = random_data_points("052194", 500)
+
+    result = await filter_and_transform(
+        "052194", DataPointBatch.from_data_points(data_points), gmt_offset, "integration-id", "pull_observations"
+    )
+
+    expected = legacy_filter_and_transform(data_points, gmt_offset)
+    assert parse_recorded_at(result) == expected
+    # Check timezones are identical too, not just equal instants
+    assert [o["recorded_at"].utcoffset() for o in parse_recorded_at(result)] == [
+        o["recorded_at"].utcoffset() for o in expected
+    ]
+    assert json.loads(json.dumps(result)) == result  # The payload is sent to Gundi as it is
+
+
+@pytest.mark.asyncio
+async def test_filter_and_transform_with_fixture_data_points(mock_ats_data_parsed):
+    data_points = mock_ats_data_parsed["052194"]
+
+    result = await filter_and_transform(
+        "052194", DataPointBatch.from_data_points(data_points), 3, "integration-id", "pull_observations"
+    )
+
+    assert parse_recorded_at(result) == legacy_filter_and_transform(data_points, 3)
+    assert result[0]["recorded_at"] == "2024-05-31T00:00:00+03:00"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("gmt_offset,expected_recorded_at", [
+    (5.5, ["2024-05-31T00:00:00.000000+05:30", "2024-05-31T00:00:01.250000+05:30"]),
+    (-3, ["2024-05-31T00:00:00.000000-03:00", "2024-05-31T00:00:01.250000-03:00"]),
+])
+async def test_filter_and_transform_keeps_fractional_offsets_and_seconds(gmt_offset, expected_recorded_at):
+    data_points = random_data_points("052194", 2)
+    data_points[0].date_year_and_julian = datetime.datetime(2024, 5, 31)
+    data_points[1].date_year_and_julian = datetime.datetime(2024, 5, 31, 0, 0, 1, 250000)
+
+    result = await filter_and_transform(
+        "052194", DataPointBatch.from_data_points(data_points), gmt_offset, "integration-id", "pull_observations"
+    )
+
+    assert [o["recorded_at"] for o in result] == expected_recorded_at
+    assert parse_recorded_at(result) == legacy_filter_and_transform(data_points, gmt_offset)
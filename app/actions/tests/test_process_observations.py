@@ -5,24 +5,23 @@ import pytest
 from gundi_core.schemas.v2 import LogLevel
 
 from app.services.action_runner import execute_action
-from .utils import InMemoryIntegrationStateManager
-from ..handlers import PENDING_FILES, PROCESSED_FILES, IN_PROGRESS_FILES
-from ...conftest import AsyncMock
+from .utils import InMemoryFileStateStore
+from ..configurations import FileStatus
+from ...conftest import AsyncMock, async_return
 
 
 @pytest.mark.asyncio
 async def test_execute_process_observations_action(
-        mocker, mock_gundi_client_v2, mock_state_manager, mock_file_storage, mock_ats_client,
+        mocker, mock_gundi_client_v2, mock_file_state, mock_file_storage, mock_ats_client,
         mock_get_gundi_api_key, mock_gundi_sensors_client_class, ats_integration_v2,
         mock_transmissions_file_name, mock_data_file_name, mock_publish_event,
-        mock_gundi_client_v2_class, mock_aiofiles, mock_config_manager_ats
+        mock_gundi_client_v2_class, mock_config_manager_ats
 ):
     mocker.patch("app.services.action_runner._portal", mock_gundi_client_v2)
     mocker.patch("app.services.activity_logger.publish_event", mock_publish_event)
     mocker.patch("app.services.action_runner.publish_event", mock_publish_event)
     mocker.patch("app.services.action_runner.config_manager", mock_config_manager_ats)
-    mocker.patch("app.actions.handlers.state_manager", mock_state_manager)
-    mocker.patch("app.actions.handlers.aiofiles", mock_aiofiles)
+    mocker.patch("app.actions.handlers.file_state", mock_file_state)
     mocker.patch("app.actions.handlers.file_storage", mock_file_storage)
     mocker.patch("app.actions.handlers.ats_client", mock_ats_client)
     mocker.patch("app.services.gundi.GundiClient", mock_gundi_client_v2_class)
@@ -38,26 +37,16 @@ async def test_execute_process_observations_action(
     assert response.get("observations_processed") == 3
 
     # Check that pending files were processed
-    mock_state_manager.group_get.assert_called_once_with(PENDING_FILES)
+    mock_file_storage.iter_download.assert_any_call(
+        integration_id=integration_id,
+        source_blob_name=mock_data_file_name
+    )
     assert mock_ats_client.parse_transmissions_from_xml.called
-    assert mock_ats_client.parse_data_points_from_xml.called
+    assert mock_ats_client.read_data_point_batch_from_chunks.called
     # Check that the observations were sent to gundi
     assert mock_gundi_sensors_client_class.return_value.post_observations.called
     # Check that the file status is updated
-    mock_state_manager.group_move.assert_has_calls(
-        [
-            mock.call(  # File must be set in progress first to be thread-safe
-                from_group=PENDING_FILES,
-                to_group=IN_PROGRESS_FILES,
-                values=[mock_data_file_name]
-            ),
-            mock.call(
-                from_group=IN_PROGRESS_FILES,
-                to_group=PROCESSED_FILES,
-                values=[mock_data_file_name]
-            )
-        ]
-    )
+    assert await mock_file_state.get_status(integration_id, mock_data_file_name) == FileStatus.PROCESSED
     # Check that processed files are removed from storage
     mock_file_storage.delete_file.assert_any_call(
         integration_id=integration_id,
@@ -71,17 +60,16 @@ async def test_execute_process_observations_action(
 
 @pytest.mark.asyncio
 async def test_execute_process_observations_action_with_invalid_tz_offset(
-        mocker, mock_gundi_client_v2, mock_state_manager, mock_file_storage, mock_ats_client_with_invalid_tz_offsets,
+        mocker, mock_gundi_client_v2, mock_file_state, mock_file_storage, mock_ats_client_with_invalid_tz_offsets,
         mock_get_gundi_api_key, mock_gundi_sensors_client_class, ats_integration_v2,
         mock_transmissions_file_name, mock_data_file_name, mock_publish_event,
-        mock_gundi_client_v2_class, mock_aiofiles, mock_config_manager_ats
+        mock_gundi_client_v2_class, mock_config_manager_ats
 ):
     mocker.patch("app.services.action_runner._portal", mock_gundi_client_v2)
     mocker.patch("app.services.activity_logger.publish_event", mock_publish_event)
     mocker.patch("app.services.action_runner.publish_event", mock_publish_event)
     mocker.patch("app.services.action_runner.config_manager", mock_config_manager_ats)
-    mocker.patch("app.actions.handlers.state_manager", mock_state_manager)
-    mocker.patch("app.actions.handlers.aiofiles", mock_aiofiles)
+    mocker.patch("app.actions.handlers.file_state", mock_file_state)
     mocker.patch("app.actions.handlers.file_storage", mock_file_storage)
     mocker.patch("app.actions.handlers.ats_client", mock_ats_client_with_invalid_tz_offsets)
     mocker.patch("app.services.gundi.GundiClient", mock_gundi_client_v2_class)
@@ -97,17 +85,12 @@ async def test_execute_process_observations_action_with_invalid_tz_offset(
     # All the observations are processed, even with invalid offsets
     assert response.get("observations_processed") == 3
     # Check that pending files were processed
-    mock_state_manager.group_get.assert_called_once_with(PENDING_FILES)
     assert mock_ats_client_with_invalid_tz_offsets.parse_transmissions_from_xml.called
-    assert mock_ats_client_with_invalid_tz_offsets.parse_data_points_from_xml.called
+    assert mock_ats_client_with_invalid_tz_offsets.read_data_point_batch_from_chunks.called
     # Check that the observations were sent to gundi
     assert mock_gundi_sensors_client_class.return_value.post_observations.called
     # Check that the data file is marked as processed
-    mock_state_manager.group_move.assert_any_call(
-        from_group=IN_PROGRESS_FILES,
-        to_group=PROCESSED_FILES,
-        values=[mock_data_file_name]
-    )
+    assert await mock_file_state.get_status(integration_id, mock_data_file_name) == FileStatus.PROCESSED
     # Check that processed files are removed from storage
     mock_file_storage.delete_file.assert_any_call(
         integration_id=integration_id,
@@ -121,17 +104,16 @@ async def test_execute_process_observations_action_with_invalid_tz_offset(
 
 @pytest.mark.asyncio
 async def test_process_observations_action_logs_error_on_data_parsing_error(
-        mocker, mock_gundi_client_v2, mock_state_manager, mock_file_storage, mock_ats_client_with_parse_error,
+        mocker, mock_gundi_client_v2, mock_file_state, mock_file_storage, mock_ats_client_with_parse_error,
         mock_get_gundi_api_key, mock_gundi_sensors_client_class, ats_integration_v2,
         mock_transmissions_file_name, mock_data_file_name, mock_publish_event,
-        mock_gundi_client_v2_class, mock_aiofiles, mock_config_manager_ats
+        mock_gundi_client_v2_class, mock_config_manager_ats
 ):
     mocker.patch("app.services.action_runner._portal", mock_gundi_client_v2)
     mocker.patch("app.services.activity_logger.publish_event", mock_publish_event)
     mocker.patch("app.services.action_runner.publish_event", mock_publish_event)
     mocker.patch("app.services.action_runner.config_manager", mock_config_manager_ats)
-    mocker.patch("app.actions.handlers.state_manager", mock_state_manager)
-    mocker.patch("app.actions.handlers.aiofiles", mock_aiofiles)
+    mocker.patch("app.actions.handlers.file_state", mock_file_state)
     mocker.patch("app.actions.handlers.file_storage", mock_file_storage)
     mocker.patch("app.actions.handlers.ats_client", mock_ats_client_with_parse_error)
     mock_log_activity = AsyncMock()
@@ -154,20 +136,57 @@ async def test_process_observations_action_logs_error_on_data_parsing_error(
     )
 
 
+@pytest.mark.asyncio
+async def test_process_observations_action_logs_error_on_file_cleanup_error(
+        mocker, mock_gundi_client_v2, mock_file_state, mock_file_storage, mock_ats_client,
+        mock_get_gundi_api_key, mock_gundi_sensors_client_class, ats_integration_v2,
+        mock_transmissions_file_name, mock_data_file_name, mock_publish_event,
+        mock_gundi_client_v2_class, mock_config_manager_ats
+):
+    mocker.patch("app.services.action_runner._portal", mock_gundi_client_v2)
+    mocker.patch("app.services.activity_logger.publish_event", mock_publish_event)
+    mocker.patch("app.services.action_runner.publish_event", mock_publish_event)
+    mocker.patch("app.services.action_runner.config_manager", mock_config_manager_ats)
+    mocker.patch("app.actions.handlers.file_state", mock_file_state)
+    mock_file_storage.delete_file.side_effect = [asyncio.TimeoutError(), async_return(None)]
+    mocker.patch("app.actions.handlers.file_storage", mock_file_storage)
+    mocker.patch("app.actions.handlers.ats_client", mock_ats_client)
+    mock_log_activity = AsyncMock()
+    mocker.patch("app.actions.handlers.log_action_activity", mock_log_activity)
+    mocker.patch("app.services.gundi.GundiClient", mock_gundi_client_v2_class)
+    mocker.patch("app.services.gundi.GundiDataSenderClient", mock_gundi_sensors_client_class)
+    mocker.patch("app.services.gundi._get_gundi_api_key", mock_get_gundi_api_key)
+    integration_id = str(ats_integration_v2.id)
+
+    await execute_action(
+        integration_id=integration_id,
+        action_id="process_observations"
+    )
+
+    # A failed deletion doesn't prevent the rest of the cleanup
+    assert mock_file_storage.update_file_metadata.call_count == 2
+    assert mock_file_storage.delete_file.call_count == 2
+    mock_log_activity.assert_any_call(
+        integration_id=integration_id,
+        action_id="process_observations",
+        title=mock.ANY,
+        level=LogLevel.ERROR
+    )
+
+
 @pytest.mark.asyncio
 async def test_process_observations_action_is_thread_safe(
         mocker, mock_gundi_client_v2, mock_file_storage, mock_ats_client,
         mock_get_gundi_api_key, mock_gundi_sensors_client_class, ats_integration_v2,
         mock_transmissions_file_name, mock_data_file_name, mock_publish_event,
-        mock_gundi_client_v2_class, mock_aiofiles, mock_config_manager_ats
+        mock_gundi_client_v2_class, mock_config_manager_ats
 ):
     mocker.patch("app.services.action_runner._portal", mock_gundi_client_v2)
     mocker.patch("app.services.activity_logger.publish_event", mock_publish_event)
     mocker.patch("app.services.action_runner.publish_event", mock_publish_event)
     mocker.patch("app.services.action_runner.config_manager", mock_config_manager_ats)
-    in_memory_state_manager = InMemoryIntegrationStateManager()
-    mocker.patch("app.actions.handlers.state_manager", in_memory_state_manager)
-    mocker.patch("app.actions.handlers.aiofiles", mock_aiofiles)
+    in_memory_file_state = InMemoryFileStateStore()
+    mocker.patch("app.actions.handlers.file_state", in_memory_file_state)
     mocker.patch("app.actions.handlers.file_storage", mock_file_storage)
     mocker.patch("app.actions.handlers.ats_client", mock_ats_client)
     mocker.patch("app.services.gundi.GundiClient", mock_gundi_client_v2_class)
@@ -176,7 +195,7 @@ async def test_process_observations_action_is_thread_safe(
     integration_id = str(ats_integration_v2.id)
 
     # Try to process the same file multiple times concurrently
-    await in_memory_state_manager.group_add(PENDING_FILES, [mock_data_file_name])
+    await in_memory_file_state.set_status(integration_id, mock_data_file_name, FileStatus.PENDING)
     concurrent_tasks = [
         execute_action(integration_id=integration_id, action_id="process_observations")
         for _ in range(5)
@@ -185,5 +204,121 @@ async def test_process_observations_action_is_thread_safe(
     # Check the file was processed only once
     assert sum([r.get("observations_processed") for r in results]) == 3
     # Check that the file status is updated
-    assert await in_memory_state_manager.group_get(IN_PROGRESS_FILES) == set()
-    assert await in_memory_state_manager.group_get(PROCESSED_FILES) == {mock_data_file_name}
+    assert await in_memory_file_state.get_files(integration_id, FileStatus.IN_PROGRESS) == []
+    assert await in_memory_file_state.get_files(integration_id, FileStatus.PROCESSED) == [mock_data_file_name]
+
+
+@pytest.mark.asyncio
+async def test_process_observations_action_reclaims_files_with_expired_lease(
+        mocker, mock_gundi_client_v2, mock_file_storage, mock_ats_client,
+        mock_get_gundi_api_key, mock_gundi_sensors_client_class, ats_integration_v2,
+        mock_data_file_name, mock_publish_event, mock_gundi_client_v2_class, mock_config_manager_ats
+):
+    mocker.patch("app.services.action_runner._portal", mock_gundi_client_v2)
+    mocker.patch("app.services.activity_logger.publish_event", mock_publish_event)
+    mocker.patch("app.services.action_runner.publish_event", mock_publish_event)
+    mocker.patch("app.services.action_runner.config_manager", mock_config_manager_ats)
+    file_state = InMemoryFileStateStore(lease_seconds=0)
+    mocker.patch("app.actions.handlers.file_state", file_state)
+    mocker.patch("app.actions.handlers.file_storage", mock_file_storage)
+    mocker.patch("app.actions.handlers.ats_client", mock_ats_client)
+    mock_log_activity = AsyncMock()
+    mocker.patch("app.actions.handlers.log_action_activity", mock_log_activity)
+    mocker.patch("app.services.gundi.GundiClient", mock_gundi_client_v2_class)
+    mocker.patch("app.services.gundi.GundiDataSenderClient", mock_gundi_sensors_client_class)
+    mocker.patch("app.services.gundi._get_gundi_api_key", mock_get_gundi_api_key)
+    integration_id = str(ats_integration_v2.id)
+    # A previous run crashed after setting the file in progress
+    await file_state.set_status(integration_id, mock_data_file_name, FileStatus.IN_PROGRESS, lease_owner="crashed-run")
+
+    response = await execute_action(
+        integration_id=integration_id,
+        action_id="process_observations"
+    )
+
+    assert response.get("leases_reclaimed") == 1
+    assert response.get("observations_processed") == 3
+    assert file_state.statuses[mock_data_file_name] == FileStatus.PROCESSED
+    mock_log_activity.assert_any_call(
+        integration_id=integration_id,
+        action_id="process_observations",
+        title=mock.ANY,
+        level=LogLevel.WARNING
+    )
+
+
+@pytest.mark.asyncio
+async def test_process_observations_action_stops_retrying_files_after_max_attempts(
+        mocker, mock_gundi_client_v2, mock_file_storage, mock_ats_client_with_parse_error,
+        ats_integration_v2, mock_data_file_name, mock_publish_event, mock_config_manager_ats
+):
+    mocker.patch("app.services.action_runner._portal", mock_gundi_client_v2)
+    mocker.patch("app.services.activity_logger.publish_event", mock_publish_event)
+    mocker.patch("app.services.action_runner.publish_event", mock_publish_event)
+    mocker.patch("app.services.action_runner.config_manager", mock_config_manager_ats)
+    file_state = InMemoryFileStateStore(lease_seconds=0, max_attempts=2)
+    mocker.patch("app.actions.handlers.file_state", file_state)
+    mocker.patch("app.actions.handlers.file_storage", mock_file_storage)
+    mocker.patch("app.actions.handlers.ats_client", mock_ats_client_with_parse_error)
+    mock_log_activity = AsyncMock()
+    mocker.patch("app.actions.handlers.log_action_activity", mock_log_activity)
+    integration_id = str(ats_integration_v2.id)
+    await file_state.set_status(integration_id, mock_data_file_name, FileStatus.PENDING)
+
+    responses = [
+        await execute_action(integration_id=integration_id, action_id="process_observations")
+        for _ in range(4)
+    ]
+
+    # The file is processed twice, then left in progress and reported only once
+    assert [r.get("leases_reclaimed") for r in responses] == [0, 1, 0, 0]
+    assert [r.get("files_abandoned") for r in responses] == [0, 0, 1, 0]
+    assert mock_ats_client_with_parse_error.read_data_point_batch_from_chunks.call_count == 2
+    assert file_state.statuses[mock_data_file_name] == FileStatus.IN_PROGRESS
+    abandoned_file_logs = [
+        call for call in mock_log_activity.call_args_list
+        if call.kwargs["level"] == LogLevel.ERROR and "left in progress" in call.kwargs["title"]
+    ]
+    assert len(abandoned_file_logs) == 1
+    # The file can be retried once its status is set back to pending
+    await file_state.set_status(integration_id, mock_data_file_name, FileStatus.PENDING)
+    response = await execute_action(integration_id=integration_id, action_id="process_observations")
+    assert response.get("files_abandoned") == 0
+    assert mock_ats_client_with_parse_error.read_data_point_batch_from_chunks.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_process_observations_action_keeps_files_when_status_changed_while_processing(
+        mocker, mock_gundi_client_v2, mock_file_storage, mock_ats_client,
+        mock_get_gundi_api_key, mock_gundi_sensors_client_class, ats_integration_v2,
+        mock_data_file_name, mock_publish_event, mock_gundi_client_v2_class, mock_config_manager_ats
+):
+    mocker.patch("app.services.action_runner._portal", mock_gundi_client_v2)
+    mocker.patch("app.services.activity_logger.publish_event", mock_publish_event)
+    mocker.patch("app.services.action_runner.publish_event", mock_publish_event)
+    mocker.patch("app.services.action_runner.config_manager", mock_config_manager_ats)
+    file_state = InMemoryFileStateStore()
+    set_status = file_state.set_status
+
+    async def set_status_reclaimed_while_processing(integration_id, file_name, status, **kwargs):
+        if status == FileStatus.PROCESSED:  # The lease expired and another run set the file back to pending
+            await set_status(integration_id, file_name, FileStatus.PENDING)
+        return await set_status(integration_id, file_name, status, **kwargs)
+
+    mocker.patch.object(file_state, "set_status", set_status_reclaimed_while_processing)
+    mocker.patch("app.actions.handlers.file_state", file_state)
+    mocker.patch("app.actions.handlers.file_storage", mock_file_storage)
+    mocker.patch("app.actions.handlers.ats_client", mock_ats_client)
+    mocker.patch("app.services.gundi.GundiClient", mock_gundi_client_v2_class)
+    mocker.patch("app.services.gundi.GundiDataSenderClient", mock_gundi_sensors_client_class)
+    mocker.patch("app.services.gundi._get_gundi_api_key", mock_get_gundi_api_key)
+    integration_id = str(ats_integration_v2.id)
+    await set_status(integration_id, mock_data_file_name, FileStatus.PENDING)
+
+    response = await execute_action(integration_id=integration_id, action_id="process_observations")
+
+    # The observations were sent, but the files are kept for the run that owns the file now
+    assert response.get("observations_processed") == 3
+    assert file_state.statuses[mock_data_file_name] == FileStatus.PENDING
+    mock_file_storage.update_file_metadata.assert_not_called()
+    mock_file_storage.delete_file.assert_not_called()
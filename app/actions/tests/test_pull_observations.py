@@ -1,11 +1,13 @@
+import httpx
 import pytest
 from app.services.action_runner import execute_action
-from app.actions.handlers import PENDING_FILES
+from app.actions.configurations import FileStatus
+from .utils import InMemoryFileStateStore
 
 
 @pytest.mark.asyncio
 async def test_execute_pull_observations_action(
-        mocker, mock_gundi_client_v2, mock_state_manager, mock_file_storage, mock_ats_client,
+        mocker, mock_gundi_client_v2, mock_file_storage, mock_ats_client,
         mock_get_gundi_api_key, mock_gundi_sensors_client_class, ats_integration_v2,
         mock_ats_data_parsed, mock_publish_event, mock_gundi_client_v2_class, mock_config_manager_ats
 ):
@@ -13,7 +15,8 @@ async def test_execute_pull_observations_action(
     mocker.patch("app.services.activity_logger.publish_event", mock_publish_event)
     mocker.patch("app.services.action_runner.publish_event", mock_publish_event)
     mocker.patch("app.services.action_runner.config_manager", mock_config_manager_ats)
-    mocker.patch("app.actions.handlers.state_manager", mock_state_manager)
+    file_state = InMemoryFileStateStore()
+    mocker.patch("app.actions.handlers.file_state", file_state)
     mocker.patch("app.actions.handlers.file_storage", mock_file_storage)
     mocker.patch("app.actions.handlers.ats_client", mock_ats_client)
     mocker.patch("app.services.gundi.GundiClient", mock_gundi_client_v2_class)
@@ -28,13 +31,56 @@ async def test_execute_pull_observations_action(
     assert "data_points_file" in response
     assert "transmissions_file" in response
     # Check that the data is extracted from ATS
-    assert mock_ats_client.get_transmissions_endpoint_response.called
-    assert mock_ats_client.get_data_endpoint_response.called
-    # Check that the data is saved as xml files in the cloud
-    assert mock_file_storage.upload_file.call_count == 2
+    assert mock_ats_client.iter_transmissions_endpoint_response.called
+    assert mock_ats_client.iter_data_endpoint_response.called
+    # Check that the data is streamed into xml files in the cloud
+    assert mock_file_storage.upload_stream.call_count == 2
     assert not mock_gundi_sensors_client_class.return_value.post_observations.called  # No data sent to Gundi
     # Check that the data file is marked as pending for processing
-    mock_state_manager.group_add.assert_called_once_with(
-        group_name=PENDING_FILES,
-        values=[response["data_points_file"]]
+    assert file_state.statuses == {response["data_points_file"]: FileStatus.PENDING}
+    # Timings are reported per phase
+    assert set(response["timings"]) == {"transmissions", "data_points", "total"}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("failing_endpoint", ["iter_data_endpoint_response", "iter_transmissions_endpoint_response"])
+async def test_pull_observations_cleans_up_when_a_retrieval_fails(
+        mocker, mock_gundi_client_v2, mock_file_storage, mock_ats_client,
+        ats_integration_v2, mock_publish_event, mock_config_manager_ats, failing_endpoint
+):
+    mocker.patch("app.services.action_runner._portal", mock_gundi_client_v2)
+    mocker.patch("app.services.activity_logger.publish_event", mock_publish_event)
+    mocker.patch("app.services.action_runner.publish_event", mock_publish_event)
+    mocker.patch("app.services.action_runner.config_manager", mock_config_manager_ats)
+    file_state = InMemoryFileStateStore()
+    mocker.patch("app.actions.handlers.file_state", file_state)
+    mocker.patch("app.actions.handlers.file_storage", mock_file_storage)
+    mocker.patch("app.actions.handlers.ats_client", mock_ats_client)
+
+    async def broken_stream(**kwargs):
+        yield b"<DataSet>"
+        raise httpx.ReadError("Connection reset", request=httpx.Request("GET", "http://ats-url.org/Service1.svc"))
+
+    getattr(mock_ats_client, failing_endpoint).side_effect = broken_stream
+
+    response = await execute_action(
+        integration_id=str(ats_integration_v2.id),
+        action_id="pull_observations"
+    )
+
+    assert response.status_code == 500
+    # Both endpoints are streamed concurrently
+    assert mock_ats_client.iter_transmissions_endpoint_response.called
+    assert mock_ats_client.iter_data_endpoint_response.called
+    # The file that was saved is deleted, and nothing is marked as pending
+    assert mock_file_storage.upload_stream.call_count == 2
+    uploaded_file = next(
+        call.kwargs["destination_blob_name"] for call in mock_file_storage.upload_stream.call_args_list
+        if not call.kwargs["destination_blob_name"].endswith(
+            "_data_points.xml" if failing_endpoint == "iter_data_endpoint_response" else "_transmissions.xml"
+        )
+    )
+    mock_file_storage.delete_file.assert_called_once_with(
+        integration_id=str(ats_integration_v2.id), blob_name=uploaded_file
     )
+    assert not file_state.statuses
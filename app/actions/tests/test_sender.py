@@ -0,0 +1,131 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from app.actions.sender import ObservationsSender
+
+
+def make_batches(count, size=2):
+    return [[{"source": f"device-{i}", "index": j} for j in range(size)] for i in range(count)]
+
+
+@pytest.mark.asyncio
+async def test_sender_keeps_up_to_max_concurrent_batches_in_flight(mocker):
+    in_flight = 0
+    max_in_flight = 0
+
+    async def send_observations(observations, integration_id):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return [{"object_id": "1"}] * len(observations)
+
+    mocker.patch("app.actions.sender.gundi_tools.send_observations_to_gundi", send_observations)
+
+    async with ObservationsSender(integration_id="integration-id", max_concurrent_batches=3, batch_size=2) as sender:
+        for batch in make_batches(10):
+            await sender.add(batch, device=batch[0]["source"])
+            assert in_flight <= 3  # Backpressure: add() waits while the window is full
+
+    assert max_in_flight == 3
+    assert sender.batches_sent == 10
+    assert sender.observations_sent == 20
+    assert len(sender.latencies) == 10
+
+
+@pytest.mark.asyncio
+async def test_sender_stops_on_first_permanent_failure(mocker):
+    sent_batches = []
+
+    async def send_observations(observations, integration_id):
+        await asyncio.sleep(0.01)
+        if observations[0]["source"] == "device-1":
+            raise httpx.ConnectError("Connection refused")
+        sent_batches.append(observations)
+        return [{"object_id": "1"}] * len(observations)
+
+    mocker.patch("app.actions.sender.gundi_tools.send_observations_to_gundi", send_observations)
+
+    sender = ObservationsSender(integration_id="integration-id", max_concurrent_batches=2, batch_size=2)
+    with pytest.raises(httpx.ConnectError):
+        async with sender:
+            for batch in make_batches(10):
+                await sender.add(batch)
+
+    # The batches in flight when the error happened are completed and counted, but no more are sent
+    assert len(sent_batches) < 9
+    assert sender.batches_sent == len(sent_batches)
+    assert sender.observations_sent == 2 * len(sent_batches)
+
+
+@pytest.mark.asyncio
+async def test_sender_waits_for_batches_in_flight_when_final_flush_fails(mocker):
+    async def send_observations(observations, integration_id):
+        if observations[0]["source"] == "device-0":
+            await asyncio.sleep(0.01)
+            raise httpx.ConnectError("Connection refused")
+        await asyncio.sleep(0.05)
+        return [{"object_id": "1"}] * len(observations)
+
+    mocker.patch("app.actions.sender.gundi_tools.send_observations_to_gundi", send_observations)
+
+    sender = ObservationsSender(integration_id="integration-id", max_concurrent_batches=2, batch_size=2)
+    with pytest.raises(httpx.ConnectError):
+        async with sender:
+            for batch in make_batches(3):  # The first batch fails while the final flush waits for the window
+                await sender.add(batch)
+
+    # The batch in flight was completed before the error was raised
+    assert not sender._tasks
+    assert sender.batches_sent == 1
+    assert sender.observations_sent == 2
+
+
+@pytest.mark.asyncio
+async def test_sender_packs_observations_from_many_devices_in_full_batches(mocker):
+    sent_batches = []
+
+    async def send_observations(observations, integration_id):
+        sent_batches.append(observations)
+        return [{"object_id": "1"}] * len(observations)
+
+    mocker.patch("app.actions.sender.gundi_tools.send_observations_to_gundi", send_observations)
+
+    # 300 devices with 3 fixes each
+    async with ObservationsSender(integration_id="integration-id", batch_size=200) as sender:
+        for batch in make_batches(300, size=3):
+            await sender.add(batch, device=batch[0]["source"])
+
+    assert [len(batch) for batch in sent_batches] == [200, 200, 200, 200, 100]
+    assert sender.batches_sent == 5
+    assert sender.observations_sent == 900
+    # Counts per device are still accurate
+    assert len(sender.observations_sent_per_device) == 300
+    assert set(sender.observations_sent_per_device.values()) == {3}
+    # Order is preserved
+    assert [o for batch in sent_batches for o in batch] == [o for batch in make_batches(300, size=3) for o in batch]
+
+
+@pytest.mark.asyncio
+async def test_sender_caps_batches_by_serialized_size(mocker):
+    sent_batches = []
+
+    async def send_observations(observations, integration_id):
+        sent_batches.append(observations)
+        return [{"object_id": "1"}] * len(observations)
+
+    mocker.patch("app.actions.sender.gundi_tools.send_observations_to_gundi", send_observations)
+    observations = [{"source": "device-1", "additional": {"payload": "x" * 100}} for _ in range(10)]
+    observation_size = len(json.dumps(observations[0])) + 2
+
+    async with ObservationsSender(
+        integration_id="integration-id", batch_size=200, max_batch_bytes=observation_size * 3
+    ) as sender:
+        await sender.add(observations, device="device-1")
+
+    assert [len(batch) for batch in sent_batches] == [3, 3, 3, 1]
+    assert sender.observations_sent_per_device == {"device-1": 10}
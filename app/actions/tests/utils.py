@@ -1,5 +1,9 @@
+import time
 from collections import defaultdict
 
+from app.actions.configurations import FileStatus
+from app.actions.file_state import ANY_STATUS
+
 
 class InMemoryIntegrationStateManager:
 
@@ -39,3 +43,77 @@ class InMemoryIntegrationStateManager:
 
     def __str__(self):
         return f"{self.__class__.__name__}({self.kvs}, {self.groups})"
+
+
+class InMemoryFileStateStore:
+
+    def __init__(self, **kwargs):
+        self.lease_seconds = kwargs.get("lease_seconds", 600)
+        self.statuses = {}  # file name -> FileStatus
+        self.max_attempts = kwargs.get("max_attempts", 3)
+        self.leases = {}  # file name -> (owner, expiry)
+        self.attempts = {}  # file name -> processing attempts
+        self.processed_max_count = kwargs.get("processed_max_count", 10000)
+        self.processed_seen = set()
+
+    async def get_status(self, integration_id: str, file_name: str):
+        return self.statuses.get(file_name)
+
+    async def set_status(self, integration_id: str, file_name: str, status, expected_status=ANY_STATUS,
+                         lease_owner: str = None):
+        previous_status = self.statuses.get(file_name)
+        if expected_status is not ANY_STATUS and expected_status != previous_status:
+            return False, previous_status
+        if previous_status == FileStatus.IN_PROGRESS and lease_owner and file_name in self.leases:
+            if self.leases[file_name][0] != lease_owner:
+                return False, previous_status
+        self.statuses[file_name] = status
+        self.leases.pop(file_name, None)
+        attempts = self.attempts.pop(file_name, 0)
+        if status == FileStatus.IN_PROGRESS:
+            self.leases[file_name] = (lease_owner or "", time.time() + self.lease_seconds)
+            self.attempts[file_name] = attempts + 1
+        if status == FileStatus.PROCESSED:
+            self.processed_seen.add(file_name)
+        return True, previous_status
+
+    async def trim_processed_files(self, integration_id: str):
+        processed_files = await self.get_files(integration_id, FileStatus.PROCESSED)
+        trimmed_files = processed_files[:max(len(processed_files) - self.processed_max_count, 0)]
+        for file_name in trimmed_files:
+            del self.statuses[file_name]
+        return len(trimmed_files)
+
+    async def was_processed(self, integration_id: str, file_name: str):
+        return file_name in self.processed_seen
+
+    async def reclaim_expired_leases(self, integration_id: str):
+        now = time.time()
+        expired_files = [
+            file_name for file_name, status in self.statuses.items()
+            if status == FileStatus.IN_PROGRESS and f"_{integration_id}_" in file_name
+            and self.leases.get(file_name, ("", 0))[1] <= now
+        ]
+        reclaimed_files, abandoned_files = [], []
+        for file_name in expired_files:
+            owner, _ = self.leases.pop(file_name, ("", 0))
+            if self.attempts.get(file_name, 0) >= self.max_attempts:
+                self.leases[file_name] = (owner, float("inf"))
+                abandoned_files.append(file_name)
+            else:
+                self.statuses[file_name] = FileStatus.PENDING
+                reclaimed_files.append(file_name)
+        return reclaimed_files, abandoned_files
+
+    async def get_files(self, integration_id: str, status, limit: int = None):
+        file_names = sorted(  # File names start with a timestamp
+            file_name for file_name, file_status in self.statuses.items()
+            if file_status == status and f"_{integration_id}_" in file_name
+        )
+        return file_names[:limit]
+
+    async def migrate_global_groups(self, batch_size: int = 500):
+        return 0
+
+    def __str__(self):
+        return f"{self.__class__.__name__}({self.statuses})"
@@ -1,11 +1,15 @@
 import asyncio
 import datetime
+import gzip
 import json
 
 import httpx
 import pydantic
 import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 from unittest.mock import MagicMock
+from redis.exceptions import RedisError
 from app import settings
 from gcloud.aio import pubsub
 from gundi_core.schemas.v2 import Integration, IntegrationSummary
@@ -55,6 +59,33 @@ def async_return(result):
     return f
 
 
+@pytest.fixture(autouse=True)
+def clear_sensors_api_clients_cache():
+    # Sender clients are cached per integration, don't leak them across tests
+    from app.services import gundi
+    gundi.clear_sensors_api_clients()
+    yield
+    gundi.clear_sensors_api_clients()
+
+
+@pytest.fixture(autouse=True)
+def clear_storage_session():
+    # The shared storage session is bound to the event loop of the test that created it
+    from app.services import file_storage
+    file_storage._storage_session = None
+    yield
+    file_storage._storage_session = None
+
+
+@pytest.fixture(autouse=True)
+def clear_config_cache():
+    # Parsed configurations are cached in-process across config manager instances
+    from app.services.config_manager import clear_config_cache
+    clear_config_cache()
+    yield
+    clear_config_cache()
+
+
 @pytest.fixture
 def mock_integration_state():
     return {"last_execution": "2024-01-29T11:20:00+0200"}
@@ -81,7 +112,10 @@ def mock_redis(mocker, mock_integration_state):
     redis_client.__aenter__.return_value = redis_client
     redis_client.__aexit__.return_value = None
     redis_client.pipeline.return_value = redis_client
+    redis_client.lock.return_value.acquire.return_value = async_return(True)
+    redis_client.lock.return_value.release.return_value = async_return(None)
     redis.Redis.return_value = redis_client
+    redis.RedisError = RedisError
     redis.StrictRedis.return_value = redis_client
     return redis
 
@@ -100,7 +134,10 @@ def mock_redis_empty(mocker, mock_integration_state):
     redis_client.__aenter__.return_value = redis_client
     redis_client.__aexit__.return_value = None
     redis_client.pipeline.return_value = redis_client
+    redis_client.lock.return_value.acquire.return_value = async_return(True)
+    redis_client.lock.return_value.release.return_value = async_return(None)
     redis.Redis.return_value = redis_client
+    redis.RedisError = RedisError
     return redis
 
 
@@ -119,7 +156,10 @@ def mock_redis_with_integration_config(mocker, integration_v2_as_json):
     redis_client.__aenter__.return_value = redis_client
     redis_client.__aexit__.return_value = None
     redis_client.pipeline.return_value = redis_client
+    redis_client.lock.return_value.acquire.return_value = async_return(True)
+    redis_client.lock.return_value.release.return_value = async_return(None)
     redis.Redis.return_value = redis_client
+    redis.RedisError = RedisError
     return redis
 
 
@@ -138,7 +178,10 @@ def mock_redis_with_action_config(mocker, pull_observations_config_as_json):
     redis_client.__aenter__.return_value = redis_client
     redis_client.__aexit__.return_value = None
     redis_client.pipeline.return_value = redis_client
+    redis_client.lock.return_value.acquire.return_value = async_return(True)
+    redis_client.lock.return_value.release.return_value = async_return(None)
     redis.Redis.return_value = redis_client
+    redis.RedisError = RedisError
     return redis
 
 @pytest.fixture
@@ -2084,6 +2127,129 @@ def mock_webhook_request_payload_for_fixed_schema():
     }
 
 
+class FakeGCSServer:
+    """
+    Minimal in-process GCS JSON API, for testing the streaming paths of CloudFileStorage end to end.
+    Use it as an async context manager, and pass Storage(api_root=server.url) to the file storage.
+    """
+
+    def __init__(self, max_persisted_per_chunk=None, failed_chunk_uploads=0):
+        self.objects = {}  # name -> (data, metadata)
+        self.uploads = {}  # session id -> (received data, metadata)
+        self.requests = []
+        # To test recovering from partial uploads: the bytes persisted per chunk (a multiple of 256 KiB),
+        # and how many chunk uploads fail with an error after the chunk was persisted
+        self.max_persisted_per_chunk = max_persisted_per_chunk
+        self.failed_chunk_uploads = failed_chunk_uploads
+        self._server = None
+
+    @property
+    def url(self):
+        return str(self._server.make_url("")).rstrip("/")
+
+    async def __aenter__(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/upload/storage/v1/b/{bucket}/o", self._initiate_upload)
+        app.router.add_put("/upload-sessions/{session_id}", self._upload_chunk)
+        app.router.add_get("/storage/v1/b/{bucket}/o", self._list_objects)
+        app.router.add_get("/storage/v1/b/{bucket}/o/{name}", self._get_object)
+        app.router.add_patch("/storage/v1/b/{bucket}/o/{name}", self._patch_object)
+        app.router.add_delete("/storage/v1/b/{bucket}/o/{name}", self._delete_object)
+        self._server = TestServer(app)
+        await self._server.start_server()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._server.close()
+
+    async def _initiate_upload(self, request):
+        self.requests.append(request)
+        upload_type = request.query["uploadType"]
+        if upload_type != "resumable":
+            return await self._upload(request, upload_type)
+        session_id = str(len(self.uploads))
+        self.uploads[session_id] = (bytearray(), await request.json())
+        return web.Response(headers={"Location": f"{self.url}/upload-sessions/{session_id}"})
+
+    async def _upload(self, request, upload_type):
+        if upload_type == "multipart":
+            reader = await request.multipart()
+            metadata = await (await reader.next()).json()
+            data = await (await reader.next()).read(decode=False)
+        else:
+            metadata = {"name": request.query["name"]}
+            data = await request.read()
+        if "contentEncoding" in request.query:
+            metadata["contentEncoding"] = request.query["contentEncoding"]
+        self.objects[metadata["name"]] = (bytes(data), metadata)
+        return web.json_response({**metadata, "size": str(len(data))})
+
+    async def _upload_chunk(self, request):
+        self.requests.append(request)
+        data, metadata = self.uploads[request.match_info["session_id"]]
+        if "Content-Range" not in request.headers:  # Single request upload
+            data += await request.read()
+            self.objects[metadata["name"]] = (bytes(data), metadata)
+            return web.json_response({**metadata, "size": str(len(data))})
+        byte_range, total = request.headers["Content-Range"].removeprefix("bytes ").split("/")
+        if metadata["name"] in self.objects and len(self.objects[metadata["name"]][0]) == len(data):  # Completed
+            return web.json_response({**metadata, "size": str(len(data))})
+        if byte_range != "*":
+            start, end = (int(position) for position in byte_range.split("-"))
+            assert start == len(data), "Chunks must be sent in order"
+            chunk = await request.read()
+            assert len(chunk) == end - start + 1
+            if self.max_persisted_per_chunk is not None and total == "*":
+                chunk = chunk[:self.max_persisted_per_chunk]
+            data += chunk
+            if self.failed_chunk_uploads > 0:
+                self.failed_chunk_uploads -= 1
+                return web.Response(status=503)
+        if total == "*" or len(data) < int(total):
+            return web.Response(status=308, headers={"Range": f"bytes=0-{len(data) - 1}"} if data else {})
+        assert len(data) == int(total)
+        self.objects[metadata["name"]] = (bytes(data), metadata)
+        return web.json_response({**metadata, "size": str(len(data))})
+
+    async def _list_objects(self, request):
+        self.requests.append(request)
+        names = sorted(name for name in self.objects if name.startswith(request.query.get("prefix", "")))
+        start = int(request.query.get("pageToken", 0))
+        end = start + int(request.query.get("maxResults", 1000))
+        page = {"items": [{**self.objects[name][1], "size": str(len(self.objects[name][0]))} for name in names[start:end]]}
+        if end < len(names):
+            page["nextPageToken"] = str(end)
+        return web.json_response(page)
+
+    async def _get_object(self, request):
+        self.requests.append(request)
+        if request.match_info["name"] not in self.objects:
+            return web.Response(status=404)
+        data, metadata = self.objects[request.match_info["name"]]
+        if request.query.get("alt") != "media":
+            return web.json_response({**metadata, "size": str(len(data))})
+        if metadata.get("contentEncoding") != "gzip":
+            return web.Response(body=data)
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            return web.Response(body=data, headers={"Content-Encoding": "gzip"})
+        return web.Response(body=gzip.decompress(data))  # Decompressive transcoding
+
+    async def _patch_object(self, request):
+        self.requests.append(request)
+        if request.match_info["name"] not in self.objects:
+            return web.Response(status=404)
+        data, metadata = self.objects[request.match_info["name"]]
+        metadata = {**metadata, **await request.json()}
+        self.objects[request.match_info["name"]] = data, metadata
+        return web.json_response({**metadata, "size": str(len(data))})
+
+    async def _delete_object(self, request):
+        self.requests.append(request)
+        if self.objects.pop(request.match_info["name"], None) is None:
+            return web.Response(status=404)
+        return web.Response(status=204)
+
+
 # ToDo. Move file storage support and these mocks into the template
 @pytest.fixture
 def gcp_bucket_list_response():
@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import json
 import logging
@@ -12,6 +13,12 @@ import app.settings as settings
 from fastapi.middleware.cors import CORSMiddleware
 
 from app.services.action_runner import execute_action, _portal
+from app.services.config_manager import get_config_cache_stats
+from app.services.gundi import clear_sensors_api_clients
+from app.actions.ats_client import close_sessions as close_ats_sessions
+from app.actions.handlers import migrate_global_file_groups
+from app.services.file_storage import close_storage_session
+from app.services.activity_logger import start_event_publisher, stop_event_publisher
 from app.services.self_registration import register_integration_in_gundi
 
 
@@ -25,9 +32,16 @@ async def lifespan(app: FastAPI):
     if settings.REGISTER_ON_START:
         await register_integration_in_gundi(gundi_client=_portal)
         # ToDo: set env var to false in GCP after registration
+    await start_event_publisher()
+    file_groups_migration = asyncio.create_task(migrate_global_file_groups())
     yield
     # Shotdown Hook
+    file_groups_migration.cancel()
+    await stop_event_publisher()  # Publishes pending events first
     await _portal.close()
+    clear_sensors_api_clients()
+    await close_ats_sessions()
+    await close_storage_session()
 
 
 app = FastAPI(
@@ -64,6 +78,16 @@ def read_root(
     return {"status": "healthy"}
 
 
+@app.get(
+    "/status/config-cache",
+    tags=["health-check"],
+    summary="Get the stats of the configuration cache",
+    description="Hits, misses and reloads of the configurations cached by this instance since it started, to measure how effective the cache is.",
+)
+def config_cache_status():
+    return get_config_cache_stats()
+
+
 @app.post(
     "/",
     summary="Execute an action from GCP PubSub",
@@ -81,6 +81,7 @@ async def execute_action(
         integration = await config_manager.get_integration_details(integration_id)
     except Exception as e:
         return await _handle_error(e, integration_id, action_id)
+    logger.debug(f"Configuration cache stats: {config_manager.cache_stats()}")
 
     # Find the action handler based on the action ID or data type
     if action_id:
@@ -31,6 +31,149 @@ from app import settings
 logger = logging.getLogger(__name__)
 
 
+def _build_pubsub_message(event: SystemEventBaseModel) -> pubsub.PubsubMessage:
+    binary_payload = json.dumps(event.dict(), default=str).encode("utf-8")
+    # Events of an integration are delivered in order to subscriptions with message ordering enabled
+    integration_id = getattr(event.payload, "integration_id", None)
+    return pubsub.PubsubMessage(binary_payload, ordering_key=str(integration_id) if integration_id else "")
+
+
+_STOP = object()  # Queued to wake up the publisher to stop
+
+
+class EventPublisher:
+    """
+    Publishes system events in the background, through a long-lived session, in batches of up to max_messages
+    or max_bytes, sent at most max_latency seconds after the first event of the batch was queued.
+    Events are published in the order they were queued.
+    """
+    def __init__(self, max_messages: int = 100, max_bytes: int = 1_000_000, max_latency: float = 0.5):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self._queue = None
+        self._task = None
+        self._session = None
+        self._client = None
+        self._next_item = None  # Taken from the queue but didn't fit in the previous batch
+        self._stopping = False
+
+    @property
+    def is_running(self):
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        if self.is_running:
+            return
+        self._queue = asyncio.Queue()
+        self._stopping = False
+        self._session = aiohttp.ClientSession(raise_for_status=True, timeout=aiohttp.ClientTimeout(total=20.0))
+        self._client = pubsub.PublisherClient(session=self._session)
+        self._task = asyncio.create_task(self._run())
+
+    async def publish(self, event: SystemEventBaseModel, topic_name: str):
+        message = _build_pubsub_message(event)
+        logger.debug(f"Queueing event {event} to be published to PubSub topic {topic_name}..")
+        self._queue.put_nowait((topic_name, message, len(message.data)))
+
+    async def stop(self, timeout: float = 30):
+        # Publishes the events pending in the queue before closing the session
+        if self.is_running:
+            # Pending events are published without waiting for batches to fill up
+            self._stopping = True
+            self._queue.put_nowait(_STOP)
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"Timed out publishing events on shutdown. {self._queue.qsize()} events were discarded.")
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self._next_item = None
+        self._stopping = False
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _get(self, timeout: float):
+        # Next queued item, or None if none is queued in time, or right away when stopping
+        try:
+            if self._stopping:
+                item = self._queue.get_nowait()
+            else:
+                item = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+        except (asyncio.QueueEmpty, asyncio.TimeoutError):
+            return None
+        if item is _STOP:
+            self._queue.task_done()
+            return None
+        return item
+
+    async def _next_batch(self):
+        item, self._next_item = self._next_item, None
+        while item is None:
+            item = await self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                item = None
+        batch, batch_bytes = [item], item[2]
+        deadline = asyncio.get_running_loop().time() + self.max_latency
+        while len(batch) < self.max_messages:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0 or (item := await self._get(timeout)) is None:
+                break
+            if batch_bytes + item[2] > self.max_bytes:
+                self._next_item = item
+                break
+            batch.append(item)
+            batch_bytes += item[2]
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._publish_batch(batch)
+            except Exception as e:
+                logger.exception(f"Error publishing {len(batch)} system events: {type(e).__name__}: {e}. Events discarded.")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _publish_batch(self, batch: list):
+        # Topics are published one after the other, to keep the order of events
+        messages_by_topic = {}
+        for topic_name, message, _ in batch:
+            messages_by_topic.setdefault(topic_name, []).append(message)
+        for topic_name, messages in messages_by_topic.items():
+            topic = self._client.topic_path(settings.GCP_PROJECT_ID, topic_name)
+            for attempt in stamina.retry_context(
+                    on=(aiohttp.ClientError, asyncio.TimeoutError), attempts=5, wait_initial=4.0, wait_max=60, wait_jitter=5.0
+            ):
+                with attempt:
+                    response = await self._client.publish(topic, messages)
+            logger.debug(f"{len(messages)} system events published to PubSub topic {topic_name}. Response: {response}")
+
+
+event_publisher = EventPublisher(
+    max_messages=settings.PUBSUB_BATCH_MAX_MESSAGES,
+    max_bytes=settings.PUBSUB_BATCH_MAX_BYTES,
+    max_latency=settings.PUBSUB_BATCH_MAX_LATENCY
+)
+
+
+async def start_event_publisher():
+    if settings.PUBSUB_BATCH_EVENTS:
+        await event_publisher.start()
+
+
+async def stop_event_publisher():
+    await event_publisher.stop(timeout=settings.PUBSUB_BATCH_DRAIN_TIMEOUT)
+
+
 # Publish events for other services or system components
 @stamina.retry(
     on=(aiohttp.ClientError, asyncio.TimeoutError),
@@ -40,6 +183,8 @@ logger = logging.getLogger(__name__)
     wait_jitter=5.0
 )
 async def publish_event(event: SystemEventBaseModel, topic_name: str):
+    if event_publisher.is_running:  # Published in the background, so there's no response to return
+        return await event_publisher.publish(event, topic_name)
     timeout_settings = aiohttp.ClientTimeout(total=20.0)
     async with aiohttp.ClientSession(
         raise_for_status=True, timeout=timeout_settings
@@ -48,8 +193,7 @@ async def publish_event(event: SystemEventBaseModel, topic_name: str):
         # Get the topic
         topic = client.topic_path(settings.GCP_PROJECT_ID, topic_name)
         # Prepare the payload
-        binary_payload = json.dumps(event.dict(), default=str).encode("utf-8")
-        messages = [pubsub.PubsubMessage(binary_payload)]
+        messages = [_build_pubsub_message(event)]
         logger.debug(f"Sending event {event} to PubSub topic {topic_name}..")
         try:  # Send to pubsub
             response = await client.publish(topic, messages)
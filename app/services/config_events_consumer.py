@@ -24,7 +24,7 @@ async def handle_integration_created_event(event: IntegrationCreated):
 
 async def handle_integration_updated_event(event: IntegrationUpdated):
     event_data = event.payload
-    integration = await config_manager.get_integration(integration_id=event_data.id)
+    integration = await config_manager.get_integration(integration_id=event_data.id, use_cache=False)
     for key, value in event_data.changes.items():
         if hasattr(integration, key):
             setattr(integration, key, value)
@@ -50,7 +50,8 @@ async def handle_action_config_updated_event(event: ActionConfigUpdated):
     action_id = event_data.alt_id
     action_config = await config_manager.get_action_configuration(
         integration_id=integration_id,
-        action_id=action_id
+        action_id=action_id,
+        use_cache=False
     )
     for key, value in event_data.changes.items():
         setattr(action_config, key, value)
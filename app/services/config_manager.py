@@ -1,10 +1,43 @@
+import asyncio
 import json
+import logging
 import stamina
 import httpx
 import redis.asyncio as redis
 from gundi_core.schemas.v2 import Integration, IntegrationSummary, IntegrationActionConfiguration
 from gundi_client_v2 import GundiClient
 from app import settings
+from .utils import TTLCache
+
+
+# Parsed configurations, shared by all the managers in the process so writes through any of them invalidate it.
+# Other instances of the service pick up changes when entries expire.
+_config_cache = TTLCache(max_size=settings.CONFIG_CACHE_MAX_SIZE, ttl=settings.CONFIG_CACHE_TTL)
+# Reloads from Gundi in progress in the process, by integration id
+_reloads_in_flight = {}
+_reload_counters = {
+    "reloads": 0,  # Reloads from Gundi
+    "reloads_coalesced": 0,  # Waited on a reload in progress in the process
+    "reloads_shared": 0,  # Got the result of a reload made by another replica
+}
+
+logger = logging.getLogger(__name__)
+
+
+def clear_config_cache():
+    _config_cache.clear()
+    for counter in _reload_counters:
+        _reload_counters[counter] = 0
+
+
+def get_config_cache_stats():
+    return {
+        "size": len(_config_cache),
+        "hits": _config_cache.hits,
+        "misses": _config_cache.misses,
+        "reloads_in_flight": len(_reloads_in_flight),
+        **_reload_counters,
+    }
 
 
 class IntegrationConfigurationManager:
@@ -22,75 +55,193 @@ class IntegrationConfigurationManager:
     def _get_integration_config_key(self, integration_id: str, action_id: str) -> str:
         return f"integrationconfig.{integration_id}.{action_id}"
 
+    def _get_reload_lock_key(self, integration_id: str) -> str:
+        return f"integration_reload_lock.{integration_id}"
+
+    def _get_reload_result_key(self, integration_id: str) -> str:
+        return f"integration_reload.{integration_id}"
+
+    @staticmethod
+    def cache_stats():
+        return get_config_cache_stats()
+
+    def invalidate_cache(self, integration_id: str, action_id: str = None):
+        # Drops the cached configurations of an integration, or only the ones of one action if action_id is set
+        integration_id = str(integration_id)
+        _config_cache.pop(("integration_details", integration_id))
+        if action_id:
+            _config_cache.pop(("action_config", integration_id, action_id))
+        else:
+            _config_cache.pop_matching(lambda key: key[1] == integration_id)
+
     async def _reload_integration_from_gundi(self, integration_id: str) -> Integration:
+        # Concurrent reloads of the same integration wait on the one in progress
+        integration_id = str(integration_id)
+        if reload := _reloads_in_flight.get(integration_id):
+            _reload_counters["reloads_coalesced"] += 1
+            return await asyncio.shield(reload)
+        reload = asyncio.ensure_future(self._reload_integration_from_gundi_locked(integration_id))
+        _reloads_in_flight[integration_id] = reload
+        reload.add_done_callback(lambda _: _reloads_in_flight.pop(integration_id, None))
+        # Shielded so the reload isn't cancelled for the callers waiting on it when the first one is
+        return await asyncio.shield(reload)
+
+    async def _reload_integration_from_gundi_locked(self, integration_id: str) -> Integration:
+        # Replicas wait on the one holding the lock, and take the result of its reload.
+        # If the lock can't be acquired in time, reload anyway rather than failing the action.
+        lock = self.db_client.lock(
+            self._get_reload_lock_key(integration_id),
+            timeout=settings.CONFIG_RELOAD_LOCK_TIMEOUT,
+            blocking_timeout=settings.CONFIG_RELOAD_LOCK_WAIT
+        )
+        waited = False
+        try:
+            if not (acquired := await lock.acquire(blocking=False)):
+                waited = True  # Another replica is reloading it
+                acquired = await lock.acquire()
+        except redis.RedisError as e:
+            logger.warning(f"Error acquiring the reload lock for integration {integration_id}: {type(e).__name__}: {e}")
+            acquired = False
+        if not acquired:
+            logger.warning(f"Reload lock for integration {integration_id} not acquired. Reloading from Gundi anyway.")
+        try:
+            result_key = self._get_reload_result_key(integration_id)
+            if acquired and waited and (integration_data := await self.db_client.get(result_key)):
+                _reload_counters["reloads_shared"] += 1
+                return Integration.parse_raw(integration_data)
+            return await self._fetch_integration_from_gundi(integration_id)
+        finally:
+            if acquired:
+                try:
+                    await lock.release()
+                except redis.RedisError as e:  # The lock expired, or redis is unavailable and it will
+                    logger.warning(f"Error releasing the reload lock for integration {integration_id}: {type(e).__name__}: {e}")
+
+    async def _fetch_integration_from_gundi(self, integration_id: str) -> Integration:
+        _reload_counters["reloads"] += 1
         key = self._get_integration_key(integration_id)
         async with GundiClient() as gundi:
             async for attempt in stamina.retry_context(on=httpx.HTTPError, wait_initial=1.0, wait_jitter=5.0,  wait_max=32.0):
                 with attempt:
                     integration_details = await gundi.get_integration_details(integration_id)
-            integration = IntegrationSummary.from_integration(integration_details)
-            await self.db_client.set(key, integration.json())
-            # Save configurations for individual actions
-            for config in integration_details.configurations:
-                config_key = self._get_integration_config_key(integration_id, config.action.value)
-                await self.db_client.set(config_key, config.json())
-            return integration_details
-
-    async def get_action_configuration(self, integration_id: str, action_id: str) -> IntegrationActionConfiguration:
+        integration = IntegrationSummary.from_integration(integration_details)
+        # Save the summary, configurations for individual actions, and the result shared with other replicas
+        # in one transaction, so readers never see a partially saved integration
+        ttl = settings.CONFIG_RELOAD_TTL
+        values = {key: (integration.json(), ttl)}
+        for config in integration_details.configurations:
+            config_key = self._get_integration_config_key(integration_id, config.action.value)
+            values[config_key] = (config.json(), ttl)
+        values[self._get_reload_result_key(integration_id)] = (
+            integration_details.json(), int(settings.CONFIG_RELOAD_LOCK_TIMEOUT)
+        )
+        for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30, wait_jitter=3.0):
+            with attempt:
+                async with self.db_client.pipeline(transaction=True) as pipeline:
+                    for value_key, (value, expiration) in values.items():
+                        pipeline.set(value_key, value, ex=expiration)
+                    await pipeline.execute()
+        return integration_details
+
+    async def get_action_configuration(
+            self, integration_id: str, action_id: str, use_cache: bool = True
+    ) -> IntegrationActionConfiguration:
+        # Returns a copy, that can be modified without affecting the cached one. Set use_cache to False to skip the cache.
+        cache_key = ("action_config", str(integration_id), action_id)
+        if use_cache and (config := _config_cache.get(cache_key)):
+            return config.copy(deep=True)
         key = self._get_integration_config_key(integration_id, action_id)
         for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30, wait_jitter=3.0):
             with attempt:
                 data = await self.db_client.get(key)
         if data:
-            return IntegrationActionConfiguration.parse_raw(data)
-        # If not found in the redis db, try reloading data from Gundi API
-        integration_details = await self._reload_integration_from_gundi(integration_id)
-        return integration_details.get_action_config(action_id)
+            config = IntegrationActionConfiguration.parse_raw(data)
+        else:
+            # If not found in the redis db, try reloading data from Gundi API
+            integration_details = await self._reload_integration_from_gundi(integration_id)
+            config = integration_details.get_action_config(action_id)
+        if use_cache and config:
+            _config_cache.set(cache_key, config.copy(deep=True))
+        return config
 
     async def set_action_configuration(self, integration_id: str, action_id: str, config: IntegrationActionConfiguration):
         key = self._get_integration_config_key(integration_id, action_id)
         for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30, wait_jitter=3.0):
             with attempt:
                 await self.db_client.set(key, config.json())
+        self.invalidate_cache(integration_id, action_id)
 
     async def delete_action_configuration(self, integration_id: str, action_id: str):
         key = self._get_integration_config_key(integration_id, action_id)
         for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30, wait_jitter=3.0):
             with attempt:
-                return await self.db_client.delete(key)
+                deleted = await self.db_client.delete(key)
+        self.invalidate_cache(integration_id, action_id)
+        return deleted
 
-    async def get_integration(self, integration_id: str) -> IntegrationSummary:
+    async def get_integration(self, integration_id: str, use_cache: bool = True) -> IntegrationSummary:
+        # Returns a copy, that can be modified without affecting the cached one. Set use_cache to False to skip the cache.
+        cache_key = ("integration", str(integration_id))
+        if use_cache and (integration := _config_cache.get(cache_key)):
+            return integration.copy(deep=True)
         key = self._get_integration_key(integration_id)
         for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30, wait_jitter=3.0):
             with attempt:
                 integration_data = await self.db_client.get(key)
         if integration_data:
             # Looks for configurations
-            return IntegrationSummary.parse_raw(integration_data)
-        # If not found in cache, reload from Gundi
-        integration_details = await self._reload_integration_from_gundi(integration_id)
-        return IntegrationSummary.from_integration(integration_details)
+            integration = IntegrationSummary.parse_raw(integration_data)
+        else:
+            # If not found in cache, reload from Gundi
+            integration_details = await self._reload_integration_from_gundi(integration_id)
+            integration = IntegrationSummary.from_integration(integration_details)
+        if use_cache:
+            _config_cache.set(cache_key, integration.copy(deep=True))
+        return integration
 
     async def set_integration(self, integration: IntegrationSummary):
         key = self._get_integration_key(integration.id)
         for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30, wait_jitter=3.0):
             with attempt:
                 await self.db_client.set(key, integration.json())
+        self.invalidate_cache(integration.id)
 
     async def delete_integration(self, integration_id: str):
         key = self._get_integration_key(integration_id)
         for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30, wait_jitter=3.0):
             with attempt:
                 await self.db_client.delete(key)
+        self.invalidate_cache(integration_id)
 
     async def get_integration_details(self, integration_id: str) -> Integration:
-        integration_summary = await self.get_integration(integration_id)
+        # Returns a copy, that can be modified without affecting the cached one
+        cache_key = ("integration_details", str(integration_id))
+        if integration := _config_cache.get(cache_key):
+            return integration.copy(deep=True)
+        integration_details = None  # Reloaded from Gundi at most once, when anything is missing in the redis db
+        summary_cache_key = ("integration", str(integration_id))
+        if not (integration_summary := _config_cache.get(summary_cache_key)):
+            key = self._get_integration_key(integration_id)
+            for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30, wait_jitter=3.0):
+                with attempt:
+                    integration_data = await self.db_client.get(key)
+            if integration_data:
+                integration_summary = IntegrationSummary.parse_raw(integration_data)
+            else:
+                integration_details = await self._reload_integration_from_gundi(integration_id)
+                integration_summary = IntegrationSummary.from_integration(integration_details)
+            _config_cache.set(summary_cache_key, integration_summary)
+        action_ids = [action.value for action in integration_summary.type.actions]
+        if integration_details:  # Configurations were reloaded along with the summary
+            configs_by_action = {action_id: integration_details.get_action_config(action_id) for action_id in action_ids}
+        else:
+            configs_by_action = await self._get_action_configurations(integration_id, action_ids)
         configurations = []
-        for action in integration_summary.type.actions:
-            config = await self.get_action_configuration(integration_id, action.value)
-            if config:
+        for action_id in action_ids:
+            if config := configs_by_action.get(action_id):
+                _config_cache.set(("action_config", str(integration_id), action_id), config)
                 configurations.append(config)
-        return Integration(
+        integration = Integration(
             id=integration_summary.id,
             name=integration_summary.name,
             type=integration_summary.type,
@@ -101,4 +252,34 @@ class IntegrationConfigurationManager:
             additional=integration_summary.additional,
             configurations=configurations,
             # ToDo: webhook_configuration
-        )
\ No newline at end of file
+        )
+        _config_cache.set(cache_key, integration)
+        return integration.copy(deep=True)
+
+    async def _get_action_configurations(self, integration_id: str, action_ids: list) -> dict:
+        # Gets the configurations of several actions as {action_id: config}, from the cache or in one redis round trip
+        configs_by_action = {}
+        missing_action_ids = []
+        for action_id in action_ids:
+            if config := _config_cache.get(("action_config", str(integration_id), action_id)):
+                configs_by_action[action_id] = config
+            else:
+                missing_action_ids.append(action_id)
+        if not missing_action_ids:
+            return configs_by_action
+        keys = [self._get_integration_config_key(integration_id, action_id) for action_id in missing_action_ids]
+        for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30, wait_jitter=3.0):
+            with attempt:
+                values = await self.db_client.mget(keys)
+        not_found_action_ids = []
+        for action_id, data in zip(missing_action_ids, values):
+            if data:
+                configs_by_action[action_id] = IntegrationActionConfiguration.parse_raw(data)
+            else:
+                not_found_action_ids.append(action_id)
+        if not_found_action_ids:
+            # A single reload from Gundi API covers every configuration not found in the redis db
+            integration_details = await self._reload_integration_from_gundi(integration_id)
+            for action_id in not_found_action_ids:
+                configs_by_action[action_id] = integration_details.get_action_config(action_id)
+        return configs_by_action
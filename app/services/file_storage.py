@@ -1,22 +1,134 @@
+import json
+import zlib
+from collections import defaultdict
+from urllib.parse import quote
 import aiohttp
 import stamina
 import asyncio
 from gcloud.aio.storage import Storage
 from app import settings
 
+
+RESUMABLE_UPLOAD_CHUNK_MULTIPLE = 256 * 1024  # GCS requires chunks (except the last one) to be multiples of 256 KiB
+
+
+# Shared by all the storage clients so the calls made for each file reuse warm connections
+_storage_session = None
+# in_use counts the requests that got a connection, until they get the response headers or fail
+_storage_pool_counters = {"connections_created": 0, "connections_reused": 0, "requests_queued": 0, "in_use": 0}
+
+
+def get_storage_session():
+    global _storage_session
+    if _storage_session is None or _storage_session.closed:
+        _storage_pool_counters.update(dict.fromkeys(_storage_pool_counters, 0))
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(_count_pool_event("connections_created"))
+        trace_config.on_connection_reuseconn.append(_count_pool_event("connections_reused"))
+        trace_config.on_connection_queued_start.append(_count_pool_event("requests_queued"))
+        trace_config.on_connection_create_end.append(_on_connection_acquired)
+        trace_config.on_connection_reuseconn.append(_on_connection_acquired)
+        trace_config.on_request_end.append(_on_request_done)
+        trace_config.on_request_exception.append(_on_request_done)
+        _storage_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=settings.GCP_STORAGE_MAX_CONNECTIONS,
+                limit_per_host=settings.GCP_STORAGE_MAX_CONNECTIONS_PER_HOST,
+                ttl_dns_cache=settings.GCP_STORAGE_DNS_CACHE_TTL,
+                keepalive_timeout=settings.GCP_STORAGE_KEEPALIVE_TIMEOUT
+            ),
+            trace_configs=[trace_config]
+        )
+    return _storage_session
+
+
+async def close_storage_session():
+    global _storage_session
+    if _storage_session is not None:
+        await _storage_session.close()
+        _storage_session = None
+
+
+def get_storage_pool_stats():
+    connector = _storage_session.connector if _storage_session is not None and not _storage_session.closed else None
+    return {
+        "open": connector is not None,
+        "limit": connector.limit if connector else settings.GCP_STORAGE_MAX_CONNECTIONS,
+        "limit_per_host": connector.limit_per_host if connector else settings.GCP_STORAGE_MAX_CONNECTIONS_PER_HOST,
+        **_storage_pool_counters
+    }
+
+
+def _count_pool_event(counter):
+    async def on_event(session, context, params):
+        _storage_pool_counters[counter] += 1
+    return on_event
+
+
+async def _on_connection_acquired(session, context, params):
+    # The context is per request, so requests failing before getting a connection aren't counted when done
+    context.holds_connection = True
+    _storage_pool_counters["in_use"] += 1
+
+
+async def _on_request_done(session, context, params):
+    if getattr(context, "holds_connection", False):
+        context.holds_connection = False
+        _storage_pool_counters["in_use"] -= 1
+
+
+class StorageRequests:
+    """
+    Raw requests to the GCS JSON API, for the resumable uploads and streamed downloads that gcloud-aio Storage
+    doesn't provide. They need parts of the Storage client that are private in gcloud-aio-storage, so they're all
+    read here when the client is created: an upgrade that changes them fails right away instead of mid-upload.
+    """
+
+    def __init__(self, storage_client):
+        self.storage_client = storage_client
+        try:
+            self.api_root_read = storage_client._api_root_read
+            self.api_root_write = storage_client._api_root_write
+            self._get_headers = storage_client._headers
+            self.session = storage_client.session  # Raises for error statuses
+            self.raw_session = storage_client.session.session  # The aiohttp session, returns any status
+        except AttributeError as e:
+            raise RuntimeError(f"Unsupported gcloud-aio-storage version, Storage has changed: {e}") from e
+
+    async def headers(self, **extra_headers):
+        headers = await self._get_headers()
+        headers.update(extra_headers)
+        return headers
+
+
 # ToDo. Move this to the template for other integrations needing file support
 class CloudFileStorage:
     def __init__(self, bucket_name=None, root_prefix=None):
         self.root_prefix = root_prefix or settings.GCP_BUCKET_ROOT_PREFIX
         self.bucket_name = bucket_name or settings.GCP_BUCKET_NAME
         self._storage_client = None  # Lazy initialization
+        self._storage_session = None
+        self._storage_requests = None
 
     @property
     def storage_client(self):
-        if self._storage_client is None:
-            self._storage_client = Storage()
+        if self._storage_client is None or self._storage_session is not None and self._storage_session.closed:
+            # Recreated when the shared session was closed, e.g. by the app shutting down between tests
+            self._storage_session = get_storage_session()
+            self._storage_client = Storage(session=self._storage_session)
         return self._storage_client
 
+    @property
+    def storage_requests(self):
+        storage_client = self.storage_client
+        if self._storage_requests is None or self._storage_requests.storage_client is not storage_client:
+            self._storage_requests = StorageRequests(storage_client)
+        return self._storage_requests
+
+    @staticmethod
+    def pool_stats():
+        return get_storage_pool_stats()
+
     def get_file_fullname(self, integration_id, blob_name):
         return f"{self.root_prefix}/{integration_id}/{blob_name}"
 
@@ -30,26 +142,255 @@ class CloudFileStorage:
                     self.bucket_name, target_path, local_file_path, metadata=custom_metadata
                 )
 
+    async def upload_bytes(self, integration_id, data, destination_blob_name, metadata=None,
+                           content_type="application/xml", zipped=False):
+        """
+        Upload data held in memory (bytes or str), without going through a local file.
+        If zipped is True, the data is gzip-compressed and stored with Content-Encoding: gzip.
+        """
+        target_path = self.get_file_fullname(integration_id, destination_blob_name)
+        custom_metadata = {"metadata": metadata} if metadata else None
+        for attempt in stamina.retry_context(on=(aiohttp.ClientError, asyncio.TimeoutError),
+                                             attempts=5, wait_initial=1.0, wait_max=30, wait_jitter=3.0):
+            with attempt:
+                return await self.storage_client.upload(
+                    self.bucket_name, target_path, data,
+                    content_type=content_type, metadata=custom_metadata, zipped=zipped
+                )
+
+    async def upload_stream(self, integration_id, chunks, destination_blob_name, metadata=None,
+                            content_type="application/xml", zipped=False):
+        """
+        Upload data from an async iterable of bytes (e.g. an HTTP response stream) using a resumable upload.
+        Only one chunk of GCP_UPLOAD_CHUNK_SIZE bytes is kept in memory at a time, and no local file is needed.
+        If zipped is True, the data is gzip-compressed on the fly and stored with Content-Encoding: gzip.
+        Each chunk is retried on its own, as the source stream can't be read again. The bytes of a chunk that GCS
+        didn't persist are kept and sent again with the next one.
+        """
+        target_path = self.get_file_fullname(integration_id, destination_blob_name)
+        chunk_size = max(
+            settings.GCP_UPLOAD_CHUNK_SIZE // RESUMABLE_UPLOAD_CHUNK_MULTIPLE, 1
+        ) * RESUMABLE_UPLOAD_CHUNK_MULTIPLE
+        object_metadata = {"name": target_path, "contentType": content_type}
+        if metadata:
+            object_metadata["metadata"] = {str(k): str(v) for k, v in metadata.items()}
+        if zipped:
+            object_metadata["contentEncoding"] = "gzip"
+        session_uri = await self._initiate_resumable_upload(object_metadata)
+        compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if zipped else None  # gzip container
+        buffer = bytearray()
+        offset = 0  # Position of the start of the buffer in the uploaded object
+        async for chunk in chunks:
+            buffer += compressor.compress(chunk) if compressor else chunk
+            while len(buffer) >= chunk_size:
+                persisted_size, _ = await self._upload_chunk(session_uri, bytes(buffer[:chunk_size]), offset)
+                del buffer[:persisted_size - offset]
+                offset = persisted_size
+        if compressor:
+            buffer += compressor.flush()
+        total_size = offset + len(buffer)
+        while True:
+            persisted_size, uploaded_object = await self._upload_chunk(
+                session_uri, bytes(buffer), offset, total_size=total_size
+            )
+            if uploaded_object is not None:
+                return uploaded_object
+            del buffer[:persisted_size - offset]
+            offset = persisted_size
+
+    async def _initiate_resumable_upload(self, object_metadata):
+        # https://cloud.google.com/storage/docs/performing-resumable-uploads#initiate-session
+        storage_requests = self.storage_requests
+        url = f"{storage_requests.api_root_write}/{self.bucket_name}/o"
+        for attempt in stamina.retry_context(on=(aiohttp.ClientError, asyncio.TimeoutError),
+                                             attempts=5, wait_initial=1.0, wait_max=30, wait_jitter=3.0):
+            with attempt:
+                headers = await storage_requests.headers(**{"Content-Type": "application/json; charset=UTF-8"})
+                response = await storage_requests.session.post(
+                    url, headers=headers, params={"uploadType": "resumable"}, data=json.dumps(object_metadata)
+                )
+                return response.headers["Location"]
+
+    async def _upload_chunk(self, session_uri, data, offset, total_size=None):
+        """
+        Send data from the given offset of the object, with the total size of the object once it's known.
+        Returns how many bytes of the object GCS persisted, and the uploaded object once the upload is complete.
+        GCS may persist only part of the data. When a request fails, the upload status is checked before retrying,
+        and only the data that wasn't persisted is sent again.
+        """
+        # https://cloud.google.com/storage/docs/performing-resumable-uploads#chunked-upload
+        storage_requests = self.storage_requests
+        total = total_size if total_size is not None else "*"
+        start = offset
+        for attempt in stamina.retry_context(on=(aiohttp.ClientError, asyncio.TimeoutError),
+                                             attempts=5, wait_initial=1.0, wait_max=30, wait_jitter=3.0):
+            with attempt:
+                if attempt.num > 1:  # The previous request may have been persisted, fully or in part
+                    headers = await storage_requests.headers(**{"Content-Range": "bytes */*", "Content-Length": "0"})
+                    start, uploaded_object = await self._put_upload(session_uri, b"", headers, offset)
+                    if uploaded_object is not None or start == offset + len(data) and total_size is None:
+                        return start, uploaded_object
+                remaining_data = data[start - offset:]
+                if remaining_data:
+                    content_range = f"bytes {start}-{start + len(remaining_data) - 1}/{total}"
+                else:
+                    content_range = f"bytes */{total}"
+                headers = await storage_requests.headers(
+                    **{"Content-Range": content_range, "Content-Length": str(len(remaining_data))}
+                )
+                persisted_size, uploaded_object = await self._put_upload(session_uri, remaining_data, headers, offset)
+                if uploaded_object is None and persisted_size == start and (remaining_data or total_size is not None):
+                    raise aiohttp.ClientPayloadError(f"Upload made no progress from byte {start}")
+                return persisted_size, uploaded_object
+
+    async def _put_upload(self, session_uri, data, headers, offset):
+        # Returns how many bytes of the object GCS persisted, and the uploaded object once the upload is complete
+        async with self.storage_requests.raw_session.put(
+            session_uri, data=data, headers=headers, allow_redirects=False
+        ) as response:
+            if response.status != 308:  # 308 means more data is expected, it's not a redirect
+                response.raise_for_status()
+                uploaded_object = await response.json(content_type=None)
+                return int(uploaded_object.get("size", 0)), uploaded_object
+            # The Range header has the persisted bytes, e.g. "bytes=0-262143", and is missing if there are none
+            persisted_range = response.headers.get("Range")
+            persisted_size = int(persisted_range.rsplit("-", 1)[1]) + 1 if persisted_range else 0
+        if persisted_size < offset:  # Data before offset was dropped from memory already, it can't be sent again
+            raise RuntimeError(f"GCS persisted {persisted_size} bytes, but the upload was already at byte {offset}")
+        return persisted_size, None
+
     async def download_file(self, integration_id, source_blob_name, destination_file_path):
         source_path = self.get_file_fullname(integration_id, source_blob_name)
+        not_found_error = None
         for attempt in stamina.retry_context(on=(aiohttp.ClientError, asyncio.TimeoutError),
                                              attempts=5, wait_initial=1.0, wait_max=30, wait_jitter=3.0):
             with attempt:
-                await self.storage_client.download_to_filename(self.bucket_name, source_path, destination_file_path)
+                try:
+                    await self.storage_client.download_to_filename(self.bucket_name, source_path, destination_file_path)
+                except aiohttp.ClientResponseError as e:
+                    if e.status != 404:
+                        raise
+                    not_found_error = e  # Missing files aren't retried
+        if not_found_error:
+            raise not_found_error
 
-    async def delete_file(self, integration_id, blob_name):
-        target_path = self.get_file_fullname(integration_id, blob_name)
+    async def download_bytes(self, integration_id, source_blob_name):
+        """
+        Download a file into memory, without going through a local file.
+        Gzipped files are transferred compressed and returned decompressed.
+        Retried like iter_download(), until the response starts.
+        """
+        return b"".join([chunk async for chunk in self.iter_download(integration_id, source_blob_name)])
+
+    async def iter_download(self, integration_id, source_blob_name, chunk_size=64 * 1024):
+        """
+        Download a file as an async iterator of chunks of bytes, without saving it to disk.
+        Files stored with Content-Encoding: gzip are transferred compressed and decompressed as they are received,
+        and files stored uncompressed are returned as they are.
+        The request is retried until the response starts, the data can't be read again once consumed.
+        Missing files aren't retried.
+        """
+        source_path = self.get_file_fullname(integration_id, source_blob_name)
+        storage_requests = self.storage_requests
+        url = f"{storage_requests.api_root_read}/{self.bucket_name}/o/{quote(source_path, safe='')}"
+        not_found_error = None
         for attempt in stamina.retry_context(on=(aiohttp.ClientError, asyncio.TimeoutError),
                                              attempts=5, wait_initial=1.0, wait_max=30, wait_jitter=3.0):
             with attempt:
-                await self.storage_client.delete(self.bucket_name, target_path)
+                # Ask for the stored bytes, so GCS doesn't decompress gzipped files before sending them
+                headers = await storage_requests.headers(**{"Accept-Encoding": "gzip"})
+                try:
+                    response = await storage_requests.session.get(
+                        url, headers=headers, params={"alt": "media"}, auto_decompress=False,
+                        timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+                    )
+                except aiohttp.ClientResponseError as e:
+                    if e.status != 404:
+                        raise
+                    not_found_error = e
+        if not_found_error:
+            raise not_found_error
+        async with response:
+            if response.headers.get("Content-Encoding") != "gzip":
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    yield chunk
+                return
+            # Decompress up to chunk_size bytes at a time, so memory stays bounded whatever the compression ratio
+            decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+            async for compressed_chunk in response.content.iter_chunked(chunk_size):
+                chunk = decompressor.decompress(compressed_chunk, chunk_size)
+                while chunk:
+                    yield chunk
+                    chunk = decompressor.decompress(decompressor.unconsumed_tail, chunk_size)
+            if chunk := decompressor.flush():
+                yield chunk
 
-    async def list_files(self, integration_id):
-        blobs = await self.storage_client.list_objects(self.bucket_name, params={"prefix": f"{self.root_prefix}/{integration_id}"})
+    async def delete_file(self, integration_id, blob_name):
+        target_path = self.get_file_fullname(integration_id, blob_name)
         for attempt in stamina.retry_context(on=(aiohttp.ClientError, asyncio.TimeoutError),
                                              attempts=5, wait_initial=1.0, wait_max=30, wait_jitter=3.0):
             with attempt:
-                return [blob['name'] for blob in blobs.get('items', [])]
+                await self.storage_client.delete(self.bucket_name, target_path)
+
+    async def batch(self, integration_id, operations):
+        """
+        Run several blob mutations concurrently, e.g. the metadata updates and deletions done after processing a file.
+        Each operation is a dict with an "action" ("update_metadata" or "delete"), a "blob_name",
+        and the "metadata" for updates. Operations on the same blob run in the given order.
+        Returns one result per operation, in the same order: None on success, or the error raised after retries.
+        """
+        results = [None] * len(operations)
+        operations_per_blob = defaultdict(list)
+        for index, operation in enumerate(operations):
+            operations_per_blob[operation["blob_name"]].append(index)
+
+        async def run_blob_operations(indexes):
+            for index in indexes:
+                operation = operations[index]
+                try:
+                    if operation["action"] == "update_metadata":
+                        await self.update_file_metadata(
+                            integration_id=integration_id,
+                            blob_name=operation["blob_name"],
+                            metadata=operation["metadata"]
+                        )
+                    elif operation["action"] == "delete":
+                        await self.delete_file(integration_id=integration_id, blob_name=operation["blob_name"])
+                    else:
+                        raise ValueError(f"Unsupported batch action '{operation['action']}'.")
+                except Exception as e:
+                    results[index] = e
+
+        await asyncio.gather(*[run_blob_operations(indexes) for indexes in operations_per_blob.values()])
+        return results
+
+    async def list_files(self, integration_id, status=None):
+        return [
+            blob["name"] async for blob in self.iter_files(integration_id, status=status, fields=None, page_size=None)
+        ]
+
+    async def iter_files(self, integration_id, status=None, fields="items(name,metadata)", page_size=1000):
+        """
+        Iterate over the blobs of an integration, fetching one page of results at a time.
+        Only the fields in the `fields` projection are fetched (None to get all of them),
+        and blobs can be filtered by their status metadata.
+        """
+        params = {"prefix": f"{self.root_prefix}/{integration_id}"}
+        if fields:
+            params["fields"] = f"{fields},nextPageToken" if "nextPageToken" not in fields else fields
+        if page_size:
+            params["maxResults"] = page_size
+        while True:
+            for attempt in stamina.retry_context(on=(aiohttp.ClientError, asyncio.TimeoutError),
+                                                 attempts=5, wait_initial=1.0, wait_max=30, wait_jitter=3.0):
+                with attempt:
+                    page = await self.storage_client.list_objects(self.bucket_name, params=params)
+            for blob in page.get("items", []):
+                if status is None or blob.get("metadata", {}).get("status") == status:
+                    yield blob
+            if not (page_token := page.get("nextPageToken")):
+                return
+            params = {**params, "pageToken": page_token}
 
     async def get_file_metadata(self, integration_id, blob_name):
         target_path = self.get_file_fullname(integration_id, blob_name)
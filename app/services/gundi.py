@@ -1,8 +1,31 @@
+import asyncio
 import datetime
+import time
+from contextlib import asynccontextmanager
 from typing import List
 import httpx
 import stamina
 from gundi_client_v2.client import GundiClient, GundiDataSenderClient
+from app import settings
+
+
+# integration_id -> (sender client, expiration time). Clients hold the API key of their integration.
+_sensors_api_clients = {}
+# Caps the requests in flight to the sensors API, across all the integrations
+_sensors_api_requests_limit = None
+
+
+def _get_sensors_api_requests_limit():
+    global _sensors_api_requests_limit
+    if _sensors_api_requests_limit is None:
+        _sensors_api_requests_limit = asyncio.Semaphore(settings.GUNDI_SENDER_MAX_CONNECTIONS)
+    return _sensors_api_requests_limit
+
+
+def clear_sensors_api_clients():
+    global _sensors_api_requests_limit
+    _sensors_api_clients.clear()
+    _sensors_api_requests_limit = None
 
 
 @stamina.retry(on=httpx.HTTPError, wait_initial=1.0, wait_jitter=5.0, wait_max=32.0)
@@ -14,14 +37,34 @@ async def _get_gundi_api_key(integration_id):
 
 
 async def _get_sensors_api_client(integration_id):
+    # Reuse the client (and its API key) until it expires, to avoid a call to the portal on every batch
+    cached_client, expires_at = _sensors_api_clients.get(integration_id, (None, 0))
+    if cached_client and expires_at > time.monotonic():
+        return cached_client
     gundi_api_key = await _get_gundi_api_key(integration_id=integration_id)
     assert gundi_api_key, f"Cannot get a valid API Key for integration {integration_id}"
     sensors_api_client = GundiDataSenderClient(
         integration_api_key=gundi_api_key
     )
+    _sensors_api_clients[integration_id] = (
+        sensors_api_client, time.monotonic() + settings.GUNDI_API_KEY_CACHE_TTL
+    )
     return sensors_api_client
 
 
+@asynccontextmanager
+async def _sensors_api_request(integration_id):
+    # Waits while too many requests are in flight. If the API key was rejected (e.g. it was rotated),
+    # the client is dropped so a new key is used on the next attempt.
+    async with _get_sensors_api_requests_limit():
+        try:
+            yield
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code in (httpx.codes.UNAUTHORIZED, httpx.codes.FORBIDDEN):
+                _sensors_api_clients.pop(integration_id, None)
+            raise
+
+
 @stamina.retry(on=httpx.HTTPError, wait_initial=1.0, wait_jitter=5.0, wait_max=32.0)
 async def send_events_to_gundi(events: List[dict], **kwargs) -> dict:
     """
@@ -48,7 +91,8 @@ async def send_events_to_gundi(events: List[dict], **kwargs) -> dict:
     integration_id = kwargs.get("integration_id")
     assert integration_id, "integration_id is required"
     sensors_api_client = await _get_sensors_api_client(integration_id=str(integration_id))
-    return await sensors_api_client.post_events(data=events)
+    async with _sensors_api_request(str(integration_id)):
+        return await sensors_api_client.post_events(data=events)
 
 
 @stamina.retry(on=httpx.HTTPError, wait_initial=1.0, wait_jitter=5.0, wait_max=32.0)
@@ -66,7 +110,8 @@ async def send_event_attachments_to_gundi(event_id: str, attachments: List[tuple
     integration_id = kwargs.get("integration_id")
     assert integration_id, "integration_id is required"
     sensors_api_client = await _get_sensors_api_client(integration_id=str(integration_id))
-    return await sensors_api_client.post_event_attachments(event_id=event_id, attachments=attachments)
+    async with _sensors_api_request(str(integration_id)):
+        return await sensors_api_client.post_event_attachments(event_id=event_id, attachments=attachments)
 
 
 @stamina.retry(on=httpx.HTTPError, wait_initial=1.0, wait_jitter=5.0, wait_max=32.0)
@@ -96,7 +141,8 @@ async def send_observations_to_gundi(observations: List[dict], **kwargs) -> dict
     integration_id = kwargs.get("integration_id")
     assert integration_id, "integration_id is required"
     sensors_api_client = await _get_sensors_api_client(integration_id=str(integration_id))
-    return await sensors_api_client.post_observations(data=observations)
+    async with _sensors_api_request(str(integration_id)):
+        return await sensors_api_client.post_observations(data=observations)
 
 
 @stamina.retry(on=httpx.HTTPError, wait_initial=1.0, wait_jitter=5.0, wait_max=32.0)
@@ -134,4 +180,5 @@ async def send_messages_to_gundi(messages: List[dict], **kwargs) -> dict:
     integration_id = kwargs.get("integration_id")
     assert integration_id, "integration_id is required"
     sensors_api_client = await _get_sensors_api_client(integration_id=str(integration_id))
-    return await sensors_api_client.post_messages(data=messages)
+    async with _sensors_api_request(str(integration_id)):
+        return await sensors_api_client.post_messages(data=messages)
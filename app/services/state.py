@@ -1,10 +1,66 @@
 import json
+from contextlib import asynccontextmanager
 import stamina
 import httpx
 import redis.asyncio as redis
 from app import settings
 
 
+def _state_key(integration_id: str, action_id: str, source_id: str = "no-source"):
+    return f"integration_state.{integration_id}.{action_id}.{source_id}"
+
+
+class StatePipeline:
+    # Queues state and group operations, to run them all in one round trip. See IntegrationStateManager.pipeline().
+
+    def __init__(self):
+        self._commands = []  # (function queueing the command in a redis pipeline, function parsing its result)
+        self.results = []
+
+    def get_state(self, integration_id: str, action_id: str, source_id: str = "no-source"):
+        self._commands.append((
+            lambda pipeline: pipeline.get(_state_key(integration_id, action_id, source_id)),
+            lambda json_value: json.loads(json_value) if json_value else {}
+        ))
+
+    def set_state(self, integration_id: str, action_id: str, state: dict, source_id: str = "no-source"):
+        self._commands.append((
+            lambda pipeline: pipeline.set(_state_key(integration_id, action_id, source_id), json.dumps(state, default=str)),
+            None
+        ))
+
+    def delete_state(self, integration_id: str, action_id: str, source_id: str = "no-source"):
+        self._commands.append((lambda pipeline: pipeline.delete(_state_key(integration_id, action_id, source_id)), None))
+
+    def group_add(self, group_name: str, values: list):
+        self._commands.append((lambda pipeline: pipeline.sadd(group_name, *values), None))
+
+    def group_ismember(self, group_name: str, value: str):
+        self._commands.append((lambda pipeline: pipeline.sismember(group_name, value), bool))
+
+    def group_move(self, from_group: str, to_group: str, values: list):
+        for value in values:  # SMOVE takes one value
+            self._commands.append((lambda pipeline, value=value: pipeline.smove(from_group, to_group, value), None))
+
+    def group_remove(self, group_name: str, values: list):
+        self._commands.append((lambda pipeline: pipeline.srem(group_name, *values), None))
+
+    async def execute(self, db_client, transaction: bool):
+        # Commands are queued again on each attempt, as redis pipelines are reset after running
+        for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30,
+                                             wait_jitter=3.0):
+            with attempt:
+                async with db_client.pipeline(transaction=transaction) as pipeline:
+                    for queue_command, _ in self._commands:
+                        queue_command(pipeline)
+                    results = await pipeline.execute()
+        self.results = [
+            parse_result(result) if parse_result else result
+            for (_, parse_result), result in zip(self._commands, results)
+        ]
+        return self.results
+
+
 class IntegrationStateManager:
 
     def __init__(self, **kwargs):
@@ -35,6 +91,39 @@ class IntegrationStateManager:
                     f"integration_state.{integration_id}.{action_id}.{source_id}"
                 )
 
+    async def get_states_many(self, integration_id: str, action_id: str, source_ids: list) -> dict:
+        # Gets the state of several sources in one round trip, as {source_id: state}.
+        if not source_ids:
+            return {}
+        for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30, wait_jitter=3.0):
+            with attempt:
+                json_values = await self.db_client.mget(
+                    [_state_key(integration_id, action_id, source_id) for source_id in source_ids]
+                )
+        return {
+            source_id: json.loads(json_value) if json_value else {}
+            for source_id, json_value in zip(source_ids, json_values)
+        }
+
+    async def set_states_many(self, integration_id: str, action_id: str, states: dict):
+        # Sets the state of several sources, given as {source_id: state}, in one round trip.
+        if not states:
+            return
+        for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30, wait_jitter=3.0):
+            with attempt:
+                await self.db_client.mset({
+                    _state_key(integration_id, action_id, source_id): json.dumps(state, default=str)
+                    for source_id, state in states.items()
+                })
+
+    @asynccontextmanager
+    async def pipeline(self, transaction: bool = True):
+        # Operations queued in the pipeline run in one round trip when the block exits, atomically if transaction is set.
+        # Results are available in pipeline.results afterwards, in the order the operations were queued.
+        pipeline = StatePipeline()
+        yield pipeline
+        await pipeline.execute(self.db_client, transaction=transaction)
+
     async def group_add(self, group_name: str, values: list):
         # Adds values to a group. The group is created if it does not exist.
         for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30,
@@ -49,6 +138,23 @@ class IntegrationStateManager:
             with attempt:
                 return bool(await self.db_client.sismember(group_name, value))
 
+    async def groups_ismember(self, group_names: list, value: str) -> dict:
+        # Checks in one round trip if the value is in each of the groups, as {group_name: bool}.
+        async with self.pipeline(transaction=False) as pipeline:
+            for group_name in group_names:
+                pipeline.group_ismember(group_name, value)
+        return dict(zip(group_names, pipeline.results))
+
+    async def group_ismember_many(self, group_name: str, values: list) -> dict:
+        # Checks in one round trip if each value is in the group, as {value: bool}.
+        if not values:
+            return {}
+        for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30,
+                                             wait_jitter=3.0):
+            with attempt:
+                results = await self.db_client.smismember(group_name, values)
+        return {value: bool(result) for value, result in zip(values, results)}
+
     async def group_get(self, group_name: str):
         # Gets all values in a group.
         for attempt in stamina.retry_context(on=redis.RedisError, attempts=5, wait_initial=1.0, wait_max=30,
@@ -9,9 +9,11 @@ from gundi_core.events import IntegrationActionFailed
 from gundi_core.events.transformers import ObservationTransformedER
 
 from app import settings
-from app.conftest import MockSubActionConfiguration, MockPushActionConfiguration
+from app.conftest import MockSubActionConfiguration, MockPushActionConfiguration, async_return
 from app.main import app
+from app.services.action_runner import execute_action
 from app.services.action_scheduler import trigger_action
+from app.services.config_manager import IntegrationConfigurationManager
 
 api_client = TestClient(app)
 
@@ -146,6 +148,30 @@ async def test_execute_action_from_api_with_config_overrides(
         assert getattr(config, k) == v
 
 
+@pytest.mark.asyncio
+async def test_config_overrides_dont_change_the_cached_configuration(
+        mocker, mock_gundi_client_v2, integration_v2, mock_redis_with_action_config,
+        mock_publish_event, mock_action_handlers,
+):
+    mocker.patch("app.services.config_manager.redis", mock_redis_with_action_config)
+    config_manager = IntegrationConfigurationManager()
+    mocker.patch.object(config_manager, "get_integration_details", return_value=async_return(integration_v2))
+    mocker.patch("app.services.action_runner.config_manager", config_manager)
+    mocker.patch("app.services.action_runner.action_handlers", mock_action_handlers)
+    mocker.patch("app.services.action_runner._portal", mock_gundi_client_v2)
+    mocker.patch("app.services.activity_logger.publish_event", mock_publish_event)
+    mocker.patch("app.services.action_runner.publish_event", mock_publish_event)
+    integration_id = str(integration_v2.id)
+    mock_action_handler, _, _ = mock_action_handlers["pull_observations"]
+
+    await execute_action(integration_id, "pull_observations", config_overrides={"lookback_days": 3})
+    assert mock_action_handler.call_args.kwargs["action_config"].lookback_days == 3
+    # The configuration is taken from the cache now, without the overrides of the previous execution
+    await execute_action(integration_id, "pull_observations")
+    assert mock_action_handler.call_args.kwargs["action_config"].lookback_days == 30
+    mock_redis_with_action_config.Redis.return_value.get.assert_called_once()
+
+
 @pytest.mark.asyncio
 async def test_execute_action_from_pubsub_with_config_overrides(
         mocker, mock_gundi_client_v2, mock_publish_event, mock_action_handlers, mock_config_manager,
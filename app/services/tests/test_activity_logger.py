@@ -11,7 +11,9 @@ from gundi_core.events import (
     IntegrationWebhookFailed
 )
 from app import settings
-from app.services.activity_logger import publish_event, activity_logger, webhook_activity_logger, log_activity
+from app.services.activity_logger import (
+    publish_event, activity_logger, webhook_activity_logger, log_activity, EventPublisher, _build_pubsub_message
+)
 from app.webhooks import GenericJsonPayload, GenericJsonTransformConfig
 
 
@@ -218,3 +220,70 @@ async def test_log_activity_with_error_level(mocker, integration_v2, mock_publis
     assert mock_publish_event.call_count == 1
     assert isinstance(mock_publish_event.call_args_list[0].kwargs.get("event"), IntegrationActionCustomLog)
 
+
+@pytest.mark.asyncio
+async def test_pubsub_message_ordering_key_is_integration_id(action_started_event):
+    message = _build_pubsub_message(action_started_event)
+
+    assert message.to_repr()["orderingKey"] == str(action_started_event.payload.integration_id)
+
+
+@pytest.mark.asyncio
+async def test_event_publisher_publishes_events_in_batches(
+        mocker, mock_pubsub_client, integration_event_pubsub_message, action_started_event, action_complete_event
+):
+    mocker.patch("app.services.activity_logger.pubsub", mock_pubsub_client)
+    publisher = EventPublisher(max_messages=2, max_latency=10)
+    await publisher.start()
+
+    for event in [action_started_event, action_complete_event, action_complete_event]:
+        await publisher.publish(event=event, topic_name=settings.INTEGRATION_EVENTS_TOPIC)
+    await publisher.stop()  # Publishes the last event without waiting for the batch to fill up
+
+    assert not publisher.is_running
+    assert mock_pubsub_client.PublisherClient.call_count == 1  # Reused for all the batches
+    publish = mock_pubsub_client.PublisherClient.return_value.publish
+    topic = f"projects/{settings.GCP_PROJECT_ID}/topics/{settings.INTEGRATION_EVENTS_TOPIC}"
+    assert publish.call_args_list == [
+        mocker.call(topic, [integration_event_pubsub_message, integration_event_pubsub_message]),
+        mocker.call(topic, [integration_event_pubsub_message]),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_event_publisher_splits_batches_by_size(
+        mocker, mock_pubsub_client, integration_event_pubsub_message, action_started_event
+):
+    mocker.patch("app.services.activity_logger.pubsub", mock_pubsub_client)
+    publisher = EventPublisher(max_bytes=len(integration_event_pubsub_message.data) + 1, max_latency=0.01)
+    await publisher.start()
+
+    for _ in range(2):
+        await publisher.publish(event=action_started_event, topic_name=settings.INTEGRATION_EVENTS_TOPIC)
+    await publisher.stop()
+
+    publish = mock_pubsub_client.PublisherClient.return_value.publish
+    assert publish.call_count == 2
+    for call in publish.call_args_list:
+        assert call.args[1] == [integration_event_pubsub_message]
+
+
+@pytest.mark.asyncio
+async def test_publish_event_with_event_publisher_running(
+        mocker, mock_pubsub_client, integration_event_pubsub_message, action_started_event
+):
+    mocker.patch("app.services.activity_logger.pubsub", mock_pubsub_client)
+    publisher = EventPublisher(max_latency=10)
+    mocker.patch("app.services.activity_logger.event_publisher", publisher)
+    await publisher.start()
+
+    response = await publish_event(event=action_started_event, topic_name=settings.INTEGRATION_EVENTS_TOPIC)
+
+    assert response is None  # Published in the background
+    publish = mock_pubsub_client.PublisherClient.return_value.publish
+    assert not publish.called
+    await publisher.stop()
+    publish.assert_called_once_with(
+        f"projects/{settings.GCP_PROJECT_ID}/topics/{settings.INTEGRATION_EVENTS_TOPIC}",
+        [integration_event_pubsub_message],
+    )
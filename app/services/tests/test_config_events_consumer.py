@@ -2,6 +2,7 @@ import pytest
 from fastapi.testclient import TestClient
 
 from app.main import app
+from app.services.config_manager import IntegrationConfigurationManager
 
 
 api_client = TestClient(app)
@@ -116,3 +117,27 @@ async def test_process_event_action_config_deleted_from_pubsub(
     assert response.status_code == 200
     assert mock_config_manager.delete_action_configuration.called
 
+
+
+@pytest.mark.asyncio
+async def test_process_event_integration_deleted_invalidates_config_cache(
+        mocker, mock_redis_with_integration_config, mock_gundi_client_v2_class,
+        pubsub_message_request_headers, integration_deleted_event_as_pubsub_message
+):
+    mocker.patch("app.services.config_manager.redis", mock_redis_with_integration_config)
+    mocker.patch("app.services.config_manager.GundiClient", mock_gundi_client_v2_class)
+    config_manager = IntegrationConfigurationManager()
+    mocker.patch("app.services.config_events_consumer.config_manager", config_manager)
+    integration_id = "c4517ce8-3c14-46c0-9c68-8978bdc34a1f"  # From the event
+    await config_manager.get_integration(integration_id)
+
+    response = api_client.post(
+        "/config-events/",
+        headers=pubsub_message_request_headers,
+        json=integration_deleted_event_as_pubsub_message,
+    )
+
+    assert response.status_code == 200
+    # Managers used by the action runner don't get the deleted integration from the cache
+    await IntegrationConfigurationManager().get_integration(integration_id)
+    assert mock_redis_with_integration_config.Redis.return_value.get.call_count == 2
@@ -1,7 +1,13 @@
+import asyncio
+
 import pytest
+from unittest.mock import AsyncMock
 
+from fastapi.testclient import TestClient
 from gundi_core.schemas.v2 import IntegrationSummary, IntegrationActionConfiguration, Integration
-from app.services.config_manager import IntegrationConfigurationManager
+from app.conftest import async_return
+from app.main import app
+from app.services.config_manager import IntegrationConfigurationManager, get_config_cache_stats
 
 
 @pytest.mark.asyncio
@@ -106,7 +112,209 @@ async def test_get_integration_details_with_empty_redis_db(
     assert isinstance(integration, Integration)
     assert len(integration.configurations) == len(integration_v2.configurations)
     assert integration.id == integration_v2.id
-    mock_gundi_client_v2_class.return_value.get_integration_details.assert_called_with(integration_id)
+    # Configurations are reloaded from Gundi along with the summary
+    mock_gundi_client_v2_class.return_value.get_integration_details.assert_called_once_with(integration_id)
+    mock_redis_empty.Redis.return_value.get.assert_called_once_with(f"integration.{integration_id}")
+    assert not mock_redis_empty.Redis.return_value.mget.called
+
+
+@pytest.mark.asyncio
+async def test_get_integration_details_from_redis_in_one_round_trip(
+        mocker, mock_redis_with_integration_config, mock_gundi_client_v2_class, integration_v2,
+):
+    mocker.patch("app.services.config_manager.redis", mock_redis_with_integration_config)
+    mocker.patch("app.services.config_manager.GundiClient", mock_gundi_client_v2_class)
+    redis_client = mock_redis_with_integration_config.Redis.return_value
+    # All the actions have a configuration saved
+    configs_by_action = {config.action.value: config for config in integration_v2.configurations}
+    integration_v2.type.actions = [action for action in integration_v2.type.actions if action.value in configs_by_action]
+    redis_client.get.return_value = async_return(integration_v2.json())
+    action_ids = [action.value for action in integration_v2.type.actions]
+    redis_client.mget.return_value = async_return([configs_by_action[action_id].json() for action_id in action_ids])
+    config_manager = IntegrationConfigurationManager()
+    integration_id = str(integration_v2.id)
+
+    integration = await config_manager.get_integration_details(integration_id)
+
+    assert integration.id == integration_v2.id
+    assert len(integration.configurations) == len(integration_v2.configurations)
+    redis_client.get.assert_called_once_with(f"integration.{integration_id}")
+    redis_client.mget.assert_called_once_with(
+        [f"integrationconfig.{integration_id}.{action_id}" for action_id in action_ids]
+    )
+    assert not mock_gundi_client_v2_class.return_value.get_integration_details.called
+
+
+@pytest.mark.asyncio
+async def test_get_integration_details_reloads_missing_configurations_once(
+        mocker, mock_redis_with_integration_config, mock_gundi_client_v2_class, integration_v2,
+):
+    mocker.patch("app.services.config_manager.redis", mock_redis_with_integration_config)
+    mocker.patch("app.services.config_manager.GundiClient", mock_gundi_client_v2_class)
+    redis_client = mock_redis_with_integration_config.Redis.return_value
+    redis_client.mget.return_value = async_return([None] * len(integration_v2.type.actions))
+    config_manager = IntegrationConfigurationManager()
+    integration_id = str(integration_v2.id)
+
+    integration = await config_manager.get_integration_details(integration_id)
+
+    assert len(integration.configurations) == len(integration_v2.configurations)
+    mock_gundi_client_v2_class.return_value.get_integration_details.assert_called_once_with(integration_id)
+
+
+@pytest.mark.asyncio
+async def test_get_integration_details_from_cache(
+        mocker, mock_redis_empty, mock_gundi_client_v2_class, integration_v2,
+):
+    mocker.patch("app.services.config_manager.redis", mock_redis_empty)
+    mocker.patch("app.services.config_manager.GundiClient", mock_gundi_client_v2_class)
+    integration_id = str(integration_v2.id)
+    integration = await IntegrationConfigurationManager().get_integration_details(integration_id)
+    redis_client = mock_redis_empty.Redis.return_value
+    redis_client.get.reset_mock()
+    gundi_client = mock_gundi_client_v2_class.return_value
+    gundi_client.get_integration_details.reset_mock()
+
+    # Other managers in the process share the cache
+    cached_integration = await IntegrationConfigurationManager().get_integration_details(integration_id)
+
+    assert cached_integration == integration
+    assert cached_integration is not integration  # Copies, so callers can't change the cached integration
+    assert not redis_client.get.called
+    assert not gundi_client.get_integration_details.called
+
+
+@pytest.mark.asyncio
+async def test_set_action_configuration_invalidates_cache(
+        mocker, mock_redis_with_action_config, mock_gundi_client_v2_class, integration_v2,
+):
+    mocker.patch("app.services.config_manager.redis", mock_redis_with_action_config)
+    mocker.patch("app.services.config_manager.GundiClient", mock_gundi_client_v2_class)
+    config_manager = IntegrationConfigurationManager()
+    integration_id = str(integration_v2.id)
+    action_id = integration_v2.configurations[0].action.value
+    action_config = await config_manager.get_action_configuration(integration_id, action_id)
+    await config_manager.get_action_configuration(integration_id, action_id)
+    redis_client = mock_redis_with_action_config.Redis.return_value
+    assert redis_client.get.call_count == 1
+
+    await config_manager.set_action_configuration(integration_id, action_id, action_config)
+    await config_manager.get_action_configuration(integration_id, action_id)
+
+    assert redis_client.get.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_get_integration_without_cache(
+        mocker, mock_redis_with_integration_config, mock_gundi_client_v2_class, integration_v2,
+):
+    mocker.patch("app.services.config_manager.redis", mock_redis_with_integration_config)
+    mocker.patch("app.services.config_manager.GundiClient", mock_gundi_client_v2_class)
+    config_manager = IntegrationConfigurationManager()
+    integration_id = str(integration_v2.id)
+    integration = await config_manager.get_integration(integration_id)
+
+    fresh_integration = await config_manager.get_integration(integration_id, use_cache=False)
+
+    assert fresh_integration is not integration
+    assert fresh_integration == integration
+    assert mock_redis_with_integration_config.Redis.return_value.get.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_concurrent_reloads_from_gundi_are_coalesced(
+        mocker, mock_redis_empty, mock_gundi_client_v2_class, integration_v2,
+):
+    mocker.patch("app.services.config_manager.redis", mock_redis_empty)
+    mocker.patch("app.services.config_manager.GundiClient", mock_gundi_client_v2_class)
+
+    async def get_integration_details(integration_id):
+        await asyncio.sleep(0.1)
+        return integration_v2
+
+    gundi_client = mock_gundi_client_v2_class.return_value
+    gundi_client.get_integration_details.side_effect = get_integration_details
+    integration_id = str(integration_v2.id)
+
+    integrations = await asyncio.gather(
+        *[IntegrationConfigurationManager().get_integration(integration_id) for _ in range(3)]
+    )
+
+    assert all(integration.id == integration_v2.id for integration in integrations)
+    gundi_client.get_integration_details.assert_called_once_with(integration_id)
+    mock_redis_empty.Redis.return_value.lock.assert_called_once_with(
+        f"integration_reload_lock.{integration_id}", timeout=60, blocking_timeout=30
+    )
+    stats = get_config_cache_stats()
+    assert stats["misses"] == 3
+    assert stats["reloads"] == 1
+    assert stats["reloads_coalesced"] == 2
+    assert stats["reloads_in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_reload_from_gundi_takes_result_of_other_replica(
+        mocker, mock_redis_empty, mock_gundi_client_v2_class, integration_v2,
+):
+    mocker.patch("app.services.config_manager.redis", mock_redis_empty)
+    mocker.patch("app.services.config_manager.GundiClient", mock_gundi_client_v2_class)
+    redis_client = mock_redis_empty.Redis.return_value
+    integration_id = str(integration_v2.id)
+    # Another replica holds the lock, and leaves the result of its reload
+    lock = redis_client.lock.return_value
+    lock.acquire = AsyncMock(side_effect=[False, True])
+    redis_client.get = AsyncMock(
+        side_effect=lambda key: integration_v2.json() if key == f"integration_reload.{integration_id}" else None
+    )
+
+    integration = await IntegrationConfigurationManager().get_integration_details(integration_id)
+
+    assert integration.id == integration_v2.id
+    assert len(integration.configurations) == len(integration_v2.configurations)
+    assert not mock_gundi_client_v2_class.return_value.get_integration_details.called
+    lock.release.assert_called_once()
+    assert get_config_cache_stats()["reloads_shared"] == 1
+
+
+@pytest.mark.asyncio
+async def test_reload_from_gundi_saves_configurations_in_one_transaction(
+        mocker, mock_redis_empty, mock_gundi_client_v2_class, integration_v2,
+):
+    mocker.patch("app.services.config_manager.redis", mock_redis_empty)
+    mocker.patch("app.services.config_manager.GundiClient", mock_gundi_client_v2_class)
+    mocker.patch("app.services.config_manager.settings.CONFIG_RELOAD_TTL", 3600)
+    redis_client = mock_redis_empty.Redis.return_value
+    integration_id = str(integration_v2.id)
+
+    await IntegrationConfigurationManager().get_integration(integration_id)
+
+    redis_client.pipeline.assert_called_once_with(transaction=True)
+    redis_client.execute.assert_called_once()
+    redis_client.set.assert_any_call(
+        f"integration.{integration_id}", IntegrationSummary.from_integration(integration_v2).json(), ex=3600
+    )
     for config in integration_v2.configurations:
-        action_id = config.action.value
-        mock_redis_empty.Redis.return_value.get.assert_any_call(f"integrationconfig.{integration_id}.{action_id}")
+        redis_client.set.assert_any_call(
+            f"integrationconfig.{integration_id}.{config.action.value}", config.json(), ex=3600
+        )
+    redis_client.set.assert_any_call(f"integration_reload.{integration_id}", integration_v2.json(), ex=60)
+    assert redis_client.set.call_count == len(integration_v2.configurations) + 2
+
+
+@pytest.mark.asyncio
+async def test_config_cache_stats_endpoint(
+        mocker, mock_redis_with_integration_config, mock_gundi_client_v2_class, integration_v2,
+):
+    mocker.patch("app.services.config_manager.redis", mock_redis_with_integration_config)
+    mocker.patch("app.services.config_manager.GundiClient", mock_gundi_client_v2_class)
+    config_manager = IntegrationConfigurationManager()
+    integration_id = str(integration_v2.id)
+    await config_manager.get_integration(integration_id)
+    await config_manager.get_integration(integration_id)
+
+    response = TestClient(app).get("/status/config-cache")
+
+    assert response.status_code == 200
+    assert response.json() == get_config_cache_stats()
+    assert response.json()["hits"] == 1
+    assert response.json()["misses"] == 1
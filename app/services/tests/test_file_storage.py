@@ -1,7 +1,16 @@
+import asyncio
+import gzip
+
+import aiohttp
 import pytest
+import stamina
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from gcloud.aio.storage import Storage
 
 from app import settings
-from app.services.file_storage import CloudFileStorage
+from app.conftest import FakeGCSServer
+from app.services.file_storage import CloudFileStorage, StorageRequests, close_storage_session, get_storage_session
 
 
 @pytest.mark.asyncio
@@ -50,6 +59,23 @@ async def test_download_file(mocker, mock_gcp_cloud_storage, integration_v2):
     )
 
 
+@pytest.mark.asyncio
+async def test_download_file_does_not_retry_missing_files(mocker, mock_gcp_cloud_storage, integration_v2):
+    mocker.patch("app.services.file_storage.Storage", mock_gcp_cloud_storage)
+    storage_client = mock_gcp_cloud_storage.return_value
+    storage_client.download_to_filename.side_effect = aiohttp.ClientResponseError(
+        request_info=mocker.MagicMock(), history=(), status=404
+    )
+    file_storage = CloudFileStorage()
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        await file_storage.download_file(
+            integration_id=str(integration_v2.id), source_blob_name="missing.xml", destination_file_path="/tmp/missing.xml"
+        )
+
+    storage_client.download_to_filename.assert_called_once()
+
+
 @pytest.mark.asyncio
 async def test_delete_file(mocker, mock_gcp_cloud_storage, integration_v2):
     mocker.patch("app.services.file_storage.Storage", mock_gcp_cloud_storage)
@@ -115,3 +141,316 @@ async def test_update_file_metadata(mocker, mock_gcp_cloud_storage, integration_
         f"integrations/{integration_id}/{blob_name}",
         {"metadata": metadata}
     )
+
+
+async def iter_chunks(data, chunk_size):
+    for i in range(0, len(data), chunk_size):
+        yield data[i: i + chunk_size]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("size", [0, 1000, 256 * 1024, 700 * 1024])
+async def test_upload_stream(mocker, integration_v2, size):
+    mocker.patch("app.services.file_storage.settings.GCP_UPLOAD_CHUNK_SIZE", 256 * 1024)
+    integration_id = str(integration_v2.id)
+    blob_name = "20241201100200000000_dd65d9de-0ec8-480c-8719-c1f5ff4d639a_data_points.xml"
+    data = bytes(i % 251 for i in range(size))
+    async with FakeGCSServer() as gcs:
+        file_storage = CloudFileStorage()
+        file_storage._storage_client = Storage(api_root=gcs.url)
+
+        await file_storage.upload_stream(
+            integration_id=integration_id,
+            chunks=iter_chunks(data, 10000),
+            destination_blob_name=blob_name,
+            metadata={"status": "pending"}
+        )
+        await file_storage.storage_client.close()
+
+    stored_data, stored_metadata = gcs.objects[f"integrations/{integration_id}/{blob_name}"]
+    assert stored_data == data
+    assert stored_metadata["metadata"] == {"status": "pending"}
+    assert stored_metadata["contentType"] == "application/xml"
+    # Data is sent in chunks of GCP_UPLOAD_CHUNK_SIZE, plus the last one
+    assert len([r for r in gcs.requests if r.method == "PUT"]) == size // (256 * 1024) + 1
+
+
+@pytest.mark.asyncio
+async def test_upload_stream_with_gzip(mocker, integration_v2):
+    mocker.patch("app.services.file_storage.settings.GCP_UPLOAD_CHUNK_SIZE", 256 * 1024)
+    integration_id = str(integration_v2.id)
+    blob_name = "20241201100200000000_dd65d9de-0ec8-480c-8719-c1f5ff4d639a_data_points.xml"
+    data = b"<Table><AtsSerialNum>052194</AtsSerialNum></Table>" * 50000
+    async with FakeGCSServer() as gcs:
+        file_storage = CloudFileStorage()
+        file_storage._storage_client = Storage(api_root=gcs.url)
+
+        await file_storage.upload_stream(
+            integration_id=integration_id,
+            chunks=iter_chunks(data, 64 * 1024),
+            destination_blob_name=blob_name,
+            zipped=True
+        )
+        await file_storage.storage_client.close()
+
+    stored_data, stored_metadata = gcs.objects[f"integrations/{integration_id}/{blob_name}"]
+    assert stored_metadata["contentEncoding"] == "gzip"
+    assert gzip.decompress(stored_data) == data
+    assert len(stored_data) < len(data) // 10
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("max_persisted_per_chunk,failed_chunk_uploads", [
+    (256 * 1024, 0),  # GCS persisted only part of each chunk
+    (None, 2),  # The responses were lost after the chunks were persisted
+    (256 * 1024, 2),
+])
+async def test_upload_stream_resends_only_what_was_not_persisted(
+        mocker, integration_v2, max_persisted_per_chunk, failed_chunk_uploads
+):
+    mocker.patch("app.services.file_storage.settings.GCP_UPLOAD_CHUNK_SIZE", 512 * 1024)
+    retry_context = stamina.retry_context
+    mocker.patch(
+        "app.services.file_storage.stamina.retry_context",
+        lambda on, attempts, **kwargs: retry_context(on=on, attempts=attempts, wait_initial=0, wait_max=0, wait_jitter=0)
+    )
+    integration_id = str(integration_v2.id)
+    blob_name = "20241201100200000000_dd65d9de-0ec8-480c-8719-c1f5ff4d639a_data_points.xml"
+    data = bytes(i % 251 for i in range(1300 * 1024))
+    async with FakeGCSServer(max_persisted_per_chunk, failed_chunk_uploads) as gcs:
+        file_storage = CloudFileStorage()
+        file_storage._storage_client = Storage(api_root=gcs.url)
+
+        uploaded_object = await file_storage.upload_stream(
+            integration_id=integration_id,
+            chunks=iter_chunks(data, 10000),
+            destination_blob_name=blob_name
+        )
+        await file_storage.storage_client.close()
+
+    stored_data, _ = gcs.objects[f"integrations/{integration_id}/{blob_name}"]
+    assert stored_data == data
+    assert uploaded_object["size"] == str(len(data))
+    # The status of the upload is checked before retrying a failed chunk upload
+    status_requests = [r for r in gcs.requests if r.method == "PUT" and r.headers["Content-Range"] == "bytes */*"]
+    assert len(status_requests) == failed_chunk_uploads
+
+
+@pytest.mark.asyncio
+async def test_storage_requests_fails_on_unsupported_storage_client():
+    # StorageRequests uses private parts of gcloud-aio Storage, a new version changing them must fail loudly
+    storage_client = Storage(api_root="http://localhost:9023")
+    storage_requests = StorageRequests(storage_client)
+    await storage_client.close()
+    assert storage_requests.api_root_write == "http://localhost:9023/upload/storage/v1/b"
+    assert storage_requests.api_root_read == "http://localhost:9023/storage/v1/b"
+    assert isinstance(storage_requests.raw_session, aiohttp.ClientSession)
+    assert await storage_requests.headers(Range="bytes=0-1") == {"Range": "bytes=0-1"}  # No token for the emulator
+
+    class ChangedStorage:
+        session = None
+
+    with pytest.raises(RuntimeError, match="Unsupported gcloud-aio-storage version"):
+        StorageRequests(ChangedStorage())
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("zipped", [True, False])
+async def test_iter_download(integration_v2, zipped):
+    integration_id = str(integration_v2.id)
+    blob_name = "20241201100200000000_dd65d9de-0ec8-480c-8719-c1f5ff4d639a_data_points.xml"
+    data = b"<Table><AtsSerialNum>052194</AtsSerialNum></Table>" * 50000
+    async with FakeGCSServer() as gcs:
+        file_storage = CloudFileStorage()
+        file_storage._storage_client = Storage(api_root=gcs.url)
+        await file_storage.upload_stream(
+            integration_id=integration_id,
+            chunks=iter_chunks(data, 64 * 1024),
+            destination_blob_name=blob_name,
+            zipped=zipped
+        )
+
+        chunks = [
+            chunk async for chunk in file_storage.iter_download(
+                integration_id=integration_id, source_blob_name=blob_name, chunk_size=16 * 1024
+            )
+        ]
+        await file_storage.storage_client.close()
+
+    assert b"".join(chunks) == data
+    assert max(len(chunk) for chunk in chunks) <= 16 * 1024
+    # Gzipped files are requested compressed, GCS doesn't decompress them before sending
+    download_request = gcs.requests[-1]
+    assert download_request.query["alt"] == "media"
+    assert "gzip" in download_request.headers["Accept-Encoding"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("zipped", [True, False])
+async def test_upload_and_download_bytes(integration_v2, zipped):
+    integration_id = str(integration_v2.id)
+    blob_name = "20241201100200000000_dd65d9de-0ec8-480c-8719-c1f5ff4d639a_transmissions.xml"
+    data = b"<Table><CollarSerialNum>052194</CollarSerialNum></Table>" * 1000
+    async with FakeGCSServer() as gcs:
+        file_storage = CloudFileStorage()
+        file_storage._storage_client = Storage(api_root=gcs.url)
+
+        await file_storage.upload_bytes(
+            integration_id=integration_id,
+            data=data,
+            destination_blob_name=blob_name,
+            metadata={"status": "pending"},
+            zipped=zipped
+        )
+        result = await file_storage.download_bytes(integration_id=integration_id, source_blob_name=blob_name)
+        await file_storage.storage_client.close()
+
+    assert result == data
+    stored_data, stored_metadata = gcs.objects[f"integrations/{integration_id}/{blob_name}"]
+    assert stored_metadata["metadata"] == {"status": "pending"}
+    assert (gzip.decompress(stored_data) if zipped else stored_data) == data
+
+
+@pytest.mark.asyncio
+async def test_download_bytes_does_not_retry_missing_files(integration_v2):
+    async with FakeGCSServer() as gcs:
+        file_storage = CloudFileStorage()
+        file_storage._storage_client = Storage(api_root=gcs.url)
+
+        with pytest.raises(aiohttp.ClientResponseError) as error:
+            await file_storage.download_bytes(integration_id=str(integration_v2.id), source_blob_name="missing.xml")
+        await file_storage.storage_client.close()
+
+    assert error.value.status == 404
+    assert len(gcs.requests) == 1
+
+
+@pytest.mark.asyncio
+async def test_storage_clients_share_pooled_session(monkeypatch, integration_v2):
+    integration_id = str(integration_v2.id)
+    async with FakeGCSServer() as gcs:
+        monkeypatch.setenv("STORAGE_EMULATOR_HOST", gcs.url)
+        file_storages = [CloudFileStorage() for _ in range(3)]
+        for i, file_storage in enumerate(file_storages):
+            await file_storage.upload_bytes(
+                integration_id=integration_id, data=b"<xml/>", destination_blob_name=f"file_{i}.xml"
+            )
+        sessions = {id(file_storage.storage_client.session.session) for file_storage in file_storages}
+        stats = CloudFileStorage.pool_stats()
+        await close_storage_session()
+
+    assert len(sessions) == 1
+    assert len(gcs.objects) == 3
+    assert stats["open"]
+    assert stats["limit"] == settings.GCP_STORAGE_MAX_CONNECTIONS
+    assert stats["limit_per_host"] == settings.GCP_STORAGE_MAX_CONNECTIONS_PER_HOST
+    # Every request went through the shared connector
+    assert stats["connections_created"] + stats["connections_reused"] == 3
+    assert stats["requests_queued"] == 0
+    assert stats["in_use"] == 0
+
+
+@pytest.mark.asyncio
+async def test_pool_stats_count_connections_in_use():
+    release_responses = asyncio.Event()
+
+    async def slow_handler(request):
+        await release_responses.wait()
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_get("/", slow_handler)
+    async with TestServer(app) as server:
+        session = get_storage_session()
+        requests = [asyncio.create_task(session.get(server.make_url("/"))) for _ in range(2)]
+        async with asyncio.timeout(5):  # Until both requests got a connection
+            while CloudFileStorage.pool_stats()["in_use"] < 2:
+                await asyncio.sleep(0.01)
+        release_responses.set()
+        for response in await asyncio.gather(*requests):
+            response.release()
+        stats = CloudFileStorage.pool_stats()
+        await close_storage_session()
+
+    assert stats["in_use"] == 0
+    assert stats["connections_created"] == 2
+
+
+@pytest.mark.asyncio
+async def test_storage_client_recreated_after_session_closed(monkeypatch, integration_v2):
+    async with FakeGCSServer() as gcs:
+        monkeypatch.setenv("STORAGE_EMULATOR_HOST", gcs.url)
+        file_storage = CloudFileStorage()
+        first_client = file_storage.storage_client
+        await close_storage_session()
+        await file_storage.upload_bytes(
+            integration_id=str(integration_v2.id), data=b"<xml/>", destination_blob_name="file.xml"
+        )
+        second_client = file_storage.storage_client
+        await close_storage_session()
+
+    assert second_client is not first_client
+    assert not CloudFileStorage.pool_stats()["open"]
+    assert len(gcs.objects) == 1
+
+
+@pytest.mark.asyncio
+async def test_batch_runs_operations_and_reports_errors_per_item(mocker, integration_v2):
+    # Fail on the first error
+    retry_context = stamina.retry_context
+    mocker.patch(
+        "app.services.file_storage.stamina.retry_context",
+        lambda on, **kwargs: retry_context(on=on, attempts=1)
+    )
+    integration_id = str(integration_v2.id)
+    async with FakeGCSServer() as gcs:
+        file_storage = CloudFileStorage()
+        file_storage._storage_client = Storage(api_root=gcs.url)
+        for blob_name in ["data_points.xml", "transmissions.xml", "other.xml"]:
+            await file_storage.upload_bytes(integration_id=integration_id, data=b"<xml/>", destination_blob_name=blob_name)
+
+        results = await file_storage.batch(integration_id=integration_id, operations=[
+            {"action": "update_metadata", "blob_name": "data_points.xml", "metadata": {"status": "processed"}},
+            {"action": "update_metadata", "blob_name": "missing.xml", "metadata": {"status": "processed"}},
+            {"action": "update_metadata", "blob_name": "other.xml", "metadata": {"status": "processed"}},
+            {"action": "delete", "blob_name": "data_points.xml"},
+            {"action": "delete", "blob_name": "transmissions.xml"},
+            {"action": "copy", "blob_name": "other.xml"},
+        ])
+        await file_storage.storage_client.close()
+
+    assert results[0] is None
+    assert isinstance(results[1], aiohttp.ClientResponseError)
+    assert results[1].status == 404
+    assert results[2:5] == [None, None, None]
+    assert isinstance(results[5], ValueError)
+    # The metadata of a file is updated before it's deleted
+    requests = [(r.method, r.match_info["name"].rsplit("/", 1)[-1]) for r in gcs.requests if r.method != "POST"]
+    assert requests.index(("PATCH", "data_points.xml")) < requests.index(("DELETE", "data_points.xml"))
+    assert list(gcs.objects) == [f"integrations/{integration_id}/other.xml"]
+    assert gcs.objects[f"integrations/{integration_id}/other.xml"][1]["metadata"] == {"status": "processed"}
+
+
+@pytest.mark.asyncio
+async def test_iter_files_follows_pages_and_filters_by_status(integration_v2):
+    integration_id = str(integration_v2.id)
+    async with FakeGCSServer() as gcs:
+        file_storage = CloudFileStorage()
+        file_storage._storage_client = Storage(api_root=gcs.url)
+        for i in range(5):
+            await file_storage.upload_bytes(
+                integration_id=integration_id, data=b"<xml/>", destination_blob_name=f"file_{i}.xml",
+                metadata={"status": "processed" if i % 2 else "pending"}
+            )
+        await file_storage.upload_bytes(integration_id="other-integration", data=b"<xml/>", destination_blob_name="file.xml")
+
+        all_files = [blob async for blob in file_storage.iter_files(integration_id=integration_id, page_size=2)]
+        pending_files = await file_storage.list_files(integration_id=integration_id, status="pending")
+        await file_storage.storage_client.close()
+
+    assert [blob["name"] for blob in all_files] == [f"integrations/{integration_id}/file_{i}.xml" for i in range(5)]
+    assert pending_files == [f"integrations/{integration_id}/file_{i}.xml" for i in [0, 2, 4]]
+    list_requests = [r for r in gcs.requests if r.method == "GET"]
+    assert [r.query.get("pageToken") for r in list_requests[:3]] == [None, "2", "4"]
+    assert list_requests[0].query["fields"] == "items(name,metadata),nextPageToken"
+    assert list_requests[0].query["maxResults"] == "2"
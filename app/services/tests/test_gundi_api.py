@@ -1,4 +1,10 @@
+import asyncio
+
+import httpx
 import pytest
+import respx
+import stamina
+from app.services import gundi
 from app.services.gundi import send_events_to_gundi, send_observations_to_gundi, send_event_attachments_to_gundi
 
 
@@ -121,3 +127,110 @@ async def test_send_observations_to_gundi(
     assert len(response) == 2
     assert mock_gundi_sensors_client_class.called
     mock_gundi_sensors_client_class.return_value.post_observations.assert_called_once_with(data=observations)
+
+
+@pytest.fixture
+def observations():
+    return [
+        {
+            "source": "device-xy123",
+            "type": "tracking-device",
+            "recorded_at": "2024-01-24 09:03:00-0300",
+            "location": {
+                "lat": -51.748,
+                "lon": -72.720
+            }
+        }
+    ]
+
+
+@pytest.fixture
+def sensors_api(mocker, observations_created_response):
+    mocker.patch("gundi_client_v2.client.settings.SENSORS_API_BASE_URL", "https://sensors.api")
+    with respx.mock(assert_all_called=False) as respx_mock:
+        respx_mock.post("https://sensors.api/v2/observations/").respond(201, json=observations_created_response)
+        yield respx_mock
+
+
+@pytest.mark.asyncio
+async def test_sensors_api_client_is_reused_across_batches(
+        mocker, sensors_api, mock_get_gundi_api_key, mock_api_key, integration_v2, observations
+):
+    mocker.patch("app.services.gundi._get_gundi_api_key", mock_get_gundi_api_key)
+    sender_client_class = mocker.patch(
+        "app.services.gundi.GundiDataSenderClient", side_effect=gundi.GundiDataSenderClient
+    )
+
+    for _ in range(3):
+        await send_observations_to_gundi(observations=observations, integration_id=integration_v2.id)
+
+    # The API key is requested once and the same client is used for all the batches
+    assert mock_get_gundi_api_key.call_count == 1
+    sender_client_class.assert_called_once_with(integration_api_key=mock_api_key)
+    route = sensors_api.routes[0]
+    assert route.call_count == 3
+    assert route.calls.last.request.headers["apikey"] == mock_api_key
+
+
+@pytest.mark.asyncio
+async def test_sensors_api_client_is_renewed_after_expiration(
+        mocker, sensors_api, mock_get_gundi_api_key, integration_v2, observations
+):
+    mocker.patch("app.services.gundi._get_gundi_api_key", mock_get_gundi_api_key)
+    mocker.patch("app.services.gundi.settings.GUNDI_API_KEY_CACHE_TTL", 0)
+
+    await send_observations_to_gundi(observations=observations, integration_id=integration_v2.id)
+    await send_observations_to_gundi(observations=observations, integration_id=integration_v2.id)
+
+    assert mock_get_gundi_api_key.call_count == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("status_code", [401, 403])
+async def test_sensors_api_client_is_dropped_when_api_key_rejected(
+        mocker, sensors_api, mock_get_gundi_api_key, integration_v2, observations, observations_created_response,
+        status_code
+):
+    mocker.patch("app.services.gundi._get_gundi_api_key", mock_get_gundi_api_key)
+    sensors_api.routes[0].side_effect = [
+        httpx.Response(status_code), httpx.Response(201, json=observations_created_response)
+    ]
+
+    stamina.set_active(False)  # Fail on the first error
+    try:
+        with pytest.raises(httpx.HTTPStatusError):
+            await send_observations_to_gundi(observations=observations, integration_id=integration_v2.id)
+    finally:
+        stamina.set_active(True)
+    response = await send_observations_to_gundi(observations=observations, integration_id=integration_v2.id)
+
+    # A new API key is requested after the rejection
+    assert response == observations_created_response
+    assert mock_get_gundi_api_key.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_sensors_api_requests_in_flight_are_limited(
+        mocker, sensors_api, mock_get_gundi_api_key, integration_v2, observations, observations_created_response
+):
+    mocker.patch("app.services.gundi._get_gundi_api_key", mock_get_gundi_api_key)
+    mocker.patch("app.services.gundi.settings.GUNDI_SENDER_MAX_CONNECTIONS", 2)
+    requests_in_flight = 0
+    max_requests_in_flight = 0
+
+    async def respond(request):
+        nonlocal requests_in_flight, max_requests_in_flight
+        requests_in_flight += 1
+        max_requests_in_flight = max(max_requests_in_flight, requests_in_flight)
+        await asyncio.sleep(0.01)
+        requests_in_flight -= 1
+        return httpx.Response(201, json=observations_created_response)
+
+    sensors_api.routes[0].side_effect = respond
+
+    await asyncio.gather(*[
+        send_observations_to_gundi(observations=observations, integration_id=integration_v2.id) for _ in range(6)
+    ])
+
+    assert sensors_api.routes[0].call_count == 6
+    assert max_requests_in_flight == 2
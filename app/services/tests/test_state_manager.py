@@ -2,6 +2,7 @@ import datetime
 import json
 
 import pytest
+from app.conftest import async_return
 from app.services.state import IntegrationStateManager
 
 
@@ -204,3 +205,88 @@ async def test_group_remove(mocker, mock_redis, integration_v2):
     await state_manager.group_remove(group_name=group_name, values=files)
 
     mock_redis.StrictRedis.return_value.srem.assert_called_once_with(group_name, *files)
+
+
+@pytest.mark.asyncio
+async def test_get_states_many(mocker, mock_redis, integration_v2, mock_integration_state):
+    mocker.patch("app.services.state.redis", mock_redis)
+    redis_client = mock_redis.StrictRedis.return_value
+    redis_client.mget.return_value = async_return([json.dumps(mock_integration_state), None])
+    state_manager = IntegrationStateManager()
+    integration_id = str(integration_v2.id)
+
+    states = await state_manager.get_states_many(
+        integration_id=integration_id,
+        action_id="pull_observations",
+        source_ids=["device-1", "device-2"]
+    )
+
+    assert states == {"device-1": mock_integration_state, "device-2": {}}
+    redis_client.mget.assert_called_once_with([
+        f"integration_state.{integration_id}.pull_observations.device-1",
+        f"integration_state.{integration_id}.pull_observations.device-2",
+    ])
+
+
+@pytest.mark.asyncio
+async def test_set_states_many(mocker, mock_redis, integration_v2):
+    mocker.patch("app.services.state.redis", mock_redis)
+    redis_client = mock_redis.StrictRedis.return_value
+    redis_client.mset.return_value = async_return(True)
+    state_manager = IntegrationStateManager()
+    integration_id = str(integration_v2.id)
+
+    await state_manager.set_states_many(
+        integration_id=integration_id,
+        action_id="pull_observations",
+        states={"device-1": {"last_position": 1}, "device-2": {"last_position": 2}}
+    )
+
+    redis_client.mset.assert_called_once_with({
+        f"integration_state.{integration_id}.pull_observations.device-1": '{"last_position": 1}',
+        f"integration_state.{integration_id}.pull_observations.device-2": '{"last_position": 2}',
+    })
+    assert not redis_client.set.called
+
+
+@pytest.mark.asyncio
+async def test_groups_ismember(mocker, mock_redis):
+    mocker.patch("app.services.state.redis", mock_redis)
+    redis_client = mock_redis.StrictRedis.return_value
+    redis_client.execute.return_value = async_return([1, 0])
+    state_manager = IntegrationStateManager()
+
+    result = await state_manager.groups_ismember(group_names=["group_a", "group_b"], value="file_1.xml")
+
+    assert result == {"group_a": True, "group_b": False}
+    redis_client.pipeline.assert_called_once_with(transaction=False)
+    redis_client.sismember.assert_has_calls([
+        mocker.call("group_a", "file_1.xml"),
+        mocker.call("group_b", "file_1.xml"),
+    ])
+    redis_client.execute.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_pipeline_runs_queued_operations_in_one_round_trip(mocker, mock_redis, integration_v2):
+    mocker.patch("app.services.state.redis", mock_redis)
+    redis_client = mock_redis.StrictRedis.return_value
+    redis_client.execute.return_value = async_return([True, 1, True, '{"last_position": 1}'])
+    state_manager = IntegrationStateManager()
+    integration_id = str(integration_v2.id)
+
+    async with state_manager.pipeline() as pipeline:
+        pipeline.set_state(integration_id, "pull_observations", {"last_position": 1}, source_id="device-1")
+        pipeline.group_add("group_a", ["file_1.xml"])
+        pipeline.group_move("group_a", "group_b", ["file_1.xml"])
+        pipeline.get_state(integration_id, "pull_observations", source_id="device-1")
+        assert not redis_client.pipeline.called  # Nothing runs until the block exits
+
+    redis_client.pipeline.assert_called_once_with(transaction=True)
+    redis_client.set.assert_called_once_with(
+        f"integration_state.{integration_id}.pull_observations.device-1", '{"last_position": 1}'
+    )
+    redis_client.sadd.assert_called_once_with("group_a", "file_1.xml")
+    redis_client.smove.assert_called_once_with("group_a", "group_b", "file_1.xml")
+    redis_client.execute.assert_called_once()
+    assert pipeline.results == [True, 1, True, {"last_position": 1}]
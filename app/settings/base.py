@@ -40,6 +40,8 @@ PORTAL_INBOUND_INTEGRATIONS_ENDPOINT = (
 GUNDI_API_BASE_URL = env.str("GUNDI_API_BASE_URL", None)
 GUNDI_API_SSL_VERIFY = env.bool("GUNDI_API_SSL_VERIFY", True)
 SENSORS_API_BASE_URL = env.str("SENSORS_API_BASE_URL", None)
+GUNDI_API_KEY_CACHE_TTL = env.int("GUNDI_API_KEY_CACHE_TTL", 60 * 10)  # Seconds
+GUNDI_SENDER_MAX_CONNECTIONS = env.int("GUNDI_SENDER_MAX_CONNECTIONS", 20)  # Requests in flight to the sensors API
 
 # Used in OTel traces/spans to set the 'environment' attribute, used on metrics calculation
 TRACE_ENVIRONMENT = env.str("TRACE_ENVIRONMENT", "dev")
@@ -48,6 +50,11 @@ TRACE_ENVIRONMENT = env.str("TRACE_ENVIRONMENT", "dev")
 GCP_PROJECT_ID = env.str("GCP_PROJECT_ID", "cdip-78ca")
 GCP_BUCKET_NAME = env.str("GCP_BUCKET_NAME", "cdip-files-prod")
 GCP_BUCKET_ROOT_PREFIX = env.str("GCP_BUCKET_ROOT_PREFIX", "integrations")
+GCP_UPLOAD_CHUNK_SIZE = env.int("GCP_UPLOAD_CHUNK_SIZE", 8 * 256 * 1024)  # Bytes, rounded to multiples of 256 KiB
+GCP_STORAGE_MAX_CONNECTIONS = env.int("GCP_STORAGE_MAX_CONNECTIONS", 100)
+GCP_STORAGE_MAX_CONNECTIONS_PER_HOST = env.int("GCP_STORAGE_MAX_CONNECTIONS_PER_HOST", 20)
+GCP_STORAGE_DNS_CACHE_TTL = env.int("GCP_STORAGE_DNS_CACHE_TTL", 300)  # Seconds
+GCP_STORAGE_KEEPALIVE_TIMEOUT = env.float("GCP_STORAGE_KEEPALIVE_TIMEOUT", 60)  # Seconds
 
 KEYCLOAK_ALGORITHMS = env.list("KEYCLOAK_ALGORITHMS", ["RS256", "HS256"])
 KEYCLOAK_AUDIENCE = env.str("KEYCLOAK_AUDIENCE", None)
@@ -61,6 +68,13 @@ REDIS_HOST = env.str("REDIS_HOST", "localhost")
 REDIS_PORT = env.int("REDIS_PORT", 6379)
 REDIS_STATE_DB = env.int("REDIS_STATE_DB", 0)
 REDIS_CONFIGS_DB = env.int("REDIS_CONFIGS_DB", 1)  # ToDo: define a convention for DB numbers across services
+# In-process cache of parsed configurations, in front of the configs DB. Set the size or ttl to 0 to disable it.
+CONFIG_CACHE_MAX_SIZE = env.int("CONFIG_CACHE_MAX_SIZE", 1024)
+CONFIG_CACHE_TTL = env.float("CONFIG_CACHE_TTL", 60)  # Seconds
+# Concurrent reloads of an integration from Gundi, across replicas, wait on the one holding the lock
+CONFIG_RELOAD_LOCK_TIMEOUT = env.float("CONFIG_RELOAD_LOCK_TIMEOUT", 60)  # Seconds, also how long the result is shared
+CONFIG_RELOAD_LOCK_WAIT = env.float("CONFIG_RELOAD_LOCK_WAIT", 30)  # Seconds, then reload anyway
+CONFIG_RELOAD_TTL = env.int("CONFIG_RELOAD_TTL", None)  # Seconds to keep configurations reloaded from Gundi. None to keep them
 
 
 REGISTER_ON_START = env.bool("REGISTER_ON_START", False)
@@ -75,3 +89,9 @@ INTEGRATION_EVENTS_TOPIC = env.str("INTEGRATION_EVENTS_TOPIC", "integration-even
 default_commands_topic = f"{INTEGRATION_TYPE_SLUG}-actions-topic" if INTEGRATION_TYPE_SLUG else None
 INTEGRATION_COMMANDS_TOPIC = env.str("INTEGRATION_COMMANDS_TOPIC", default_commands_topic)
 TRIGGER_ACTIONS_ALWAYS_SYNC = env.bool("TRIGGER_ACTIONS_ALWAYS_SYNC", False)
+# System events are published in the background in batches, while the app is running
+PUBSUB_BATCH_EVENTS = env.bool("PUBSUB_BATCH_EVENTS", True)
+PUBSUB_BATCH_MAX_MESSAGES = env.int("PUBSUB_BATCH_MAX_MESSAGES", 100)  # PubSub accepts up to 1000
+PUBSUB_BATCH_MAX_BYTES = env.int("PUBSUB_BATCH_MAX_BYTES", 1_000_000)  # PubSub accepts up to 10MB per request
+PUBSUB_BATCH_MAX_LATENCY = env.float("PUBSUB_BATCH_MAX_LATENCY", 0.5)  # Seconds
+PUBSUB_BATCH_DRAIN_TIMEOUT = env.float("PUBSUB_BATCH_DRAIN_TIMEOUT", 30)  # Seconds to publish pending events on shutdown
@@ -1,6 +1,41 @@
+import math
 from environs import Env
 
 env = Env()
 env.read_env()
 
 OBSERVATIONS_BATCH_SIZE = env.int("OBSERVATIONS_BATCH_SIZE", default=200)
+OBSERVATIONS_MAX_CONCURRENT_BATCHES = env.int("OBSERVATIONS_MAX_CONCURRENT_BATCHES", default=4)
+OBSERVATIONS_BATCH_MAX_BYTES = env.int("OBSERVATIONS_BATCH_MAX_BYTES", default=0)  # 0 means no limit
+
+ATS_STORE_FILES_GZIPPED = env.bool("ATS_STORE_FILES_GZIPPED", default=True)  # Pulled files are stored compressed
+# Files in progress for longer are set back to pending. Keep it above MAX_ACTION_EXECUTION_TIME.
+FILE_PROCESSING_LEASE_SECONDS = env.int("FILE_PROCESSING_LEASE_SECONDS", default=60 * 10)
+# Files failing this many times are left in progress instead of being retried, until their status is set manually
+FILE_PROCESSING_MAX_ATTEMPTS = env.int("FILE_PROCESSING_MAX_ATTEMPTS", default=3)
+# Processed files are kept for this long, up to a maximum per integration
+PROCESSED_FILES_RETENTION_DAYS = env.int("PROCESSED_FILES_RETENTION_DAYS", default=30)
+PROCESSED_FILES_MAX_COUNT = env.int("PROCESSED_FILES_MAX_COUNT", default=10000)
+# Bloom filters of processed files, one per retention period and two kept per integration. Sized for the files
+# processed per period (one data points file per 10-minute pull by default), at a target false positive rate:
+#   bits = files * -ln(rate) / ln(2)^2, rounded up to a power of two, and hashes = -log2(rate), rounded up.
+# With the defaults, ~4.3k files in 30 days at 1%: 2**16 bits (8 KiB per filter) and 7 hashes.
+PROCESSED_FILES_FILTER_EXPECTED_FILES = env.int(
+    "PROCESSED_FILES_FILTER_EXPECTED_FILES", default=PROCESSED_FILES_RETENTION_DAYS * 24 * 6
+)
+PROCESSED_FILES_FILTER_FALSE_POSITIVE_RATE = env.float("PROCESSED_FILES_FILTER_FALSE_POSITIVE_RATE", default=0.01)
+PROCESSED_FILES_FILTER_SIZE_BITS = env.int(
+    "PROCESSED_FILES_FILTER_SIZE_BITS",
+    default=2 ** math.ceil(math.log2(
+        PROCESSED_FILES_FILTER_EXPECTED_FILES * -math.log(PROCESSED_FILES_FILTER_FALSE_POSITIVE_RATE) / math.log(2) ** 2
+    ))
+)
+PROCESSED_FILES_FILTER_HASHES = env.int(
+    "PROCESSED_FILES_FILTER_HASHES", default=math.ceil(-math.log2(PROCESSED_FILES_FILTER_FALSE_POSITIVE_RATE))
+)
+
+# Pooled HTTP clients for the ATS endpoints
+ATS_HTTP2 = env.bool("ATS_HTTP2", default=False)  # Requires the 'h2' package
+ATS_MAX_CONNECTIONS = env.int("ATS_MAX_CONNECTIONS", default=10)
+ATS_MAX_KEEPALIVE_CONNECTIONS = env.int("ATS_MAX_KEEPALIVE_CONNECTIONS", default=5)
+ATS_KEEPALIVE_EXPIRY = env.float("ATS_KEEPALIVE_EXPIRY", default=60 * 11)  # Seconds, longer than the pull interval
@@ -0,0 +1,150 @@
+"""
+Compare the file-based and in-memory paths of CloudFileStorage on ATS-sized data points files.
+
+For each file size it uploads and downloads the same XML using:
+  - file:   write to /tmp + upload_file(), download_file() + read from /tmp (the original path)
+  - bytes:  upload_bytes() + download_bytes()
+  - stream: upload_stream() + iter_download()
+and reports the time of each step and the peak memory allocated by Python (tracemalloc).
+
+Run it from the repository root against a GCS emulator (e.g. fake-gcs-server) or a real bucket:
+    PYTHONPATH=. STORAGE_EMULATOR_HOST=http://localhost:4443 python local/benchmarks/file_storage_benchmark.py
+or against the minimal fake of the GCS API used in the tests, started in a child process:
+    PYTHONPATH=. python local/benchmarks/file_storage_benchmark.py --fake-gcs
+Memory is measured in the benchmark process only, so the storage server is never counted.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import re
+import time
+import tracemalloc
+from contextlib import asynccontextmanager
+
+from gcloud.aio.storage import Storage
+
+from app.services.file_storage import CloudFileStorage
+
+
+SAMPLE_FILE = "app/actions/tests/files/ats_data_points.xml"
+INTEGRATION_ID = "benchmark"
+
+
+def build_data_points_xml(size_in_bytes):
+    # Repeat the <Table> rows of the sample file until reaching the requested size
+    with open(SAMPLE_FILE) as f:
+        sample = f.read()
+    rows = "".join(re.findall(r"<Table .*?</Table>\s*", sample, flags=re.DOTALL))
+    head, tail = sample.split("<Table ", 1)[0], sample.rsplit("</Table>", 1)[1]
+    repeats = max(1, (size_in_bytes - len(head) - len(tail)) // len(rows))
+    return (head + rows * repeats + tail).encode("utf-8")
+
+
+async def iter_chunks(data, chunk_size=64 * 1024):
+    for i in range(0, len(data), chunk_size):
+        yield data[i: i + chunk_size]
+
+
+async def run_file_path(file_storage, blob_name, data, zipped):
+    local_path = f"/tmp/{blob_name}"
+    start = time.monotonic()
+    with open(local_path, "wb") as f:
+        f.write(data)
+    await file_storage.upload_file(INTEGRATION_ID, local_path, blob_name)
+    upload_time = time.monotonic() - start
+    os.remove(local_path)
+    start = time.monotonic()
+    await file_storage.download_file(INTEGRATION_ID, blob_name, local_path)
+    with open(local_path, "rb") as f:
+        result = f.read()
+    download_time = time.monotonic() - start
+    os.remove(local_path)
+    return upload_time, download_time, result
+
+
+async def run_bytes_path(file_storage, blob_name, data, zipped):
+    start = time.monotonic()
+    await file_storage.upload_bytes(INTEGRATION_ID, data, blob_name, zipped=zipped)
+    upload_time = time.monotonic() - start
+    start = time.monotonic()
+    result = await file_storage.download_bytes(INTEGRATION_ID, blob_name)
+    download_time = time.monotonic() - start
+    return upload_time, download_time, result
+
+
+async def run_stream_path(file_storage, blob_name, data, zipped):
+    start = time.monotonic()
+    await file_storage.upload_stream(INTEGRATION_ID, iter_chunks(data), blob_name, zipped=zipped)
+    upload_time = time.monotonic() - start
+    start = time.monotonic()
+    size = 0
+    async for chunk in file_storage.iter_download(INTEGRATION_ID, blob_name):
+        size += len(chunk)  # Consume the data without keeping it, as the streaming parser does
+    download_time = time.monotonic() - start
+    return upload_time, download_time, size
+
+
+PATHS = {"file": run_file_path, "bytes": run_bytes_path, "stream": run_stream_path}
+
+
+def serve_fake_gcs(urls):
+    from app.conftest import FakeGCSServer  # Only available with the dev requirements
+
+    async def serve():
+        async with FakeGCSServer() as gcs:
+            urls.put(gcs.url)
+            await asyncio.Event().wait()
+
+    logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+    asyncio.run(serve())
+
+
+@asynccontextmanager
+async def storage_api(fake_gcs):
+    if not fake_gcs:
+        yield None  # gcloud-aio uses STORAGE_EMULATOR_HOST, or the real GCS API
+        return
+    urls = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve_fake_gcs, args=(urls,), daemon=True)
+    server.start()
+    try:
+        yield urls.get(timeout=30)
+    finally:
+        server.terminate()
+
+
+async def main(sizes, repeat, zipped, fake_gcs):
+    logging.getLogger().setLevel(logging.WARNING)
+    async with storage_api(fake_gcs) as api_root:
+        file_storage = CloudFileStorage()
+        file_storage._storage_client = Storage(api_root=api_root) if api_root else Storage()
+        print(f"{'size':>8} {'path':>7} {'upload s':>9} {'download s':>11} {'peak MiB':>9}")
+        for size in sizes:
+            data = build_data_points_xml(size * 1024 * 1024)
+            for path_name, run_path in PATHS.items():
+                blob_name = f"benchmark_{size}MB_{path_name}.xml"
+                for _ in range(repeat):
+                    tracemalloc.start()
+                    upload_time, download_time, result = await run_path(file_storage, blob_name, data, zipped)
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    assert result == data or result == len(data), f"Data mismatch in the {path_name} path"
+                    print(
+                        f"{size:>6}MB {path_name:>7} {upload_time:>9.3f} {download_time:>11.3f} "
+                        f"{peak / 1024 / 1024:>9.1f}"
+                    )
+                if not fake_gcs:
+                    await file_storage.delete_file(INTEGRATION_ID, blob_name)
+        await file_storage.storage_client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1,10,50", help="Comma separated file sizes in MiB")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--zipped", action="store_true", help="Store the files gzip-compressed")
+    parser.add_argument("--fake-gcs", action="store_true", help="Use a local fake of the GCS API")
+    args = parser.parse_args()
+    asyncio.run(main([int(size) for size in args.sizes.split(",")], args.repeat, args.zipped, args.fake_gcs))